@@ -0,0 +1,430 @@
+import numpy as np
+import threading
+from enum import Enum
+from time import sleep, perf_counter
+
+from .Recording import ScanReplay
+
+try:
+	import nidaqmx as dq
+	from nidaqmx import constants as _ni_constants
+	from nidaqmx.stream_readers import AnalogMultiChannelReader
+except ImportError:
+	dq=None
+
+
+"""
+This file contains the backends used by the classes in DAQ_tasks (Scan, L_task, PD_task and Power_PD_task) to talk
+to the DAQ. A backend lists the devices, creates tasks and stream readers and provides the constants used to
+configure the tasks. The tasks themselves have the interface of nidaqmx tasks (only the part of it that is used in
+DAQ_tasks), so the classes in DAQ_tasks don't depend on which backend is used.
+
+Three backends are available (chosen with "Backend" in the [DAQ] section of the config file):
+	ni			-	NI-DAQmx through the nidaqmx package (real or NI-simulated devices).
+	simulated	-	Devices and tasks implemented with NumPy only, so the program (and the whole lock loop) can run,
+					be benchmarked and profiled without NI drivers. The data is generated by DAQ_tasks.simulate_scan.
+	replay		-	Same as the simulated backend, but the data are scans recorded before (see Recording.py), read
+					back as fast as they're asked for.
+"""
+
+
+"""
+Returns the backend of given name. Device name and "realtime" are used only by the simulated and replay backends,
+"replay_file" only by the replay backend (see below).
+"""
+def get_backend(name="ni",dev_name="default",realtime=True,replay_file=None):
+
+	if name=="ni":
+		return NIBackend()
+	elif name=="simulated":
+		return SimBackend(dev_name,realtime)
+	elif name=="replay":
+		return ReplayBackend(replay_file,dev_name)
+
+	raise ValueError('Unknown DAQ backend.')
+
+
+
+#################################################################################################################
+
+
+"""
+NI-DAQmx backend. It only passes everything to nidaqmx, which is imported when this file is loaded (if it's not
+installed, only this backend can't be used).
+"""
+class NIBackend:
+
+	name="ni"
+
+	#Data read from the DAQ is real (DAQ_tasks replaces it only if simulation is chosen separately).
+	simulated=False
+
+	def __init__(self):
+
+		if dq is None:
+			raise ImportError('The nidaqmx package is needed for the "ni" DAQ backend.')
+
+		self.AcquisitionType=_ni_constants.AcquisitionType
+		self.RegenerationMode=_ni_constants.RegenerationMode
+		self.WriteRelativeTo=_ni_constants.WriteRelativeTo
+		self.DigitalWidthUnits=_ni_constants.DigitalWidthUnits
+
+
+	def devices(self):
+		return dq.system.System.local().devices
+
+
+	def task(self,name):
+		return dq.Task(new_task_name=name)
+
+
+	#Reader of the input stream of a task (reads into preallocated arrays).
+	def reader(self,task):
+		return AnalogMultiChannelReader(task.in_stream)
+
+
+
+#################################################################################################################
+
+
+"""
+Constants of the simulated backend. They have the same names as the nidaqmx constants used in DAQ_tasks.
+"""
+class AcquisitionType(Enum):
+	FINITE=0
+	CONTINUOUS=1
+
+class RegenerationMode(Enum):
+	ALLOW_REGENERATION=0
+	DONT_ALLOW_REGENERATION=1
+
+class WriteRelativeTo(Enum):
+	FIRST_SAMPLE=0
+	CURRENT_WRITE_POSITION=1
+
+class DigitalWidthUnits(Enum):
+	SECONDS=0
+	TICKS=1
+	SAMPLE_CLOCK_PERIODS=2
+
+
+"""
+Simulated backend. It has one device with 4 analog outputs and 16 analog inputs. Tasks keep their settings and the
+data written to them, finite tasks take as long as they would on a real DAQ (if "realtime" is True, otherwise they
+finish immediately, which is useful for profiling) and continuous input tasks call their callback once per the
+given number of samples from their own thread. Reads return zeros (DAQ_tasks replaces them with simulated data).
+"""
+class SimBackend:
+
+	name="simulated"
+	simulated=True
+
+	AcquisitionType=AcquisitionType
+	RegenerationMode=RegenerationMode
+	WriteRelativeTo=WriteRelativeTo
+	DigitalWidthUnits=DigitalWidthUnits
+
+	def __init__(self,dev_name="default",realtime=True):
+
+		if dev_name=="default":
+			dev_name="Dev1"
+
+		self.device=SimDevice(dev_name)
+		self.realtime=realtime
+
+
+	def devices(self):
+		return [self.device]
+
+
+	def task(self,name):
+		return SimTask(name,self)
+
+
+	def reader(self,task):
+		return SimReader(task)
+
+
+
+#Simulated device. Last data written to each output channel is kept in "outputs" (channel name: data).
+class SimDevice:
+
+	def __init__(self,name,n_ao=4,n_ai=16):
+
+		self.name=name
+		self.ao_physical_chans=_SimChannels([name+"/ao"+str(i) for i in range(n_ao)])
+		self.ai_physical_chans=_SimChannels([name+"/ai"+str(i) for i in range(n_ai)])
+		self.outputs={}
+
+
+
+#List of channels of a device or of a task (the part of nidaqmx channel collections that is used).
+class _SimChannels:
+
+	def __init__(self,names=None):
+		self.channel_names=list(names) if names is not None else []
+
+	def add_ao_voltage_chan(self,physical_channel):
+		self.channel_names.append(physical_channel)
+
+	def add_ai_voltage_chan(self,physical_channel):
+		self.channel_names.append(physical_channel)
+
+
+
+#Sample clock of a simulated task.
+class _SimTiming:
+
+	def __init__(self):
+
+		self.samp_clk_rate=1000.
+		self.samp_clk_src=None
+		self.samp_quant_samp_mode=AcquisitionType.FINITE
+		self.samp_quant_samp_per_chan=1000
+
+
+	def cfg_samp_clk_timing(self,rate,source="",active_edge=None,sample_mode=AcquisitionType.FINITE,samps_per_chan=1000):
+
+		self.samp_clk_rate=float(rate)
+		self.samp_clk_src=source
+		self.samp_quant_samp_mode=sample_mode
+		self.samp_quant_samp_per_chan=int(samps_per_chan)
+
+
+
+#Start trigger of a simulated task (the settings are only kept).
+class _SimStartTrigger:
+
+	def __init__(self):
+
+		self.source=None
+		self.delay=0
+		self.delay_units=DigitalWidthUnits.SECONDS
+
+
+	def cfg_dig_edge_start_trig(self,trigger_source):
+		self.source=trigger_source
+
+	def disable_start_trig(self):
+		self.source=None
+
+
+
+class _SimTriggers:
+
+	def __init__(self):
+		self.start_trigger=_SimStartTrigger()
+
+
+
+#Output stream settings of a simulated task (they are only kept).
+class _SimOutStream:
+
+	def __init__(self):
+
+		self.output_buf_size=0
+		self.regen_mode=RegenerationMode.ALLOW_REGENERATION
+		self.relative_to=WriteRelativeTo.CURRENT_WRITE_POSITION
+		self.offset=0
+
+
+
+"""
+Simulated task. Output and input channels are added the same way as to a nidaqmx task. A finite task is done when
+the configured number of samples would be generated at the configured rate after it was started.
+"""
+class SimTask:
+
+	def __init__(self,name,backend):
+
+		self.name=name
+		self._backend=backend
+		self._channels=_SimChannels()
+		self.ao_channels=self._channels
+		self.ai_channels=self._channels
+		self.timing=_SimTiming()
+		self.triggers=_SimTriggers()
+		self.out_stream=_SimOutStream()
+		self.in_stream=self
+
+		self._started=None
+		self._callback=None
+		self._every_n=0
+		self._stop=threading.Event()
+		self._thread=None
+
+
+	@property
+	def channel_names(self):
+		return list(self._channels.channel_names)
+
+
+	@property
+	def number_of_channels(self):
+		return len(self._channels.channel_names)
+
+
+	#Data for one channel is a number or a 1D array, for more channels a list or a 2D array (one row per channel).
+	def write(self,data,auto_start=False):
+
+		data=np.asarray(data,dtype=float)
+		if data.ndim==0 or (data.ndim==1 and self.number_of_channels>1):
+			data=data.reshape(-1,1)
+		else:
+			data=data.reshape(self.number_of_channels,-1)
+
+		for ch,values in zip(self._channels.channel_names,data):
+			self._backend.device.outputs[ch]=values.copy()
+
+		if auto_start:
+			self.start()
+
+		return data.shape[1]
+
+
+	def start(self):
+
+		self._started=perf_counter()
+
+		if self._callback is not None and self.timing.samp_quant_samp_mode==AcquisitionType.CONTINUOUS:
+			self._stop.clear()
+			self._thread=threading.Thread(target=self._run_callbacks,daemon=True)
+			self._thread.start()
+
+
+	def stop(self):
+
+		self._stop.set()
+		if self._thread is not None and self._thread is not threading.current_thread():
+			self._thread.join()
+		self._thread=None
+		self._started=None
+
+
+	def close(self):
+		self.stop()
+
+
+	#Waits until the samples of a finite task would be generated (only in the real-time mode).
+	def wait_until_done(self,timeout=10.):
+
+		if self._started is None or not self._backend.realtime:
+			return
+
+		remaining=self._started+self.timing.samp_quant_samp_per_chan/self.timing.samp_clk_rate-perf_counter()
+		if remaining>timeout:
+			raise TimeoutError('Simulated task did not finish in time.')
+		if remaining>0:
+			sleep(remaining)
+
+
+	def register_every_n_samples_acquired_into_buffer_event(self,sample_interval,callback_method):
+
+		self._every_n=sample_interval
+		self._callback=callback_method
+
+
+	#Calls the callback every "_every_n" samples (at the clock rate, or as fast as possible if not in real time).
+	def _run_callbacks(self):
+
+		period=self._every_n/self.timing.samp_clk_rate
+		next_call=perf_counter()+period
+
+		while not self._stop.is_set():
+			if self._backend.realtime:
+				self._stop.wait(max(next_call-perf_counter(),0))
+				if self._stop.is_set():
+					break
+				next_call+=period
+			self._callback(None,None,self._every_n,None)
+
+
+
+#################################################################################################################
+
+
+"""
+Replay backend. Tasks are the simulated ones (not in real time), but reading a scan of the same shape as the
+recorded scans (channels x samples) returns the next recorded scan, so the lock loop processes recorded data as fast
+as it can. Other reads (e.g. power) return zeros. Scans are replayed in order and from the beginning again after the
+last one ("finished" is set then); the scan settings have to be the same as during the recording.
+"""
+class ReplayBackend(SimBackend):
+
+	name="replay"
+	simulated=False
+
+	def __init__(self,filename,dev_name="default"):
+
+		if filename is None:
+			raise ValueError('No file to replay.')
+
+		SimBackend.__init__(self,dev_name,realtime=False)
+
+		self.replay=ScanReplay(filename)
+		if len(self.replay)==0:
+			raise ValueError('There are no scans in the file to replay.')
+
+		self.position=0
+		self.finished=threading.Event()
+
+
+	def reader(self,task):
+		return ReplayReader(task,self)
+
+
+	#Next recorded scan.
+	def next_scan(self):
+
+		data=self.replay.scan(self.position)
+
+		self.position+=1
+		if self.position==len(self.replay):
+			self.position=0
+			self.finished.set()
+
+		return data
+
+
+
+#Reader of a replay task (see above).
+class ReplayReader:
+
+	def __init__(self,task,backend):
+		self._task=task
+		self._backend=backend
+
+
+	"""
+	Only the readout of the photodetectors runs on the sample clock of the scan, so only its reads get the recorded
+	scans. If the scans it reads don't have the shape of the recorded ones, the scan settings differ from those of the
+	recording and an error is raised. Other reads return zeros.
+	"""
+	def read_many_sample(self,data,number_of_samples_per_channel=-1,timeout=10.):
+
+		if not (self._task.timing.samp_clk_src or "").endswith('/ao/SampleClock'):
+			data[:,:number_of_samples_per_channel]=0
+			return number_of_samples_per_channel
+
+		shape=(self._backend.replay.channels,self._backend.replay.n_samples)
+		if data.shape!=shape:
+			raise ValueError('Recorded scans {} can not be replayed as scans {} (the scan settings have to be the same as during the recording).'.format(shape,data.shape))
+
+		np.copyto(data,self._backend.next_scan())
+
+		return number_of_samples_per_channel
+
+
+
+#Reader of a simulated task. It fills the given array (channels x samples) with zeros.
+class SimReader:
+
+	def __init__(self,task):
+		self._task=task
+
+
+	def read_many_sample(self,data,number_of_samples_per_channel=-1,timeout=10.):
+
+		data[:,:number_of_samples_per_channel]=0
+
+		return number_of_samples_per_channel
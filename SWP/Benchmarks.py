@@ -0,0 +1,79 @@
+import os
+import glob
+import timeit
+import numpy as np
+
+from .Config import load_conf
+from .Data_acq import Filter
+
+
+"""
+Micro-benchmarks of the signal processing that is done on every scan. They are not used by the program itself,
+they are meant to be run by hand after changing the filters, e.g. with:
+
+	python -m SWP.Benchmarks
+
+The number of samples per scan is taken from the config files in the "configs" folder, so the timings are given
+for the scans that are actually used in the lab.
+"""
+
+
+#Previous implementation of the peak filter. It is kept only as a reference for the benchmark.
+def _peak_filter_loop(data,k=10):
+	return np.concatenate((np.concatenate((data[:k],[data[i]**2-data[i-k]*data[i+k] for i in range(k,len(data)-k)])),data[-k:]))
+
+
+#Returns sorted numbers of samples per scan found in all config files.
+def config_scan_samples(cfg_dir=None):
+
+	if cfg_dir is None:
+		cfg_dir=os.path.dirname(os.path.realpath(__file__))+"/configs"
+
+	samples=set()
+	for filename in glob.glob(cfg_dir+"/*.ini"):
+		try:
+			samples.add(int(load_conf(filename)['CAVITY']['ScanSamples']))
+		except (KeyError,ValueError):
+			pass
+
+	return sorted(samples)
+
+
+"""
+Compares the slice-based peak filter with the previous list comprehension for different numbers of samples per
+scan. For each of them it prints the time per call for both versions (in microseconds), the speed-up and how
+many points differ between them (see Filter.peak_filter for why a few points can differ in the last bit).
+"""
+def bench_peak_filter(samples=None,number=200,repeat=5):
+
+	if samples is None:
+		samples=config_scan_samples()+[5000]
+
+	fltr=Filter()
+	results=[]
+
+	print("{:>8} {:>12} {:>12} {:>9} {:>8}".format("Samples","Loop [us]","Slices [us]","Speed-up","Diff."))
+
+	for n in samples:
+
+		#Data similar to a real scan: a couple of peaks on top of noise.
+		x=np.linspace(0,1,n)
+		data=0.01/((x-0.4)**2+1e-4)+0.01/((x-0.8)**2+1e-4)+0.01*np.random.randn(n)
+		data=data-np.mean(data)
+		out=np.empty(n)
+
+		ref=_peak_filter_loop(data)
+		res=fltr.peak_filter(data,out=out)
+		diff=np.count_nonzero(ref!=res)
+
+		t_loop=min(timeit.repeat(lambda: _peak_filter_loop(data),number=number,repeat=repeat))/number
+		t_slice=min(timeit.repeat(lambda: fltr.peak_filter(data,out=out),number=number,repeat=repeat))/number
+
+		print("{:>8d} {:>12.1f} {:>12.1f} {:>9.1f} {:>8d}".format(n,1e6*t_loop,1e6*t_slice,t_loop/t_slice,diff))
+		results.append((n,t_loop,t_slice,diff))
+
+	return results
+
+
+if __name__=="__main__":
+	bench_peak_filter()
@@ -0,0 +1,225 @@
+import numpy as np
+from collections import deque
+
+
+"""
+This file contains containers for histories of values that are updated on every scan (e.g. error signals). Their
+point is that adding a value and reading the statistics costs the same no matter how long the history is.
+"""
+
+
+"""
+Rolling statistics (RMS, mean and peak-to-peak) of the last "window" values. Running sums of the values and of their
+squares are kept, so adding a value only adds the new one and subtracts the one that leaves the window. To keep the
+rounding errors of the running sums from adding up, they are summed again from scratch once per "window" values,
+which still costs O(1) per value on average.
+
+Minimum and maximum are kept by a _Extrema object (see below).
+"""
+class RollingStats:
+
+	def __init__(self,window):
+
+		self._window=max(int(window),1)
+		self.reset()
+
+
+	#Removes all values.
+	def reset(self):
+
+		self._values=deque(maxlen=self._window)
+		self._sum=0.
+		self._sum_sq=0.
+		self._since_sum=0
+		self._extrema=_Extrema()
+
+
+	def append(self,value):
+
+		value=float(value)
+
+		if len(self._values)==self._window:
+			old=self._values[0]
+			self._sum-=old
+			self._sum_sq-=old*old
+
+		self._values.append(value)
+		self._sum+=value
+		self._sum_sq+=value*value
+
+		self._since_sum+=1
+		if self._since_sum>=self._window:
+			self._resum()
+
+		self._extrema.append(value,len(self._values))
+
+
+	def __len__(self):
+		return len(self._values)
+
+
+	@property
+	def window(self):
+		return self._window
+
+
+	#Changing the window keeps the last values (as many as fit in the new window).
+	@window.setter
+	def window(self,window):
+
+		values=list(self._values)
+		self._window=max(int(window),1)
+		self.reset()
+
+		for value in values[-self._window:]:
+			self.append(value)
+
+
+	@property
+	def mean(self):
+		return self._sum/len(self._values) if self._values else 0.
+
+
+	@property
+	def rms(self):
+		return np.sqrt(max(self._sum_sq,0.)/len(self._values)) if self._values else 0.
+
+
+	@property
+	def ptp(self):
+		return self._extrema.max-self._extrema.min if self._values else 0.
+
+
+	def _resum(self):
+
+		self._sum=float(np.sum(self._values))
+		self._sum_sq=float(np.dot(self._values,self._values))
+		self._since_sum=0
+
+
+
+"""
+Fixed-capacity history of values kept in a NumPy array, used in place of deque(maxlen=capacity) for values that are
+plotted. The array is twice as long as the capacity and every value is written to two places (i and i+capacity), so
+the values, from the oldest to the newest, are always a contiguous part of the array: "values" returns them as a
+view, without copying. X values for plotting (0,1,2,...) are also kept in an array and returned as a view, and the
+minimum and maximum are kept up to date with every value, so that nothing has to go over the whole history.
+"""
+class RingBuffer:
+
+	def __init__(self,capacity,dtype=float):
+
+		self.capacity=max(int(capacity),1)
+		self._data=np.zeros(2*self.capacity,dtype=dtype)
+		self._x=np.arange(self.capacity,dtype=float)
+		self.clear()
+
+
+	#Removes all values.
+	def clear(self):
+
+		self._start=0
+		self._len=0
+		self._extrema=_Extrema()
+
+
+	def append(self,value):
+
+		end=(self._start+self._len)%self.capacity
+		self._data[end]=value
+		self._data[end+self.capacity]=value
+
+		if self._len<self.capacity:
+			self._len+=1
+		else:
+			self._start=(self._start+1)%self.capacity
+
+		self._extrema.append(self._data[end],self._len)
+
+
+	def __len__(self):
+		return self._len
+
+
+	def __getitem__(self,ind):
+		return self.values[ind]
+
+
+	def __iter__(self):
+		return iter(self.values)
+
+
+	#Values from the oldest to the newest (read-only view).
+	@property
+	def values(self):
+
+		view=self._data[self._start:self._start+self._len]
+		view.flags.writeable=False
+
+		return view
+
+
+	#X values (indices) of the values, for plotting (read-only view).
+	@property
+	def x(self):
+
+		view=self._x[:self._len]
+		view.flags.writeable=False
+
+		return view
+
+
+	@property
+	def min(self):
+		return self._extrema.min
+
+
+	@property
+	def max(self):
+		return self._extrema.max
+
+
+
+"""
+Minimum and maximum of the last values added, for RollingStats and RingBuffer. Two monotonic queues are used: the
+one for the maximum holds only the values that can still become the maximum (each is smaller than the ones before
+it), and similarly for the minimum. Every value enters and leaves each queue at most once, so the cost per value is
+O(1) on average.
+"""
+class _Extrema:
+
+	def __init__(self):
+
+		self._mins=deque()		#(index, value) pairs, values increasing
+		self._maxs=deque()		#(index, value) pairs, values decreasing
+		self._count=0			#Number of values added (used as their index)
+
+
+	#Adds a value, "length" is the number of last values (including this one) that are still kept.
+	def append(self,value,length):
+
+		while self._mins and self._mins[-1][1]>=value:
+			self._mins.pop()
+		self._mins.append((self._count,value))
+
+		while self._maxs and self._maxs[-1][1]<=value:
+			self._maxs.pop()
+		self._maxs.append((self._count,value))
+
+		self._count+=1
+		first=self._count-length
+
+		if self._mins[0][0]<first:
+			self._mins.popleft()
+		if self._maxs[0][0]<first:
+			self._maxs.popleft()
+
+
+	@property
+	def min(self):
+		return self._mins[0][1] if self._mins else 0.
+
+
+	@property
+	def max(self):
+		return self._maxs[0][1] if self._maxs else 0.
@@ -1,9 +1,14 @@
-import nidaqmx as dq
-import matplotlib.pyplot as plt
 import numpy as np
-import math
+import queue
 from collections import deque
-import random
+import logging
+
+from .Backends import get_backend
+from .Simulation import CavityModel, setup_model
+from .Recording import ScanRecorder, unused_filename
+
+
+log=logging.getLogger(__name__)
 
 
 """
@@ -13,26 +18,31 @@ itself references to objects of three other classes defined here: Scan class, co
 which controls voltages applied to science lasers (so controls their frequencies), and PD_task class, which is
 designed to read data from photodetectors for both the master and slave lasers.The whole process of scanning (so
 writing data) and reading is managed from the level of DAQ_tasks. It also contains some more general helpful methods.
+All of them create their DAQ tasks through a backend (see Backends.py): NI-DAQmx or a simulated device.
 """
 class DAQ_tasks:
 
 	"""
 	The class can be initialized with device name, if read from a config file. Then, it searches through all DAQs
 	that are connected to this computer (might include a smiulated DAQ) and chooses one that matches the name.
-	Otherwise, it chooses the first one from the list.
+	Otherwise, it chooses the first one from the list. Devices are listed by the backend (NI-DAQmx by default).
 	"""
-	def __init__(self,simulate,dev_name=None):
+	def __init__(self,simulate,dev_name=None,backend=None):
+
+		if backend is None:
+			backend=get_backend("ni")
+		self.backend=backend
 
-		syst=dq.system.System.local()
+		devices=backend.devices()
 		if dev_name is not None:
-			for dev in syst.devices:
+			for dev in devices:
 				if dev.name==dev_name:
 					self.device=dev
 					break
 			else:
 				raise NameError('Could not locate DAQ device of given name.')
 		else:
-			self.device=syst.devices[0]
+			self.device=devices[0]
 		self.ao_scan=0
 		self.ao_laser=0
 		self.ai_PDs=0
@@ -41,9 +51,71 @@ class DAQ_tasks:
 		self.PD_data=[]
 		self.simulation=simulate
 
-
-	#To avoid error when the program is being closed, the tasks are closed first.
+		"""
+		Acquisition mode: "sequential" (scan, then process), "pipelined" (next scan is acquired while the last one
+		is processed) or "continuous" (the scan runs all the time and full scans are delivered to a queue).
+		"""
+		self.acquisition_mode="sequential"
+		self._acquiring=False
+
+		#Triangle scan: half of the period in PD_data (1 rising, -1 falling) and in the scan being acquired.
+		self.scan_direction=1
+		self._acq_direction=1
+
+		"""
+		Part of the scan at its beginning (where the piezo rings after the reset) during which the photodiodes are not
+		sampled at all. It's used only with the ramp waveform and in the sequential and pipelined modes.
+		"""
+		self.settle_fraction=0
+
+		#If True, the laser voltages are written together with the scan, as one buffer (see combine_outputs).
+		self.combined_output=False
+
+		#Model of the cavity transmission used to simulate the data (see Simulation.py).
+		self.sim_model=CavityModel()
+		self._sim_data=[]
+
+		"""
+		Recording of raw scans (see Recording.py). Scan offset and laser voltages that were written for the scan being
+		acquired are kept, and handed over with its data when it's finished (in the pipelined and continuous modes the
+		next scan is already started by then), so they can be recorded with it.
+		"""
+		self.recorder=None
+		self._applied=(0,[])
+		self._scan_applied=(0,[])
+
+		"""
+		Full scans delivered in the continuous mode (only the newest few are kept). Every scan has its own array,
+		taken from the free ones by the callback and given back once a newer scan is processed, so an array is never
+		overwritten while it's waiting or being processed. After "continuous_retries" timeouts in a row the
+		continuous mode is restarted.
+		"""
+		self._scans=queue.Queue(maxsize=4)
+		self._free=queue.Queue()
+		self._processed=None
+		self._dropped=None
+		self._continuous=False
+		self.continuous_retries=3
+
+		"""
+		Writes in the continuous mode land while a scan is running, so that scan can be torn (see _write_continuous).
+		Every write raises the write generation (before and after writing) and the callback drops "torn_scans" scans
+		from the one during which it changed. Laser voltages that were last written are kept, so they're written only
+		when they change.
+		"""
+		self.torn_scans=1
+		self._write_gen=0
+		self._scan_gen=0
+		self._torn_left=0
+		self._written_volts=[]
+
+		#The callback gets the halves of the triangle scan in turn, starting with the rising one.
+		self._next_direction=1
+
+
+	#To avoid error when the program is being closed, the tasks are closed first (and the recorded scans are written).
 	def __del__(self):
+		self.stop_recording()
 		self._clear_tasks()
 
 
@@ -66,16 +138,16 @@ class DAQ_tasks:
 	def reset_tasks(self,cfg,n):
 		self._clear_tasks()
 
-		self.ao_scan.dq_task=dq.Task(new_task_name="Scan")
+		self.ao_scan.dq_task=self.backend.task("Scan")
 		self.ao_scan.dq_task.ao_channels.add_ao_voltage_chan(self.device.name+"/ao"+cfg['CAVITY']['OutputChannel'])
 
-		self.ao_laser.dq_task=dq.Task(new_task_name="Lasers")
+		self.ao_laser.dq_task=self.backend.task("Lasers")
 		self.ao_laser._channel_no=0
 
-		self.power_PDs.dq_task=dq.Task(new_task_name="Power")
+		self.power_PDs.dq_task=self.backend.task("Power")
 		self.power_PDs._channel_no=0
 
-		self.ai_PDs.dq_task=dq.Task(new_task_name="PDs")
+		self.ai_PDs.dq_task=self.backend.task("PDs")
 		self.ai_PDs.dq_task.ai_channels.add_ai_voltage_chan(self.device.name+"/ai"+cfg['CAVITY']['InputChannel'])
 		self.ai_PDs._channel_no=1
 
@@ -83,6 +155,8 @@ class DAQ_tasks:
 		if n>1:
 			self.add_laser(int(cfg['LASER2']['InputChannel']),int(cfg['LASER2']['OutputChannel']),int(cfg['LASER2']['PowerChannel']))
 
+		self._recreate_combined_output()
+
 		#Timing (synchronisation) has to be set every time we recreate a task.
 		self.set_input_timing()
 
@@ -91,21 +165,23 @@ class DAQ_tasks:
 	def update_tasks(self,ao_channels,ai_channels,power_channels):
 		self._clear_tasks()
 
-		self.ao_scan.dq_task=dq.Task(new_task_name="Scan")
+		self.ao_scan.dq_task=self.backend.task("Scan")
 		self.ao_scan.dq_task.ao_channels.add_ao_voltage_chan(ao_channels[0])
 
-		self.ao_laser.dq_task=dq.Task(new_task_name="Lasers")
+		self.ao_laser.dq_task=self.backend.task("Lasers")
 		for ch in ao_channels[1:]:
 			self.ao_laser.dq_task.ao_channels.add_ao_voltage_chan(ch)
 
-		self.ai_PDs.dq_task=dq.Task(new_task_name="PDs")
+		self.ai_PDs.dq_task=self.backend.task("PDs")
 		for ch in ai_channels:
 			self.ai_PDs.dq_task.ai_channels.add_ai_voltage_chan(ch)
 
-		self.power_PDs.dq_task=dq.Task(new_task_name="Power")
+		self.power_PDs.dq_task=self.backend.task("Power")
 		for ch in power_channels:
 			self.power_PDs.dq_task.ai_channels.add_ai_voltage_chan(ch)
 
+		self._recreate_combined_output()
+
 		try:
 			self.set_input_timing()
 		except:
@@ -138,12 +214,45 @@ class DAQ_tasks:
 		return self.ai_PDs.dq_task.channel_names
 
 	def get_all_used_ao_channels(self):
-		return self.ao_scan.dq_task.channel_names+self.ao_laser.dq_task.channel_names
+		return self.ao_scan.dq_task.channel_names[:1]+self.ao_laser.dq_task.channel_names
+
+
+	"""
+	Combined output. The output channels of the lasers are added to the scan task, so the scan and the laser voltages
+	are written as one multi-channel buffer on the same sample clock: one write per scan updates everything and new
+	laser voltages are applied exactly when the scan starts. The lasers' task is then only used to keep their voltages
+	and limits, and it's never started (so it doesn't reserve the channels).
+	"""
+	def combine_outputs(self):
+
+		self.combined_output=True
+		self.ao_scan.add_output_channels(self.ao_laser.dq_task.channel_names)
+		self.ao_scan.configure_scan_sampling(self.ao_scan.scan_time)
+
+
+	#After the scan task was recreated, the laser channels have to be added to it again (and the sample clock set).
+	def _recreate_combined_output(self):
+
+		self.ao_scan.levels=np.zeros(0)
+		if self.combined_output:
+			self.combine_outputs()
+		else:
+			self.ao_scan._update_points()
+			self.ao_scan.configure_scan_sampling(self.ao_scan.scan_time)
+
+
+	#Writes the laser voltages: directly, or as a part of the scan buffer (written with the scan) in the combined mode.
+	def _write_laser_volts(self):
+
+		if self.combined_output:
+			self.ao_scan.set_levels(self.ao_laser.voltages)
+		else:
+			self.ao_laser.set_voltages(True)
 
 
 	#Creating an object of Scan class and adding reference to an attribute of this class.
 	def set_scan_task(self,name,channel=0):
-		self.ao_scan=Scan(self.device,name,channel)
+		self.ao_scan=Scan(self.device,name,channel,self.backend)
 
 
 	"""
@@ -165,7 +274,7 @@ class DAQ_tasks:
 		self.ao_scan.configure_scan_sampling(scan_t)
 
 		#Finally, because we are plotting acquired data as a function of time, we create the X-axis for the plot.
-		self.time_samples=np.linspace(0,scan_t,num=n_samp)
+		self.time_samples=np.linspace(0,scan_t,num=n_samp)[self.settle_samples():]
 
 
 	"""
@@ -175,13 +284,12 @@ class DAQ_tasks:
 	def modify_scanning(self,offset,amp,n_samp,scan_t):
 		self.ao_scan.configure_scan_voltages(offset,amp,n_samp)
 		self.ao_scan.configure_scan_sampling(scan_t)
-		self.time_samples=np.linspace(0,scan_t,num=n_samp)
 		self.set_input_timing()
 
 
 	#Creates an instance of L_task class
 	def set_laser_task(self,name):
-		self.ao_laser=L_task(self.device,name)
+		self.ao_laser=L_task(self.device,name,self.backend)
 
 
 	#Method setting voltages of the lasers (so it sets their frequencies)
@@ -196,12 +304,12 @@ class DAQ_tasks:
 
 	#Creating an object of PD_task class. It automatically sets up a task for master laser photodetection.
 	def set_PD_task(self,name,scan_channel=0):
-		self.ai_PDs=PD_task(self.device,name,scan_channel)
+		self.ai_PDs=PD_task(self.device,name,scan_channel,self.backend)
 
 
 	#Creating an object of power_PD_task class.
 	def set_power_task(self,name):
-		self.power_PDs=Power_PD_task(self.device,name)
+		self.power_PDs=Power_PD_task(self.device,name,self.backend)
 
 
 	#Method adding a laser. It adds channels to L_task tasks and to PD_task tasks.
@@ -216,19 +324,348 @@ class DAQ_tasks:
 	same points when scan is performed.
 	"""
 	def set_input_timing(self):
-		self.ai_PDs.configure_clock(self.ao_scan.sample_rate,self.ao_scan.n_samples)
+
+		skip=self.settle_samples()
+		self.ai_PDs.configure_clock(self.ao_scan.sample_rate,self.ao_scan.scan_samples(),skip)
+
+		#Only the acquired samples have their X values (in the triangle mode the scan is the first half of the period).
+		self.time_samples=np.linspace(0,self.ao_scan.scan_time,num=self.ao_scan.n_samples)[skip:self.ao_scan.scan_samples()]
+
+
+	#Number of samples at the beginning of the scan that are not acquired (see settle_fraction).
+	def settle_samples(self):
+
+		if self.ao_scan.waveform!="ramp" or self.acquisition_mode=="continuous":
+			return 0
+
+		return int(self.settle_fraction*self.ao_scan.n_samples)
+
+
+	"""
+	Part of the acquired data at its beginning that is ignored when looking for peaks. Usually it's the first 25% of
+	the scan, but the samples that were not acquired at all (settle_samples) are already a part of it.
+	"""
+	def discard_fraction(self):
+
+		n=self.ao_scan.scan_samples()
+		skip=self.settle_samples()
+
+		return max(0.25*n-skip,0)/(n-skip)
+
+
+	#Acquires the next scan in the chosen acquisition mode (see below). The scan is recorded if recording is on.
+	def acquire(self,evnt):
+
+		if self.acquisition_mode=="pipelined":
+			self.pipelined_acquire(evnt)
+		elif self.acquisition_mode=="continuous":
+			self.continuous_acquire(evnt)
+		else:
+			self.scan_and_acquire(evnt)
+
+		#The recording can be stopped by another thread meanwhile, so the recorder is taken only once.
+		recorder=self.recorder
+		if recorder is not None:
+			recorder.record(self.PD_data,*self._scan_applied)
+
+
+	"""
+	Starts recording of the acquired scans (data from photodetectors, time, scan offset and laser voltages) into an
+	HDF5 file. Scan settings are saved as attributes of the file. Recording continues until stop_recording is called.
+	An existing file is not overwritten: the current time is added to the name instead (see recorder.filename).
+	"""
+	def start_recording(self,filename,chunk=64,compression=None):
+
+		self.stop_recording()
+
+		recorded=unused_filename(filename)
+		if recorded!=filename:
+			log.warning('{} exists, the scans are recorded into {}'.format(filename,recorded))
+
+		attrs={"ScanTime":self.ao_scan.scan_time,"ScanSamples":self.ao_scan.n_samples,"Waveform":self.ao_scan.waveform,"SettleSamples":self.settle_samples(),"AcquisitionMode":self.acquisition_mode,"Channels":self.get_all_used_ai_channels()}
+
+		self.recorder=ScanRecorder(recorded,self.ai_PDs._channel_no,len(self.time_samples),self.ao_laser._channel_no,attrs,chunk,compression)
+
+
+	#Writes the rest of the recorded scans and closes the file.
+	def stop_recording(self):
+
+		recorder,self.recorder=self.recorder,None
+		if recorder is not None:
+			recorder.close()
+
+
+	#Keeps the scan offset and laser voltages that are written for the next scan (they're recorded with its data).
+	def _keep_applied(self):
+		self._applied=(self.ao_scan.offset,list(self.ao_laser.voltages))
+
+
+	#Scan offset that was written for the scan in PD_data.
+	def applied_offset(self):
+		return self._scan_applied[0]
 
 
 	#Method that manages scanning and acquiring data from the DAQ.
 	def scan_and_acquire(self,evnt):
 
+		self.start_acquisition()
+		self.finish_acquisition()
+
+		#Flag is set
+		evnt.set()
+
+
+	"""
+	Pipelined version of the method above. It finishes the scan that is in progress and immediately starts the next
+	one, so the DAQ is scanning the cavity while the data of the finished scan is processed (filtering, peak finding,
+	locking, plotting). The scan offset and laser voltages changed during processing are written when the next scan
+	is started, so the feedback is applied at the next ramp boundary (one scan later than in the sequential mode; the
+	gains are scaled down for it, see DelayedGainScale in TransferLock). If no scan is in progress (the first call),
+	one is started and finished first.
+	"""
+	def pipelined_acquire(self,evnt):
+
+		if not self._acquiring:
+			self.start_acquisition()
+
+		self.finish_acquisition()
+		self.start_acquisition()
+
+		#Flag is set
+		evnt.set()
+
+
+	"""
+	Continuous mode. The scan is written once and regenerated by the DAQ on its sample clock, and the readout runs
+	all the time on the same clock, so the tasks are started and stopped only once instead of for every scan. Every
+	time a full scan (n_samples per channel, or one half of the triangle) is acquired, the DAQ calls "_scan_acquired",
+	which reads it and puts it in a queue. This method takes the newest scan from the queue (older ones are dropped,
+	so the feedback is always based on the latest data), or waits for the next one.
+
+	The feedback is written while the DAQ is scanning (see _write_continuous), so the scan that's running at the
+	time can be torn. Torn scans are dropped here, so only scans acquired entirely after the feedback was written
+	are processed.
+	"""
+	def continuous_acquire(self,evnt):
+
+		if not self._continuous:
+			self.start_continuous()
+		else:
+			self._write_continuous()
+
+		data=self._newest_scan()
+		while data[2]:
+			self._free.put(data[0])
+			data=self._newest_scan()
+
+		#The array of the previous scan can be used again.
+		if self._processed is not None:
+			self._free.put(self._processed)
+		self._processed=data[0]
+
+		self.PD_data,self._scan_applied=data[:2]
+		self.scan_direction=data[3]
+
+		self.get_power()
+
+		if self.simulation:
+			self.PD_data=self.simulate_scan(self.scan_direction)
+
+		#Flag is set
+		evnt.set()
+
+
+	"""
+	Feedback in the continuous mode. Laser voltages are written directly (their task is not clocked, or they're part
+	of the scan with the combined output) and the new scan points are written over the regenerated buffer. The offset
+	moves the whole ramp, so all the points change and the whole buffer is written. These writes are not aligned with
+	the scan: the buffer can be rewritten in the middle of the ramp, so the scan running at the time is half the old
+	ramp and half the new one (and similarly for the laser voltages). Samples already moved to the onboard FIFO of the
+	device are still output as they were, so with short scans the change can reach the next scan too (raise
+	"torn_scans" then). Nothing is written if nothing changed.
+	"""
+	def _write_continuous(self):
+
+		if self.combined_output:
+			self.ao_scan.set_levels(self.ao_laser.voltages)
+			lasers=False
+		else:
+			lasers=list(self.ao_laser.voltages)!=self._written_volts
+
+		scan=self.ao_scan.changed_samples()>0
+
+		if not (lasers or scan):
+			return
+
+		self._write_gen+=1
+
+		if lasers:
+			self.ao_laser.set_voltages(True)
+			self._written_volts=list(self.ao_laser.voltages)
+		if scan:
+			self._write_scan()
+		self._keep_applied()
+
+		self._write_gen+=1
+
+
+	#Newest scan in the queue (older ones are given back to the free arrays), waiting for one if there's none.
+	def _newest_scan(self):
+
+		data=self._next_scan()
+		while True:
+			try:
+				newer=self._scans.get_nowait()
+			except queue.Empty:
+				return data
+			self._free.put(data[0])
+			data=newer
+
+
+	"""
+	Waits for the next scan in the continuous mode. If no scan comes in time (e.g. the callback is late), it's
+	reported and the waiting goes on. After "continuous_retries" timeouts in a row, the continuous mode is restarted.
+	"""
+	def _next_scan(self):
+
+		timeout=max(1,10*self.ao_scan.scan_time/1000)
+		timeouts=0
+
+		while True:
+			try:
+				return self._scans.get(timeout=timeout)
+			except queue.Empty:
+				timeouts+=1
+				log.warning('No scan acquired in {} s in the continuous mode ({} times in a row)'.format(timeout,timeouts))
+
+			if timeouts>=self.continuous_retries:
+				self.stop_continuous()
+				self.start_continuous()
+				timeouts=0
+
+
+	#Configures both tasks for the continuous mode and starts them.
+	def start_continuous(self):
+
+		self.ao_scan.configure_continuous()
+		self.ai_PDs.configure_continuous(self.ao_scan.sample_rate,self.ao_scan.scan_samples(),self._scan_acquired)
+
+		#Scans in the queue, the one being processed and the one being read need their own arrays.
+		self._scans=queue.Queue(maxsize=4)
+		self._free=queue.Queue()
+		shape=(self.ai_PDs.dq_task.number_of_channels,self.ao_scan.scan_samples())
+		for i in range(self._scans.maxsize+2):
+			self._free.put(np.zeros(shape))
+		self._processed=None
+		self._dropped=np.zeros(shape)
+
+		self._write_laser_volts()
+		self._write_scan()
+		self._keep_applied()
+		self._written_volts=list(self.ao_laser.voltages)
+		self._scan_gen=self._write_gen
+		self._torn_left=0
+		self._next_direction=1
+
+		#The readout waits for the sample clock, so it has to be started first.
+		self.ai_PDs.start()
+		self.ao_scan.start()
+
+		self._continuous=True
+
+
+	#Stops the continuous mode and restores the timing used for single scans.
+	def stop_continuous(self):
+
+		self.ao_scan.dq_task.stop()
+		self.ai_PDs.dq_task.stop()
+
+		self.ai_PDs.configure_continuous(self.ao_scan.sample_rate,self.ao_scan.scan_samples(),None)
+		self.ao_scan.configure_scan_sampling(self.ao_scan.scan_time)
+		self.set_input_timing()
+
+		self._continuous=False
+
+
+	"""
+	Callback run by nidaqmx (in its own thread) every time a full scan is acquired in the continuous mode. The scan is
+	read into a free array; if there's none at the moment, it's read and dropped. If anything was written since the
+	last scan, this scan (and "torn_scans"-1 after it) is marked as torn, so it's not used for locking. In the
+	triangle mode the scans are the halves of the regenerated period, so their direction alternates.
+	"""
+	def _scan_acquired(self,task_handle,event_type,number_of_samples,callback_data):
+
+		direction=self._next_direction
+		if self.ao_scan.waveform=="triangle":
+			self._next_direction=-direction
+
+		gen=self._write_gen
+		if gen!=self._scan_gen:
+			self._scan_gen=gen
+			self._torn_left=self.torn_scans
+
+		torn=self._torn_left>0
+		if torn:
+			self._torn_left-=1
+
+		try:
+			data=self._free.get_nowait()
+		except queue.Empty:
+			self.ai_PDs.acquire_data(self._dropped)
+			return 0
+
+		self.ai_PDs.acquire_data(data)
+
+		#If the processing can't keep up, the oldest scan is dropped (and its array is free again).
+		if self._scans.full():
+			try:
+				self._free.put_nowait(self._scans.get_nowait()[0])
+			except queue.Empty:
+				pass
+		self._scans.put_nowait((data,self._applied,torn,direction))
+
+		return 0
+
+
+	#Writes the scan points to the regenerated buffer (from its first sample).
+	def _write_scan(self):
+		self.ao_scan.write_scan_points()
+
+
+	#Finishes the scan that may be still in progress (pipelined and continuous modes) and discards its data.
+	def stop_acquisition(self):
+
+		if self._continuous:
+			self.stop_continuous()
+
+		if self._acquiring:
+			data=self.PD_data,self._scan_applied,self.scan_direction
+			self.finish_acquisition()
+			self.PD_data,self._scan_applied,self.scan_direction=data
+
+
+	#Starts the scan: the laser voltages and the scan are written, the readout is started by the DAQ clock.
+	def start_acquisition(self):
+
 		#The task for collecting data is started, but the data is not collected yet.
 		self.ai_PDs.start()
 
 		#Voltages for the lasers are set and the scan is performed. Both tasks start and are performed automatically.
-		self.ao_laser.set_voltages(True)
+		self._keep_applied()
+		self._write_laser_volts()
+		self._acq_direction=self.ao_scan.direction
 		self.ao_scan.perform_scan(True)
 
+		#Simulated data has to use the voltages that were written for this scan.
+		if self.simulation:
+			self._sim_data=self.simulate_scan(self._acq_direction)
+
+		self._acquiring=True
+
+
+	#Waits for the scan to finish and fetches the data.
+	def finish_acquisition(self):
+
 		#Data from photodetectors is acquired (it was stored in buffers when scan was being performed, now it's fetched)
 		self.ai_PDs.acquire_data()
 
@@ -239,6 +676,8 @@ class DAQ_tasks:
 
 		#We add reference to the DAQ_task object
 		self.PD_data=self.ai_PDs.acq_data
+		self._scan_applied=self._applied
+		self.scan_direction=self._acq_direction
 
 		#We stop the tasks.
 		self.ao_scan.dq_task.stop()
@@ -247,10 +686,9 @@ class DAQ_tasks:
 		self.get_power()
 
 		if self.simulation:
-			self.PD_data=self.simulate_scan()
+			self.PD_data=self._sim_data
 
-		#Flag is set
-		evnt.set()
+		self._acquiring=False
 
 
 	def get_power(self):
@@ -260,30 +698,32 @@ class DAQ_tasks:
 		self.power_PDs.stop()
 
 
-	def simulate_scan(self):
-		peak_m1=(self.ao_scan.mx_voltage/10-self.ao_scan.offset)+self.ao_scan.scan_time/8
-		peak_m2=peak_m1+self.ao_scan.scan_time*0.5
+	"""
+	Simulated data, an array (channels x samples). In the triangle mode the half of the scan given by "direction" is
+	simulated as a single ramp (taking half of the scan time), the falling one with the hysteresis of the piezo (see
+	CavityModel) and reversed.
+	"""
+	def simulate_scan(self,direction=1):
 
-		peak_s1=self.ao_laser.voltages[0]/5*self.ao_scan.scan_time
-		peak_s12p=peak_s1+(peak_m2-peak_m1)*1000/784.5
-		peak_s12m=peak_s1-(peak_m2-peak_m1)*1000/784.5
+		if self.ao_scan.waveform=="triangle":
+			h=self.ao_scan.scan_samples()
+			if direction>0:
+				return self._simulate_ramp(h,self.ao_scan.scan_time/2)
+			return self._simulate_ramp(h,self.ao_scan.scan_time/2,falling=True)[:,::-1]
 
-		M=generate_data([0.01,0.01],[peak_m1,peak_m2],[2/self.ao_scan.n_samples*self.ao_scan.scan_time,2/self.ao_scan.n_samples*self.ao_scan.scan_time],self.ao_scan.n_samples,0,self.ao_scan.scan_time)
-		M=add_noise(M,0.002)
+		#Samples that would not be acquired are removed.
+		return self._simulate_ramp(self.ao_scan.n_samples,self.ao_scan.scan_time)[:,self.settle_samples():]
 
-		S1=generate_data([0.002,0.002,0.002],[peak_s1,peak_s12p,peak_s12m],[1/self.ao_scan.n_samples*self.ao_scan.scan_time,1/self.ao_scan.n_samples*self.ao_scan.scan_time,1/self.ao_scan.n_samples*self.ao_scan.scan_time],self.ao_scan.n_samples,0,self.ao_scan.scan_time)
-		S1=add_noise(S1,0.001)
 
-		if self.ao_laser._channel_no>1:
-			peak_s2=self.ao_laser.voltages[1]/5*self.ao_scan.scan_time
-			peak_s22p=peak_s2+(peak_m2-peak_m1)*1000/784.5
-			peak_s22m=peak_s2-(peak_m2-peak_m1)*1000/784.5
-			S2=generate_data([0.002,0.002,0.002],[peak_s2,peak_s22p,peak_s22m],[1/self.ao_scan.n_samples*self.ao_scan.scan_time,1/self.ao_scan.n_samples*self.ao_scan.scan_time,1/self.ao_scan.n_samples*self.ao_scan.scan_time],self.ao_scan.n_samples,0,self.ao_scan.scan_time)
-			S2=add_noise(S2,0.0015)
+	#Master peaks follow the scan offset, slave lasers' peaks (with their sidebands) follow the lasers' voltages.
+	def _simulate_ramp(self,n_samples,scan_time,falling=False):
 
-			return [M,S1,S2]
-		else:
-			return [M,S1]
+		peak_m1=(self.ao_scan.mx_voltage/10-self.ao_scan.offset)+scan_time/8
+		peak_m2=peak_m1+scan_time*0.5
+
+		peaks_s=[self.ao_laser.voltages[i]/5*scan_time for i in range(self.ao_laser._channel_no)]
+
+		return self.sim_model.scan(n_samples,scan_time,(peak_m1,peak_m2),peaks_s,(peak_m2-peak_m1)*1000/784.5,falling)
 
 
 
@@ -298,8 +738,9 @@ number of samples per scan and scanning time).
 class Scan:
 
 	#We initialize by creating a DAQ Task and add an analog output channel used for the scan (channel number is in config file)
-	def __init__(self,dev,name,channel):
-		self.dq_task=dq.Task(new_task_name=name)
+	def __init__(self,dev,name,channel,backend):
+		self.backend=backend
+		self.dq_task=backend.task(name)
 		self.dq_task.ao_channels.add_ao_voltage_chan(dev.name+"/ao"+str(channel))
 		self.n_samples=0
 		self.scan_time=0
@@ -312,6 +753,26 @@ class Scan:
 		self.scan_end=0
 		self.amplitude=0
 
+		"""
+		"ramp" (sawtooth, only the rising part is used) or "triangle" (rising and falling half, both are used). In the
+		triangle mode every scan is one half of the period, and "direction" is the half written by the next scan (1
+		rising, -1 falling).
+		"""
+		self.waveform="ramp"
+		self.direction=1
+
+		#Ramp from 0 to amplitude (cached for given amplitude, number of samples and waveform) and the last written points
+		self._ramp=np.zeros(0)
+		self._ramp_key=None
+		self._written=np.zeros(0)
+
+		"""
+		Voltages of other output channels that are written together with the scan, as constant rows of one buffer
+		(combined output, see DAQ_tasks.combine_outputs). The scan points are the first row of that buffer.
+		"""
+		self.levels=np.zeros(0)
+		self._output=np.zeros((1,0))
+
 
 	#Starting the task. Used if autostart is not used.
 	def start(self):
@@ -346,7 +807,7 @@ class Scan:
 		self.scan_end=offset+self.amplitude
 
 		#These are the points that will be writting to the DAQ (and then to cavity's piezo)
-		self.scan_points=np.linspace(self.offset,self.scan_end,num=self.n_samples)
+		self._update_points()
 
 		self.scan_step=self.scan_points[1]-self.scan_points[0]
 
@@ -358,16 +819,84 @@ class Scan:
 		self.sample_rate=1000*self.n_samples/scan_time #S/s
 
 		#The clock is configured using sample rate.
-		self.dq_task.timing.cfg_samp_clk_timing(self.sample_rate,samps_per_chan=self.n_samples)
+		self.dq_task.timing.cfg_samp_clk_timing(self.sample_rate,samps_per_chan=self.scan_samples())
 
 		#We also need to adjust size of the buffer and set it to the number of samples that are supposed to be written.
-		self.dq_task.out_stream.output_buf_size=self.n_samples
+		self.dq_task.out_stream.output_buf_size=self.scan_samples()
+
 
+	#Number of samples of one scan: the whole ramp, or one half of the triangle (both halves have n_samples//2 samples).
+	def scan_samples(self):
+		return self.n_samples//2 if self.waveform=="triangle" else self.n_samples
 
-	#Method performing writing data to DAQ.
+
+	#Method performing writing data to DAQ. In the triangle mode it writes one half, and the next scan the other one.
 	def perform_scan(self,autostart_flag):
 
-		self.dq_task.write(self.scan_points,auto_start=autostart_flag)
+		self.dq_task.write(self._scan_data(),auto_start=autostart_flag)
+		np.copyto(self._written,self._output)
+
+		if self.waveform=="triangle":
+			self.direction=-self.direction
+
+
+	"""
+	In the continuous mode the scan is regenerated: the buffer (the whole period, so both halves of the triangle) is
+	written once and the DAQ outputs it again and again, on the same sample clock, until the task is stopped.
+	"""
+	def configure_continuous(self):
+
+		period=self._output.shape[1]
+		self.dq_task.timing.cfg_samp_clk_timing(self.sample_rate,sample_mode=self.backend.AcquisitionType.CONTINUOUS,samps_per_chan=period)
+		self.dq_task.out_stream.output_buf_size=period
+		self.dq_task.out_stream.regen_mode=self.backend.RegenerationMode.ALLOW_REGENERATION
+		self.dq_task.out_stream.relative_to=self.backend.WriteRelativeTo.FIRST_SAMPLE
+		self.dq_task.out_stream.offset=0
+
+
+	#Writes the scan points over the regenerated buffer (also while the task is running).
+	def write_scan_points(self):
+
+		self.dq_task.write(self._data(),auto_start=False)
+		np.copyto(self._written,self._output)
+
+
+	#Number of samples (of all written channels) that changed since they were last written to the DAQ.
+	def changed_samples(self):
+		return int(np.count_nonzero(self._output!=self._written))
+
+
+	#Adds output channels (given by their names) that are written together with the scan (combined output).
+	def add_output_channels(self,channels):
+
+		for ch in channels:
+			self.dq_task.ao_channels.add_ao_voltage_chan(ch)
+
+		self.levels=np.concatenate((self.levels,np.zeros(len(channels))))
+		self._update_points()
+
+
+	#Sets voltages of the channels added above. They are written with the next scan.
+	def set_levels(self,voltages):
+
+		self.levels[:]=voltages
+		self._output[1:]=self.levels[:,None]
+
+
+	#Data written to the DAQ: only the scan points, or the whole buffer if other channels are written with them.
+	def _data(self):
+		return self._output if len(self.levels)>0 else self.scan_points
+
+
+	#Data of one scan: all of the above, or the half of the triangle given by "direction".
+	def _scan_data(self):
+
+		data=self._data()
+		if self.waveform!="triangle":
+			return data
+
+		h=self.scan_samples()
+		return np.ascontiguousarray(data[...,:h] if self.direction>0 else data[...,h:])
 
 
 	#Setting scanning offset. It has to modify all the scanning points.
@@ -382,7 +911,26 @@ class Scan:
 
 		self.scan_end=offset+self.amplitude
 
-		self.scan_points=np.linspace(self.offset,self.scan_end,num=self.n_samples)
+		self._update_points()
+
+
+	"""
+	Setting the waveform. In the "triangle" mode the first half of the samples goes up from the offset to the end of
+	the scan and the second half goes back down, so the cavity is scanned twice per period. Each half is a scan of
+	its own (n_samples//2 samples, half of the scan time), so the feedback is written between the halves. The clock
+	is configured again for the new number of samples per scan.
+	"""
+	def set_waveform(self,waveform):
+
+		if waveform not in ("ramp","triangle"):
+			raise ValueError('Unknown scan waveform.')
+
+		self.waveform=waveform
+		self.direction=1
+		self._update_points()
+
+		if self.scan_time>0:
+			self.configure_scan_sampling(self.scan_time)
 
 
 	#Moving scanning offset. It has to move all the scanning points.
@@ -396,7 +944,31 @@ class Scan:
 
 		self.scan_end=self.offset+self.amplitude
 
-		self.scan_points=np.linspace(self.offset,self.scan_end,num=self.n_samples)
+		self._update_points()
+
+
+	"""
+	The scan points are the ramp (from 0 to amplitude, computed only when the amplitude or the number of samples
+	changes) moved by the offset. They are kept in one array that is updated in place (and clipped to the voltage
+	boundaries), so moving the offset on every locked scan doesn't create new arrays. The array is the first row of
+	the buffer written to the DAQ (other rows are the voltages of the combined output channels).
+	"""
+	def _update_points(self):
+
+		if self._ramp_key!=(self.amplitude,self.n_samples,self.waveform,len(self.levels)):
+			self._ramp_key=(self.amplitude,self.n_samples,self.waveform,len(self.levels))
+			if self.waveform=="triangle":
+				h=self.n_samples//2
+				self._ramp=np.concatenate((np.linspace(0,self.amplitude,num=h),np.linspace(self.amplitude,0,num=h)))
+			else:
+				self._ramp=np.linspace(0,self.amplitude,num=self.n_samples)
+			self._output=np.empty((1+len(self.levels),len(self._ramp)))
+			self._output[1:]=self.levels[:,None]
+			self.scan_points=self._output[0]
+			self._written=np.full(self._output.shape,np.nan)
+
+		np.add(self._ramp,self.offset,out=self.scan_points)
+		np.clip(self.scan_points,self.mn_voltage,self.mx_voltage,out=self.scan_points)
 
 
 #################################################################################################################
@@ -408,8 +980,8 @@ but doesn't add any channels.
 """
 class L_task:
 
-	def __init__(self,dev,name):
-		self.dq_task=dq.Task(new_task_name=name)
+	def __init__(self,dev,name,backend):
+		self.dq_task=backend.task(name)
 		self.device=dev
 		self.voltages=[]
 		self.mn_voltages=[]
@@ -469,8 +1041,9 @@ and by adding the first channel for the master (cavity reference) laser.
 """
 class PD_task:
 
-	def __init__(self,dev,name,scan_channel):
-		self.dq_task=dq.Task(new_task_name=name)
+	def __init__(self,dev,name,scan_channel,backend):
+		self.backend=backend
+		self.dq_task=backend.task(name)
 		self.device=dev
 		self.dq_task.ai_channels.add_ai_voltage_chan(dev.name+"/ai"+str(scan_channel))
 		self.acq_data=[]
@@ -479,6 +1052,16 @@ class PD_task:
 		#Eventually equal to master laser + number of slave lasers.
 		self._channel_no=1
 
+		"""
+		The data is read into preallocated arrays (channels x n_samples) that are reused. Scans are read into them in
+		turn, so the data of the last few scans stays untouched while it's being processed or plotted (in the
+		continuous mode DAQ_tasks gives its own arrays instead, see _scan_acquired).
+		"""
+		self.pool_size=2
+		self._buffers=[]
+		self._next=0
+		self._reader=(None,None)
+
 
 	#Starting the task. Reading data is usually not started automatically.
 	def start(self):
@@ -495,18 +1078,57 @@ class PD_task:
 	For that we're basically saying that clock for this task is to be the same as for the write task. It also automatically
 	adopts the buffer size from the write task.
 	"""
-	def configure_clock(self,sample_rate,n_samples):
+	def configure_clock(self,sample_rate,n_samples,skip=0):
 		try:
-			self.dq_task.timing.cfg_samp_clk_timing(sample_rate,source='/'+self.device.name+'/ao/SampleClock',samps_per_chan=n_samples)
-			self.n_samples=n_samples
+			self.dq_task.timing.cfg_samp_clk_timing(sample_rate,source='/'+self.device.name+'/ao/SampleClock',samps_per_chan=n_samples-skip)
+			self.n_samples=n_samples-skip
+
+			#The first "skip" samples of the scan are not acquired: reading starts "skip" clock periods after the scan starts.
+			if skip>0:
+				self.dq_task.triggers.start_trigger.cfg_dig_edge_start_trig('/'+self.device.name+'/ao/StartTrigger')
+				self.dq_task.triggers.start_trigger.delay_units=self.backend.DigitalWidthUnits.SAMPLE_CLOCK_PERIODS
+				self.dq_task.triggers.start_trigger.delay=skip
+			else:
+				self.dq_task.triggers.start_trigger.disable_start_trig()
 
 		except NameError:
 			pass
 
 
-	#Method that actually acquires the data. The resulting array is (_channel_no x n_samples) (so n_samples per photodetctor).
-	def acquire_data(self):
-		self.acq_data=self.dq_task.read(number_of_samples_per_channel=self.n_samples)
+	"""
+	Clock for the continuous mode: the readout runs all the time (with a buffer for a few scans) and "callback" is
+	called every n_samples, so once per scan. With callback=None the callback is removed.
+	"""
+	def configure_continuous(self,sample_rate,n_samples,callback):
+
+		if callback is None:
+			self.dq_task.register_every_n_samples_acquired_into_buffer_event(n_samples,None)
+			return
+
+		self.dq_task.timing.cfg_samp_clk_timing(sample_rate,source='/'+self.device.name+'/ao/SampleClock',sample_mode=self.backend.AcquisitionType.CONTINUOUS,samps_per_chan=10*n_samples)
+		self.dq_task.register_every_n_samples_acquired_into_buffer_event(n_samples,callback)
+		self.n_samples=n_samples
+
+
+	"""
+	Method that actually acquires the data. The resulting array is (_channel_no x n_samples) (so n_samples per
+	photodetctor). It's read into the given array, or into the next array of the pool.
+	"""
+	def acquire_data(self,data=None):
+
+		self._reader=_stream_reader(self.backend,self.dq_task,self._reader)
+
+		if data is None:
+			channels=self.dq_task.number_of_channels
+
+			if len(self._buffers)!=self.pool_size or self._buffers[0].shape!=(channels,self.n_samples):
+				self._buffers=[np.zeros((channels,self.n_samples)) for i in range(self.pool_size)]
+
+			self._next=(self._next+1)%self.pool_size
+			data=self._buffers[self._next]
+
+		self._reader[1].read_many_sample(data,number_of_samples_per_channel=self.n_samples)
+		self.acq_data=data
 
 
 
@@ -520,12 +1142,14 @@ It initializes by creating a DAQ Task and by adding channel for the first scienc
 """
 class Power_PD_task:
 
-	def __init__(self,dev,name):
-		self.dq_task=dq.Task(new_task_name=name)
+	def __init__(self,dev,name,backend):
+		self.backend=backend
+		self.dq_task=backend.task(name)
 		self.device=dev
-		self.acq_data=[]
+		self.acq_data=np.zeros((0,10))
 		self.power=[]
 		self.n_samples=10
+		self._reader=(None,None)
 
 		#Eventually equal to number of slave lasers.
 		self._channel_no=0
@@ -550,16 +1174,21 @@ class Power_PD_task:
 
 	#Method that actually acquires the data. The resulting array is (_channel_no x n_samples) (so n_samples per photodetctor).
 	def acquire_data(self,sim):
-		if self._channel_no>1:
-			self.acq_data=self.dq_task.read(number_of_samples_per_channel=self.n_samples)
-		else:
-			self.acq_data=[self.dq_task.read(number_of_samples_per_channel=self.n_samples)]
+
+		self._reader=_stream_reader(self.backend,self.dq_task,self._reader)
+		channels=self.dq_task.number_of_channels
+
+		if self.acq_data.shape!=(channels,self.n_samples):
+			self.acq_data=np.zeros((channels,self.n_samples))
+
+		self._reader[1].read_many_sample(self.acq_data,number_of_samples_per_channel=self.n_samples)
 
 		if sim:
-			self.acq_data=[[242+random.random() for i in range(self.n_samples)] for j in range(self._channel_no)]
+			self.acq_data[:]=242+np.random.random(self.acq_data.shape)
 
+		rms=np.sqrt(np.einsum('ij,ij->i',self.acq_data,self.acq_data)/self.n_samples)
 		for i in range(self._channel_no):
-			self.power[i].append(math.sqrt(sum([x**2 for x in self.acq_data[i]])/self.n_samples))
+			self.power[i].append(rms[i])
 
 
 
@@ -575,10 +1204,14 @@ adjusts parameters and sets up and synchronises clocks. It returns object of the
 """
 def setup_tasks(cfg,n,simulate):
 
+	#The simulated backend has no real data, so the data is always simulated with it.
+	backend=get_backend(cfg['DAQ'].get('Backend','ni'),cfg['DAQ']['DeviceName'],bool(int(cfg['DAQ'].get('SimRealtime','1'))),cfg['DAQ'].get('ReplayFile',None))
+	simulate=simulate or backend.simulated
+
 	if cfg['DAQ']['DeviceName']=="default":
-		tq=DAQ_tasks(simulate)
+		tq=DAQ_tasks(simulate,backend=backend)
 	else:
-		tq=DAQ_tasks(simulate,dev_name=cfg['DAQ']['DeviceName'])
+		tq=DAQ_tasks(simulate,dev_name=cfg['DAQ']['DeviceName'],backend=backend)
 
 	tq.set_scan_task("Scan",channel=int(cfg['CAVITY']['OutputChannel']))
 	tq.set_laser_task("Lasers")
@@ -596,11 +1229,31 @@ def setup_tasks(cfg,n,simulate):
 
 	tq.set_input_timing()
 
+	tq.acquisition_mode=cfg['DAQ'].get('AcquisitionMode','sequential')
+	tq.ao_scan.set_waveform(cfg['CAVITY'].get('ScanWaveform','ramp'))
+	tq.settle_fraction=float(cfg['CAVITY'].get('SettleFraction','0'))
 
+	if bool(int(cfg['DAQ'].get('CombinedOutput','0'))):
+		tq.combine_outputs()
+
+	tq.sim_model=setup_model(cfg)
+
+	#Scans are recorded from the start if a file is given.
+	if cfg['DAQ'].get('RecordFile',''):
+		tq.start_recording(cfg['DAQ']['RecordFile'])
+
+	#Timing depends on the settings above, so it's set again.
+	tq.set_input_timing()
 
 	return tq
 
 
+#Helper function returning (task, reader of its input stream). The reader is created again only if the task was recreated.
+def _stream_reader(backend,task,reader):
+	if reader[0] is not task:
+		reader=(task,backend.reader(task))
+	return reader
+
 #Helper function.
 def channel_number(channel):
 	try:
@@ -609,23 +1262,3 @@ def channel_number(channel):
 		x=int(channel[-1])
 
 	return x
-
-def generate_data(A,B,G,N,start,end):
-
-	X=np.linspace(start,end,num=N)
-
-	Y=[lor(X[i],A,B,G) for i in range(len(X))]
-
-	return Y
-
-def add_noise(data,var):
-
-	noise=var*np.random.randn(len(data))
-
-	return data+noise
-
-def lor(x,A,B,G):
-	res=0
-	for i in range(len(A)):
-		res+=A[i]/(G[i]**2+(x-B[i])**2)
-	return res
@@ -0,0 +1,205 @@
+import os
+import signal
+import argparse
+import logging
+from threading import Event
+
+from .Config import load_conf
+from .Data_acq import TransferLock, setup_tasks
+from .Lock import Lock
+from .Engine import LockEngine
+from .NetworkIOLocking import NetworkIOLocking
+
+
+"""
+Headless entry point: runs the transfer lock without the GUI (and without Tk and matplotlib, which are never
+imported), e.g. over SSH or as a service. It loads a config file, sets up the DAQ tasks, starts scanning, engages
+the cavity lock and, once the cavity is locked, the locks of the slave lasers. The network interface
+(NetworkIOLocking) is served as with the GUI, so the state of the locks can be read and the locks can be engaged or
+disengaged remotely ("command" requests call methods of LockDaemon). Run it with e.g.:
+
+	python -m SWP.Daemon DEFAULT_Sim --simulate --backend simulated
+
+"--backend" overrides the DAQ backend of the config file (Backend in [DAQ], see Backends.py): with "simulated" the
+program runs without NI drivers or hardware, with "replay" it locks on scans recorded before (given with
+"--replay-file"). "--simulate" only replaces the data from the photodetectors with simulated data, the DAQ device is
+still the one of the backend. The config file is given by its name in the "configs" folder or by its path. The wavelengths of the slave lasers
+are taken from the config file (the GUI asks the lasers for them instead), so they have to be given there or as
+arguments unless the DAQ is simulated. The program runs until it gets SIGINT or SIGTERM, then it stops scanning and
+disengages the locks.
+"""
+
+
+log=logging.getLogger(__name__)
+
+
+class LockDaemon:
+
+	def __init__(self,cfg,wavelengths,simulate=False,port=65430,laser_locks=True):
+
+		self.cfg=cfg
+
+		self.lock=Lock(wavelengths,cfg)
+		self.transfer_lock=TransferLock(self.lock,setup_tasks(cfg,len(wavelengths),simulate),cfg)
+		self.engine=LockEngine(self.transfer_lock)
+
+		#Slave lasers whose locks are engaged as soon as the cavity is locked.
+		self.auto_engage=[laser_locks]*len(wavelengths)
+
+		self.networkio=NetworkIOLocking(self,'',port)
+		self.engine.subscribe(self.networkio.update_lock_state)
+		self.engine.subscribe(self._engage_lasers)
+
+		self._stop=Event()
+
+
+	#Runs until "stop" is called, logging the state of the locks every "status_interval" seconds.
+	def run(self,status_interval=10):
+
+		self.engine.start()
+		self.engage_cavity_lock()
+		log.info('Scanning started, cavity lock engaged.')
+
+		try:
+			while not self._stop.wait(status_interval):
+				if self.engine.snapshot is not None:
+					log.info(self.status(self.engine.snapshot))
+		finally:
+			self.engine.stop(wait=True,timeout=5)
+			self.engine.disengage_cavity_lock()
+			self.transfer_lock.daq_tasks.stop_recording()
+			log.info('Scanning stopped, locks disengaged.')
+
+
+	def stop(self):
+		self._stop.set()
+
+
+	#Methods available to the network interface.
+	def engage_cavity_lock(self):
+		self.engine.engage_cavity_lock()
+
+
+	def disengage_cavity_lock(self):
+		self.engine.disengage_cavity_lock()
+
+
+	def engage_laser_lock(self,ind):
+		self.engine.engage_laser_lock(ind)
+
+
+	def disengage_laser_lock(self,ind):
+		self.auto_engage[ind]=False
+		self.engine.disengage_laser_lock(ind)
+
+
+	#One line describing the state of the locks.
+	def status(self,snap):
+
+		text='{:.1f} Hz, cavity: {}, error {:.3g} MHz rms'.format(snap.scan_frequency,'locked' if snap.master_locked else 'unlocked',snap.master_err_rms)
+		for i in range(len(snap.slave_locks_engaged)):
+			if snap.slave_locks_engaged[i]:
+				text+='; laser {}: {}, error {:.3g} MHz rms'.format(i+1,'locked' if snap.slave_locked[i] else 'unlocked',snap.slave_err_rms[i])
+			else:
+				text+='; laser {}: disengaged'.format(i+1)
+
+		return text
+
+
+	#Subscriber of the engine. It engages the locks of the slave lasers once the cavity is locked.
+	def _engage_lasers(self,snap):
+
+		if not (snap.master_lock_engaged and snap.master_locked):
+			return
+
+		for i in range(len(self.auto_engage)):
+			if self.auto_engage[i]:
+				self.auto_engage[i]=False
+				self.engine.engage_laser_lock(i)
+				log.info('Laser {} lock engaged.'.format(i+1))
+
+
+
+"""
+Wavelengths of the slave lasers: the given ones, otherwise the ones in the config file. If they aren't in the config
+file either ("default"), the simulated lasers get 1086 nm, 1087 nm (as in the GUI).
+"""
+def laser_wavelengths(cfg,n,given=None,simulate=False):
+
+	if given is not None:
+		return given[:n]
+
+	wvls=[]
+	for i in range(n):
+		try:
+			wvls.append(float(cfg['LASER'+str(i+1)]['Wavelength']))
+		except ValueError:
+			if not simulate:
+				raise ValueError('Wavelength of laser {} is not in the config file, give it with --wavelengths.'.format(i+1))
+			wvls.append(1086.+i)
+
+	return wvls
+
+
+#Config file given by its name in the "configs" folder (with or without ".ini") or by its path.
+def config_path(name):
+
+	if os.path.isfile(name):
+		return name
+
+	if name[-4:]!=".ini":
+		name+=".ini"
+
+	return os.path.dirname(os.path.realpath(__file__))+"/configs/"+name
+
+
+def main(argv=None):
+
+	parser=argparse.ArgumentParser(prog='python -m SWP.Daemon',description='Runs the transfer cavity lock without the GUI.')
+	parser.add_argument('config',help='config file (name in SWP/configs or path)')
+	parser.add_argument('--simulate',action='store_true',help='simulate the data from the photodetectors')
+	parser.add_argument('--backend',choices=('ni','simulated','replay'),default=None,help='DAQ backend (default: Backend in the config file)')
+	parser.add_argument('--replay-file',default=None,help='file with the recorded scans for the replay backend')
+	parser.add_argument('--lasers',type=int,choices=(1,2),default=None,help='number of slave lasers (default: all in the config file)')
+	parser.add_argument('--wavelengths',type=float,nargs='+',default=None,help='wavelengths of the slave lasers (nm)')
+	parser.add_argument('--port',type=int,default=65430,help='port of the network interface')
+	parser.add_argument('--no-laser-locks',action='store_true',help='engage only the cavity lock')
+	parser.add_argument('--status',type=float,default=10,help='interval of the status messages (s)')
+	args=parser.parse_args(argv)
+
+	handler=logging.StreamHandler()
+	handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+	log.addHandler(handler)
+	log.setLevel(logging.INFO)
+	log.propagate=False
+
+	filename=config_path(args.config)
+	if not os.path.isfile(filename):
+		parser.error('config file {} not found'.format(filename))
+	cfg=load_conf(filename)
+
+	if args.backend is not None:
+		cfg['DAQ']['Backend']=args.backend
+	if args.replay_file is not None:
+		cfg['DAQ']['ReplayFile']=args.replay_file
+	if cfg['DAQ'].get('Backend','ni')=="replay" and not cfg['DAQ'].get('ReplayFile',''):
+		parser.error('the replay backend needs a file with recorded scans (--replay-file)')
+
+	n=args.lasers if args.lasers is not None else (2 if cfg.has_section('LASER2') else 1)
+	try:
+		wvls=laser_wavelengths(cfg,n,args.wavelengths,args.simulate)
+	except ValueError as e:
+		parser.error(str(e))
+	if len(wvls)<n:
+		parser.error('{} wavelengths needed'.format(n))
+
+	daemon=LockDaemon(cfg,wvls,args.simulate,args.port,not args.no_laser_locks)
+
+	signal.signal(signal.SIGINT,lambda signum,frame: daemon.stop())
+	signal.signal(signal.SIGTERM,lambda signum,frame: daemon.stop())
+
+	daemon.run(args.status)
+
+
+if __name__=="__main__":
+	main()
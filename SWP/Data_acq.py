@@ -1,24 +1,23 @@
-import nidaqmx as dq
-import matplotlib.pyplot as plt
 import numpy as np
-import math
 import queue
 import logging
 import h5py
-from threading import Thread, Event
+from threading import Event
 from time import sleep
-from scipy.optimize import curve_fit
+from scipy import ndimage, fft
 
 from .DAQ_tasks import *
 from .Lock import *
-from .Themes import Colors
+from .Buffers import RollingStats, RingBuffer
+from .Engine import LockSnapshot
 
 """
-This file contains the class that represents the transfer lock and two helper classes. The main class ("TransferLock")
+This file contains the class that represents the transfer lock and a few helper classes. The main class ("TransferLock")
 uses the class "Lock" to generate feedback signal and applires it to devices by communicating with the DAQ through
 the DAQ_tasks class contained in a different file. This class is responsible for acquiring the signal and filtering
-(through helper classes), extracting necessary information, updating the GUI, obtaining the mentioned feedback,
-applying it through DAQ and plotting the data. In summary, it manages the cavity scan and its data.
+(through helper classes), extracting necessary information, obtaining the mentioned feedback and applying it through
+DAQ. In summary, it manages the cavity scan and its data. The GUI is updated from the snapshots of the lock state that
+are published after every scan (see Engine.py).
 
 """
 
@@ -40,12 +39,15 @@ class TransferLock:
 		self.lock=lock    			#Lock object
 		self.filter=Filter()		#Filter object
 		self.daq_tasks=tasks    	#DAQ_tasks object
+
+		#Arrays used to process every scan (resized only if number of channels or samples changes)
+		self.signals=SignalBatch(self.filter,n+1,tasks.ao_scan.n_samples)
 		self.master_signal=0    	#Full acquired signal
 		self.slave_signals=[0]*n
 
-		self._err_data_length=100   #Length of the error signal collected
+		self._err_data_length=int(cfg['CAVITY'].get('ErrorHistory','100'))   #Length of the error signal collected
 
-		self.rms_points=min(int(lock.cfg['CAVITY']['RMS']),self._err_data_length) #Number of points used for RMS calculation
+		self._rms_points=max(int(lock.cfg['CAVITY']['RMS']),1) #Number of points used for RMS calculation
 
 		#This variable defines the limit below which master laser is considered locked.
 		self.master_rms_crit=float(cfg['CAVITY']['LockThreshold']) #ms
@@ -54,16 +56,59 @@ class TransferLock:
 		self.master_lock_engaged=False
 		self.master_locked_flag=False
 
-		#Error signal history is contained in the queue (kept in MHz)
-		self.master_err_history=deque(maxlen=self._err_data_length)
+		#Error signal history is contained in a ring buffer (kept in MHz)
+		self.master_err_history=RingBuffer(self._err_data_length)
 		self.master_err_history.append(0)
 
-		#Current RMS of the error signal
+		#Rolling statistics (RMS, mean, peak-to-peak) of the last rms_points errors and current RMS of the error signal
+		self.master_err_stats=RollingStats(self._rms_points)
+		self.master_err_stats.append(0)
 		self.master_err_rms=0
 
 		#Criterion used for peak finding
 		self.master_peak_crit=float(cfg['CAVITY']['PeakCriterion'])
 
+		"""
+		Peak tracking. If turned on, peaks are first searched only around their positions from the previous scan,
+		in a window of +/- TrackWindow (fraction of the scan). Full search is done only when a peak is lost.
+		"""
+		self.track_peaks=bool(int(cfg['CAVITY'].get('TrackPeaks','0')))
+		self.track_window=float(cfg['CAVITY'].get('TrackWindow','0.02'))
+
+		"""
+		High precision mode. If turned on, after the peaks are found a Lorentzian is fitted to the data in a window of
+		+/- FitWindow (fraction of the scan) around every peak, which also gives the widths and amplitudes of the peaks.
+		"""
+		self.fit_peaks=bool(int(cfg['CAVITY'].get('FitPeaks','0')))
+		self.fit_window=float(cfg['CAVITY'].get('FitWindow','0.02'))
+
+		"""
+		Triangle scan: shift of the peaks in the falling half of the scan (caused by hysteresis of the piezo, in ms),
+		weight used to average it, (direction, mean master peak position, scan offset) of the last half with both
+		master peaks and the averages the shift is estimated from (see correct_hysteresis).
+		"""
+		self.hysteresis=None
+		self.hysteresis_alpha=float(cfg['CAVITY'].get('HysteresisAlpha','0.05'))
+		self._last_half=None
+		self._hysteresis_stats=None
+
+		"""
+		In the pipelined and continuous modes the feedback computed from a scan is applied one scan later than in the
+		sequential mode. With that delay, the same gains make the locks ring (and become unstable at about half the
+		gains that are stable in the sequential mode), so in these modes all gains are multiplied by DelayedGainScale.
+		"""
+		self.delayed_gain_scale=float(cfg['DAQ'].get('DelayedGainScale','0.5'))
+
+		"""
+		Peak finding method for every channel (master laser first): "derivative" (zero crossings of the derivative)
+		or "template" (cross-correlation with a Lorentzian of half width TemplateWidth, in ms).
+		"""
+		self.peak_engines=[cfg['CAVITY'].get('PeakEngine','derivative')]
+		self.template_widths=[float(cfg['CAVITY'].get('TemplateWidth','0.1'))]
+		for i in range(n):
+			self.peak_engines.append(cfg['LASER'+str(i+1)].get('PeakEngine','derivative'))
+			self.template_widths.append(float(cfg['LASER'+str(i+1)].get('TemplateWidth','0.1')))
+
 		#RMS criteria for slave lasers
 		self.slave_rms_crits=[float(cfg['LASER1']['LockThreshold'])]
 		if n>1:
@@ -80,14 +125,17 @@ class TransferLock:
 			self.slave_locked_flags.append(Event())
 
 		#RMS history
-		self.slave_err_history=[deque(maxlen=self._err_data_length)]
+		self.slave_err_history=[RingBuffer(self._err_data_length)]
 		if n>1:
-			self.slave_err_history.append(deque(maxlen=self._err_data_length)) #Kept in MHz instead of r
+			self.slave_err_history.append(RingBuffer(self._err_data_length)) #Kept in MHz instead of r
 
 		for i in range(n):
 			self.slave_err_history[i].append(0)
 
-		#Current RMS (in MHz as well)
+		#Rolling statistics and current RMS (in MHz as well)
+		self.slave_err_stats=[RollingStats(self._rms_points) for i in range(n)]
+		for i in range(n):
+			self.slave_err_stats[i].append(0)
 		self.slave_err_rms=[0]*n
 
 		"""
@@ -109,8 +157,8 @@ class TransferLock:
 		self._slave_counters=[0,0]
 
 		#Helpful flags and events
-		self._scan_thread=None
 		self._scan_flag=False
+		self._two_peaks=False
 		self._scan_finished=Event()
 		self._scan_paused=Event()
 		self._lck_adjust_fin=Event()
@@ -127,27 +175,122 @@ class TransferLock:
 		self._scan_flag=False
 
 	"""
-	Two function below are responsible for "acquiring" signal, by which I mean filtering the signal and finding
-	peaks. The data is in reality obtained regardless of these functions and is contained in DAQ_tasks object,
-	which is used here as arguments of initialization for Signal class object. These functions are run only
-	if appropriate locks are engaged.
+	The function below is responsible for "acquiring" signal, by which I mean filtering the signal and finding
+	peaks. The data is in reality obtained regardless of this function and is contained in DAQ_tasks object,
+	which is loaded into a SignalBatch object (created once, together with this object, and reused for every
+	scan). All photodiodes (master and slave lasers) are processed together in one batch, and the resulting
+	signals are then split into the master signal and slave signals. This function is run only if the cavity
+	lock is engaged.
+
+	Channels are divided between the two peak finding methods. For the "derivative" ones, if peak tracking is on,
+	peaks are first looked for around the peaks of the previous signals and only the channels where it fails are
+	searched in full. The "template" ones cost the same every time, so they are never tracked.
+
+	In the high precision mode, the found peaks of all channels are then fitted with Lorentzians.
+
+	By default the whole scan is used. With the triangle scan, every scan is one half of the period (see
+	"scan_segments"), and "direction" tells which one it is (1 rising, -1 falling).
 	"""
-	def obtain_master_signal(self):
+	def obtain_signals(self,datax=None,datay=None,direction=1):
 		try:
-			self.master_signal=Signal(self.daq_tasks.time_samples,self.daq_tasks.PD_data[0],self.filter)
-			self.master_signal.find_peaks(criterion=self.master_peak_crit,win_size=(self.daq_tasks.ao_scan.n_samples//400))
-		except Exception as e:
-			log.warning(e)
+			if datax is None:
+				datax,datay=self.daq_tasks.time_samples,self.daq_tasks.PD_data
 
+			signals=self.signals
+			signals.load(datax,datay,self.daq_tasks.discard_fraction())
+
+			criteria=[self.master_peak_crit]+self.slave_peak_crits
+			win_size=self.daq_tasks.ao_scan.n_samples//400
+
+			template=[i for i in range(len(signals)) if i<len(self.peak_engines) and self.peak_engines[i]=="template"]
+			derivative=[i for i in range(len(signals)) if i not in template]
+
+			if self.track_peaks and isinstance(self.master_signal,Signal):
+				previous=[self.master_signal.peaks_x]+[s.peaks_x if isinstance(s,Signal) else [] for s in self.slave_signals]
+				previous=[previous[i] if i in derivative else [] for i in range(len(signals))]
+				lost=signals.track_peaks(criteria,win_size,previous,int(self.track_window*self.daq_tasks.ao_scan.n_samples))
+				derivative=[i for i in derivative if i in lost]
+
+			signals.find_peaks(criteria,win_size=win_size,channels=derivative)
+			signals.find_template_peaks(criteria,self.template_widths,win_size=win_size,channels=template)
+
+			if self.fit_peaks:
+				signals.fit_peaks(int(self.fit_window*self.daq_tasks.ao_scan.n_samples))
+
+			if self.daq_tasks.ao_scan.waveform=="triangle":
+				self.correct_hysteresis(direction)
+
+			self.master_signal=signals[0]
+			for i in range(len(self.slave_signals)):
+				self.slave_signals[i]=signals[i+1]
 
-	def obtain_slave_signal(self,ind):
-		try:
-			self.slave_signals[ind]=Signal(self.daq_tasks.time_samples,self.daq_tasks.PD_data[ind+1],self.filter)
-			self.slave_signals[ind].find_peaks(criterion=self.slave_peak_crits[ind],win_size=(self.daq_tasks.ao_scan.n_samples//400))
 		except Exception as e:
 			log.warning(e)
 
 
+	"""
+	Parts of the last scan that are used for locking, as a list of (X, data, direction) tuples. For the usual ramp
+	it's just the whole scan. With the triangle scan, the scan is one half of the period (see Scan.set_waveform), and
+	the falling half is reversed, so the peaks appear at the same positions as in the rising half.
+	"""
+	def scan_segments(self):
+
+		datax=self.daq_tasks.time_samples
+		datay=self.daq_tasks.PD_data
+
+		if self.daq_tasks.ao_scan.waveform!="triangle" or self.daq_tasks.scan_direction>0:
+			return [(datax,datay,1)]
+
+		return [(datax,np.asarray(datay)[:,::-1],-1)]
+
+
+	"""
+	The piezo has hysteresis, so with the triangle scan the peaks in the falling half are shifted compared to the
+	rising half. The shift is estimated from the mean positions of the two master peaks (see _update_hysteresis) and
+	subtracted from all peaks found in the falling half. Both halves then lock the cavity and the lasers to the same
+	point, and the locks are updated after each of them, so twice per period.
+	"""
+	def correct_hysteresis(self,direction):
+
+		peaks=self.signals.peaks_x
+
+		if len(peaks[0])==2:
+			half=(direction,np.mean(peaks[0]),self.daq_tasks.applied_offset())
+			if self._last_half is not None and self._last_half[0]!=direction:
+				self._update_hysteresis(half)
+			self._last_half=half
+
+		if direction<0 and self.hysteresis is not None:
+			for i in range(len(peaks)):
+				peaks[i]=peaks[i]-self.hysteresis
+
+
+	"""
+	Every two halves in a row give one measurement: the master peaks move by the shift (forward from the rising to
+	the falling half, back from the falling to the rising one), but also because the lock changed the scan offset
+	between the halves. The moves and the offset changes are averaged over scans (exponential moving averages with
+	weight HysteresisAlpha), and the shift is the part of the moves that doesn't depend on the offset change (the
+	intercept of a linear fit).
+	"""
+	def _update_hysteresis(self,half):
+
+		sign=-half[0]
+		x=sign*(half[2]-self._last_half[2])
+		y=sign*(half[1]-self._last_half[1])
+		stats=np.array([x,y,x*x,x*y])
+
+		if self._hysteresis_stats is None:
+			self._hysteresis_stats=stats
+		else:
+			self._hysteresis_stats+=self.hysteresis_alpha*(stats-self._hysteresis_stats)
+
+		mx,my,mxx,mxy=self._hysteresis_stats
+		var=mxx-mx*mx
+		slope=(mxy-mx*my)/var if var>1e-12 else 0.
+
+		self.hysteresis=my-slope*mx
+
+
 	"""
 	Series of locking functions that are used only if appropriate locks are engaged and if master signal has exactly
 	2 peaks. The flags (in form of threading.Event) are used to time different processes correctly. They're just a
@@ -155,7 +298,7 @@ class TransferLock:
 
 	Both lock (lock_master and lock_laser) functions first call a different method, which refreshes the lock. These
 	functions (refresh_master_lock and refresh_slave_lock) first call a function from the Lock class that uses
-	the filtered signal and previously found peak positions (through obtain_master(slave)_signal method) contained
+	the filtered signal and previously found peak positions (through obtain_signals method) contained
 	in the object of Signal class that's saved to one of this object's attributes. The Lock class method finds new
 	errors for this iterations and returns them ("mer" and "ser" variables below).
 
@@ -211,13 +354,11 @@ class TransferLock:
 
 	def update_master_error(self,err):
 
-		#It is a FIFO queue which automatically removes the oldest element if it becomes over limit
+		#It is a ring buffer which automatically removes the oldest element if it becomes over limit
 		self.master_err_history.append(err)
 
-		if len(self.master_err_history)<=self.rms_points:
-			self.master_err_rms=math.sqrt(np.sum(np.power(list(self.master_err_history),2))/len(list(self.master_err_history)))
-		else:
-			self.master_err_rms=math.sqrt(np.sum(np.power(list(self.master_err_history)[-self.rms_points:],2))/self.rms_points)
+		self.master_err_stats.append(err)
+		self.master_err_rms=self.master_err_stats.rms
 
 		if self.master_err_rms<self.master_rms_crit:
 			self.master_locked_flag=True
@@ -228,10 +369,9 @@ class TransferLock:
 	def update_slave_error(self,err,ind):
 
 		self.slave_err_history[ind].append(err)
-		if len(self.slave_err_history[ind])<=self.rms_points:
-			self.slave_err_rms[ind]=math.sqrt(np.sum(np.power(list(self.slave_err_history[ind]),2))/len(list(self.slave_err_history[ind])))
-		else:
-			self.slave_err_rms[ind]=math.sqrt(np.sum(np.power(list(self.slave_err_history[ind])[-self.rms_points:],2))/self.rms_points)
+
+		self.slave_err_stats[ind].append(err)
+		self.slave_err_rms[ind]=self.slave_err_stats[ind].rms
 
 		if self.slave_err_rms[ind]<self.slave_rms_crits[ind]:
 			self.slave_lock_counters[ind]+=1
@@ -245,6 +385,45 @@ class TransferLock:
 
 
 
+	#Clears the error history and statistics of the cavity lock (e.g. when the lock is disengaged).
+	def reset_master_error(self):
+
+		self.master_err_history.clear()
+		self.master_err_history.append(0)
+		self.master_err_stats.reset()
+		self.master_err_stats.append(0)
+		self.master_err_rms=0
+
+
+	#Same as above, for a slave laser.
+	def reset_slave_error(self,ind):
+
+		self.slave_err_history[ind].clear()
+		self.slave_err_history[ind].append(0)
+		self.slave_err_stats[ind].reset()
+		self.slave_err_stats[ind].append(0)
+		self.slave_err_rms[ind]=0
+
+
+	"""
+	Number of errors used to calculate the RMS. Changing it changes the window of the rolling statistics of all lasers.
+	"""
+	@property
+	def rms_points(self):
+		return self._rms_points
+
+
+	@rms_points.setter
+	def rms_points(self,points):
+
+		self._rms_points=max(int(points),1)
+
+		self.master_err_stats.window=self._rms_points
+		for stats in self.slave_err_stats:
+			stats.window=self._rms_points
+
+
+
 	def master_logging_loop(self,GUI_object=None):
 
 
@@ -375,183 +554,126 @@ class TransferLock:
 
 	"""
 	The function below manages the scan and performs it through the DAQ_tasks class methods. It is run in
-	a separate thread that is open from the level of GUI. This function runs as long as the scan flag is
-	set to True. Currently, acquiring data and updating the plots is done sequentially in this function.
-	The order is as follows:
+	a separate thread (see LockEngine in Engine.py). This function runs as long as the scan flag is set to True.
+	It doesn't touch the GUI: after every scan the state of the lock is passed to "publish" (if given) as a
+	LockSnapshot, and the GUI and others get it from there. The snapshot is a frame (with copies of the data and
+	histories) only if "frames" returns True (always, if it's not given). The order is as follows:
 		- scan is performed, i.e. cavity's piezo is ramped and data from photodetectors acquired
 		- time of that task is measured and added to the queue used for calculating real scanning frequency
-		- label in the GUI is updated
-		- 2D lines on the plot are updated (and redrawn at the end of the function) and axes limits adjusted.
-		This refers to the plot showing the data from photodiodes, not the error signal.
-		- next, if the cavity lock is not engaged, nothing happens (graphs are just told to redraw) and next
-		iteration begins
-		- the signal from the master signal is analyzed (peaks are found)
-		- if there are not exactly 2 peaks, nothing more happens and next iteration begins
-		- otherwise first a GUI element is changed and the locking function called (described above), after
-		which, if the master laser/cavity is locked, other GUI elements are updated
-		- now whether or not the cavity is locked, the plotting of error signal happens, as well as logging
-		to a container, if the user chose to record the error signal; that occurs at the very end of the iteration
-		- if the cavity is locked, before error signal plotting happens, the slave lasers are locked, if the
-		locks are engaged of course; GUI elements are updated as well
-
+		- next, if the cavity lock is not engaged, nothing else happens
+		- the signals from all photodiodes are analyzed together (peaks are found)
+		- if there are not exactly 2 peaks, nothing more happens
+		- otherwise the locking function is called (described above) and, if the master laser/cavity is locked,
+		the slave lasers are locked, if the locks are engaged of course
+		- finally the snapshot is published and the next iteration begins
 	"""
 
-	def scan(self,GUI_object=None):
+	def scan(self,publish=None,frames=None):
 
 		self._scan_paused.clear()
 		self._counter=0
 
+		#In the pipelined and continuous modes the next scan is acquired while this one is processed (see DAQ_tasks).
+		sequential=self.daq_tasks.acquisition_mode not in ("pipelined","continuous")
+		self.lock.gain_scale=1. if sequential else self.delayed_gain_scale
+		ts=time()
+
 		while self._scan_flag:
 
 			self._scan_finished.clear()
 
-			ts=time()
+			if sequential:
+				ts=time()
 
-			self.daq_tasks.scan_and_acquire(self._scan_finished)
+			self.daq_tasks.acquire(self._scan_finished)
 
 			self._scan_finished.wait()
+
+			#In the sequential mode only the acquisition is timed. In the other modes the scans follow one another,
+			#so the time between them is measured.
 			self._scan_frequency.append(1/(time()-ts))
+			ts=time()
 
-			GUI_object.real_scfr.config(text='{:.1f}'.format(np.mean(list(self._scan_frequency))))
-
-			for i in range(len(self.daq_tasks.PD_data)):
-				GUI_object.plot_win.all_lines[i].set_data(self.daq_tasks.time_samples,self.daq_tasks.PD_data[i])
-				## plotting smoothed and derivative of master peak
-				# try:
-				# 	GUI_object.plot_win.all_lines[1].set_data(self.daq_tasks.time_samples,self.master_signal.smooth_der)
-				# 	GUI_object.plot_win.all_lines[2].set_data(self.daq_tasks.time_samples,self.master_signal.smooth_y)
-				# except:
-				# 	pass
-				if i==0:
-					GUI_object.plot_win.all_lines[i+3].set_data([self.lock.master_lockpoint]*2,[-10,10])
-				else:
-					GUI_object.plot_win.all_lines[i+3].set_data([self.lock.slave_lockpoints[i-1]*self.lock.interval+self.lock.master_lockpoint]*2,[-10,10])
-			GUI_object.plot_win.ax.set_xlim(self.daq_tasks.ao_scan.scan_time*0.2, self.daq_tasks.ao_scan.scan_time*1.01)
-			GUI_object.plot_win.ax.set_ylim(np.amin(self.daq_tasks.PD_data)-0.05, np.amax(self.daq_tasks.PD_data)+0.2)
+			self._two_peaks=False
 
 			if self.master_lock_engaged:
 
-				self.obtain_master_signal()
-
-				if len(self.master_signal.peaks_x)==2:
+				#With the triangle scan, every scan is one half of the period, so the locks are updated twice per period.
+				for datax,datay,direction in self.scan_segments():
+					self.obtain_signals(datax,datay,direction)
 
-					GUI_object.twopeak_status_cv.itemconfig(GUI_object.twopeak_status,fill=Colors['on_color'])
+				self._two_peaks=len(self.master_signal.peaks_x)==2
 
+				if self._two_peaks:
 					self.lock_master()
-
 					self._lck_adjust_fin.wait()
 
-					GUI_object.rms_cav.config(text="{:.3f}".format(self.master_err_rms))
-					GUI_object.real_scoff.config(text='{:.2f}'.format(self.daq_tasks.ao_scan.offset))
-				else:
-					GUI_object.twopeak_status_cv.itemconfig(GUI_object.twopeak_status,fill=Colors['off_color'])
-
-				if self.master_locked_flag:
-					GUI_object.networkio.master_locked_flag = True
-					GUI_object.cav_lock_status_cv.itemconfig(GUI_object.cav_lock_status,fill=Colors['on_color'])
-
-					if any(self.slave_locks_engaged):
-						for i in range(len(self.slave_locks_engaged)):
-							if self.slave_locks_engaged[i]:
-								self.obtain_slave_signal(i)
-								self.lock_laser(i)
-								self._slck_adjust_fin[i].wait()
-
-								GUI_object.rms_laser[i].config(text="{:.2f}".format(self.slave_err_rms[i]))
-								GUI_object.app_volt[i].config(text='{:.3f}'.format(self.daq_tasks.ao_laser.voltages[i]))
-								GUI_object.laser_r[i].config(text='{:.3f}'.format(GUI_object.lock.slave_Rs[i]))
-
-								if self.slave_locked_flags[i].is_set():
-									GUI_object.laser_lock_status_cv[i].itemconfig(GUI_object.laser_lock_status[i],fill=Colors['on_color'])
-								else:
-									GUI_object.laser_lock_status_cv[i].itemconfig(GUI_object.laser_lock_status[i],fill=Colors['off_color'])
-				else:
-					GUI_object.networkio.master_locked_flag = False
-					GUI_object.networkio.master_err = np.nan
-					GUI_object.cav_lock_status_cv.itemconfig(GUI_object.cav_lock_status,fill=Colors['off_color'])
-					for j in range(len(self.slave_locks_engaged)):
-						GUI_object.networkio.slave_locked_flags[j] = False
-						GUI_object.networkio.slave_err[j] = np.nan
-						GUI_object.networkio.slave_frequency[j] = np.nan
-						GUI_object.networkio.slave_lockpoint[j] = GUI_object.lock.get_laser_abs_lockpoint(j)
-
-			else:
-				GUI_object.networkio.master_locked_flag = False
-				GUI_object.networkio.master_err = np.nan
-				for j in range(len(self.slave_locks_engaged)):
-					GUI_object.networkio.slave_locked_flags[j] = False
-					GUI_object.networkio.slave_err[j] = np.nan
-					GUI_object.networkio.slave_frequency[j] = np.nan
-					GUI_object.networkio.slave_lockpoint[j] = GUI_object.lock.get_laser_abs_lockpoint(j)
-
-			if self.master_lock_engaged and len(self.master_signal.peaks_x)==2:
-
-				X=np.linspace(0,len(self.master_err_history)-1,len(self.master_err_history))
-				GUI_object.plot_win.mline.set_data(X,self.master_err_history)
-				GUI_object.plot_win.ax_err.set_ylim(min(self.master_err_history)-self.master_rms_crit/3, self.master_rms_crit/3+max(self.master_err_history))
-				GUI_object.plot_win.ax_err.set_xlim(min(X), max(X))
-
-				GUI_object.networkio.master_err = self.master_err_history[-1]
-
-				if GUI_object.master_logging_set:
-
-					GUI_object.master_time_temp.put(time()-GUI_object.mt_start)
-					GUI_object.master_error_temp.put(GUI_object.lock.master_err)
-
-					self._master_counter+=1
-
-				for j in range(len(self.slave_locks_engaged)):
-					if self.slave_locks_engaged[j]:
-						GUI_object.networkio.slave_locked_flags[j] = True
-						Xs=np.linspace(0,len(self.slave_err_history[j])-1,len(self.slave_err_history[j]))
-						GUI_object.plot_win.slines[j].set_data(Xs,self.slave_err_history[j])
-						try:
-							GUI_object.plot_win.ax_err_L[j].set_ylim(min(self.slave_err_history[j])-self.slave_rms_crits[j]/3, self.slave_rms_crits[j]/3+max(self.slave_err_history[j]))
-						except:
-							pass
-						try:
-							GUI_object.plot_win.ax_err_L[j].set_xlim(min(Xs), max(Xs))
-						except:
-							pass
-
-						GUI_object.networkio.slave_err[j] = self.slave_err_history[j][-1]
-						GUI_object.networkio.slave_frequency[j] = GUI_object.lock.get_laser_abs_freq(j)
-						GUI_object.networkio.slave_lockpoint[j] = GUI_object.lock.get_laser_abs_lockpoint(j)
-
-						if GUI_object.laser_logging_set[j]:
-
-
-							GUI_object.slave_time_temp[j].put(time()-GUI_object.lt_start[j])
-							GUI_object.slave_err_temp[j].put(self.slave_err_history[j][-1])
-							GUI_object.slave_rfreq_temp[j].put(GUI_object.lock.get_laser_abs_freq(j))
-							GUI_object.slave_lfreq_temp[j].put(GUI_object.lock.get_laser_abs_lockpoint(j))
-							GUI_object.slave_rr_temp[j].put(GUI_object.lock.slave_Rs[j])
-							GUI_object.slave_lr_temp[j].put(GUI_object.lock.slave_lockpoints[j])
-							GUI_object.slave_pow_temp[j].put(1000*np.mean(self.daq_tasks.power_PDs.power[j]))
-							GUI_object.slave_wvmfreq_temp[j].put(GUI_object.real_frequency[j][0])
-
-
-							self._slave_counters[j]+=1
-					else:
-						GUI_object.networkio.slave_locked_flags[j] = False
-						GUI_object.networkio.slave_err[j] = np.nan
-						GUI_object.networkio.slave_frequency[j] = np.nan
-						GUI_object.networkio.slave_lockpoint[j] = GUI_object.lock.get_laser_abs_lockpoint(j)
-			else:
-				for j in range(len(self.slave_locks_engaged)):
-					GUI_object.networkio.slave_locked_flags[j] = False
-					GUI_object.networkio.slave_err[j] = np.nan
-					GUI_object.networkio.slave_frequency[j] = np.nan
-					GUI_object.networkio.slave_lockpoint[j] = GUI_object.lock.get_laser_abs_lockpoint(j)
+				if self.master_locked_flag and any(self.slave_locks_engaged):
+					for i in range(len(self.slave_locks_engaged)):
+						if self.slave_locks_engaged[i]:
+							self.lock_laser(i)
+							self._slck_adjust_fin[i].wait()
 
 			self._counter+=1
 
+			if publish is not None:
+				publish(self.snapshot(frames is None or frames()))
 
-			GUI_object.plot_win.fig.canvas.draw_idle()
+		#The scan started in the pipelined (or running in the continuous) mode is finished, so the tasks are stopped
+		#when scanning is paused.
+		self.daq_tasks.stop_acquisition()
 
 		self._scan_paused.set()
 
 
+	#State of the lock after the last scan (see LockSnapshot in Engine.py). The data and histories are copied only for a frame.
+	def snapshot(self,frame=True):
+
+		snap=LockSnapshot()
+		lock=self.lock
+		n=len(self.slave_locks_engaged)
+
+		snap.counter=self._counter
+		snap.timestamp=time()
+		snap.scan_frequency=sum(self._scan_frequency)/len(self._scan_frequency) if self._scan_frequency else 0.
+
+		snap.frame=frame
+		if frame:
+			snap.time_samples=self.daq_tasks.time_samples
+			snap.pd_data=np.array(self.daq_tasks.PD_data)
+		snap.scan_time=self.daq_tasks.ao_scan.scan_time
+		snap.scan_offset=self.daq_tasks.ao_scan.offset
+		snap.laser_voltages=list(self.daq_tasks.ao_laser.voltages)
+
+		snap.lockpoints_x=[lock.master_lockpoint]+[lock.slave_lockpoints[i]*lock.interval+lock.master_lockpoint for i in range(n)]
+
+		snap.master_lock_engaged=self.master_lock_engaged
+		snap.master_two_peaks=self.master_lock_engaged and self._two_peaks
+		snap.master_valid=snap.master_two_peaks
+		snap.master_locked=self.master_locked_flag
+		snap.master_err=lock.master_err
+		snap.master_err_rms=self.master_err_rms
+		snap.master_err_mhz=self.master_err_history[-1]
+		if frame:
+			snap.master_history=np.array(self.master_err_history.values)
+		snap.master_history_range=(self.master_err_history.min,self.master_err_history.max)
+
+		snap.slave_locks_engaged=list(self.slave_locks_engaged)
+		snap.slave_locked=[self.slave_locked_flags[i].is_set() for i in range(n)]
+		snap.slave_errs=[self.slave_err_history[i][-1] if len(self.slave_err_history[i])>0 else 0. for i in range(n)]
+		snap.slave_err_rms=list(self.slave_err_rms)
+		if frame:
+			snap.slave_histories=[np.array(self.slave_err_history[i].values) for i in range(n)]
+		snap.slave_history_ranges=[(self.slave_err_history[i].min,self.slave_err_history[i].max) for i in range(n)]
+		snap.slave_Rs=list(lock.slave_Rs)
+		snap.slave_lockpoints=list(lock.slave_lockpoints)
+		snap.slave_abs_lockpoints=[lock.get_laser_abs_lockpoint(i) for i in range(n)]
+		snap.slave_frequencies=[lock.get_laser_abs_freq(i) if snap.master_valid and self.slave_locks_engaged[i] else np.nan for i in range(n)]
+		snap.slave_powers=[1000*sum(self.daq_tasks.power_PDs.power[i])/len(self.daq_tasks.power_PDs.power[i]) for i in range(n)]
+
+		return snap
+
+
 #################################################################################################################
 
 """
@@ -566,12 +688,13 @@ class Signal:
 	To initialize an object of this class one needs the X and Y data and an object of Filter class. During the
 	initialization the data is smoothed using an SG filter.
 	"""
-	def __init__(self,datax,datay,fltr):
+	def __init__(self,datax,datay,fltr,discard=0.25):
 
 		self.data_x=datax
-		self.data_y=datay-np.mean(datay[int(len(datay)/5):])
+		self.discard=discard
+		self.data_y=datay-np.mean(datay[int(0.8*discard*len(datay)):])
 		self.dx=datax[1]-datax[0]
-		self.mx=np.max(self.data_y[int(0.25*len(datay)):])
+		self.mx=np.max(self.data_y[int(discard*len(datay)):])
 		# self.smooth_y=fltr.apply(datay,0,datax[1]-datax[0])
 		self.smooth_y=fltr.peak_filter(self.data_y)
 		self.fltr=fltr
@@ -579,6 +702,8 @@ class Signal:
 		self.smooth_der=[]
 		self.peaks_x=[]
 		self.peaks_y=[]
+		self.peaks_width=[]
+		self.peaks_amp=[]
 
 
 	"""
@@ -586,59 +711,45 @@ class Signal:
 	of the signal. Then, because taking a derivative a noise-amplifying process, the derivative signal is smoothed using
 	SG filter and then using a moving average.
 
+	The derivative and the moving average are done as one convolution (see Filter.smooth_derivative).
+
 	To find peaks, we go over smoothed derivative signal until we find 2 points that are on the opposite side of 0 (we're
 	looking for them to also have a positive slope). Once two such points are found, the algorithm looks at the hight of
 	the peak in the data. It is considered a real peak if peak>criterion*max(data). Because in our measurement we're going
 	to observe one or two peaks of similar height, with a decent SNR, such a simple criterion works perfectly well.
 
 	To find the position of the peak, we fit a linear function to 14 points around the zero crossing and get the zero
-	crossing from the fit. 14 points used for a fit works very well for 1000 points per scan and peaks that are not extremely
-	narrow. This can be changed if necessary. Once the peak is found, the loop is skipped by "win_size".
+	crossing from the fit (done for all peaks at once by Filter.linear_roots). 14 points used for a fit works very
+	well for 1000 points per scan and peaks that are not extremely narrow. This can be changed if necessary. Once
+	the peak is found, the next 20*"win_size" points are skipped.
+
+	The search itself is done on whole arrays (see "_crossings" below), so only the accepted peaks are handled
+	one by one.
 	"""
 	def find_peaks(self,criterion=0.25,win_size=5,hs=10):
 
-		D=self.fltr.apply(self.smooth_y,1,self.dx)
+		D=self.fltr.smooth_derivative(self.smooth_y,1,self.dx,half_size=2)
 		self.der_y=self.fltr.apply(self.data_y,1,self.dx)
-		# D=self.fltr.apply(D,0,self.dx)
-		D=self.fltr.moving_avg(D,half_size=2)
 		self.smooth_der=D
 
-		points=[]
-		skip=0
-
-		#We discard/ignore first 25% of the data. Real scan introduces terrible noise there.
-		for i in range(int(0.25*len(D)),len(D)-win_size):
-
-			if skip>0:
-				skip-=1
-				continue
-
-			if D[i-1]<0 and D[i]>0:
+		threshold=np.array([criterion*self.mx])
+		ind=_crossings(np.asarray(D)[None],np.asarray(self.data_y)[None],threshold,win_size,self.discard)[0]
 
-				if np.amax(self.data_y[i-win_size:i+win_size])>criterion*self.mx:
-					a,b=np.polyfit(self.data_x[i-win_size:i+win_size],D[i-win_size:i+win_size],1)
-					points.append(-b/a)
-
-					skip=20*win_size
-
-		if len(points)==0:
+		#If the smoothed derivative gives nothing, we try the raw one.
+		if len(ind)==0:
 			D=self.der_y
-			skip=0
-			for i in range(int(0.25*len(D)),len(D)-win_size):
+			ind=_crossings(np.asarray(D)[None],np.asarray(self.data_y)[None],threshold,win_size,self.discard)[0]
 
-				if skip>0:
-					skip-=1
-					continue
+		self.peaks_x=self.fltr.linear_roots(self.data_x,D,ind,win_size,self.dx)
 
-				if D[i-1]<0 and D[i]>0:
 
-					if np.amax(self.data_y[i-win_size:i+win_size])>criterion*self.mx:
+	#Same as SignalBatch.find_template_peaks, for a single channel.
+	def find_template_peaks(self,criterion=0.25,width=0.1,win_size=5):
 
-						a,b=np.polyfit(self.data_x[i-win_size:i+win_size],D[i-win_size:i+win_size],1)
-						points.append(-b/a)
-						skip=20*win_size
+		C=self.fltr.correlate(self.data_y,width,self.dx)
+		self.smooth_y=C
 
-		self.peaks_x=np.array(points)
+		self.peaks_x=self.data_x[0]+_maxima(C[None],np.array([criterion]),win_size,self.dx,self.discard)[0]
 
 
 	#Function that finds interpolated values at the found peak position.
@@ -654,6 +765,481 @@ class Signal:
 
 
 
+#################################################################################################################
+
+"""
+Class below does the same as the Signal class, but for all photodiodes at once. The data is a (channels x samples)
+array (e.g. PD_data from DAQ_tasks: master laser first, then slave lasers) and all the filtering is done on the whole
+array along its second axis, so the cost of processing another laser is just a longer array. Peaks are found with
+the same criteria as in Signal (one criterion per channel). Indexing the object gives Signal objects of single
+channels, so they can be passed to the Lock class as before.
+"""
+class SignalBatch:
+
+	"""
+	The object is meant to be created once and reused for every scan: all arrays (data and filtered signals) are
+	allocated here for a given number of channels and samples, and the "load" method fills them with new data in
+	place. They are allocated again only if data of a different shape is loaded (e.g. the number of samples per
+	scan was changed).
+	"""
+	def __init__(self,fltr,channels=1,n_samples=0):
+
+		self.fltr=fltr
+		self.data_x=np.array([])
+		self.dx=0
+		self.discard=0.25
+		self.resize(channels,n_samples)
+
+
+	#Allocates all the arrays. Filtered signals of channels that aren't filtered in a scan are NaN (see track_peaks).
+	def resize(self,channels,n_samples):
+
+		self.data_y=np.zeros((channels,n_samples))
+		self.smooth_y=np.zeros((channels,n_samples))
+		self.der_y=np.zeros((channels,n_samples))
+		self.smooth_der=np.zeros((channels,n_samples))
+		self.mx=np.zeros(channels)
+		self._mean=np.zeros((channels,1))
+		self.peaks_x=[np.array([]) for i in range(channels)]
+		self.peaks_width=[np.array([]) for i in range(channels)]
+		self.peaks_amp=[np.array([]) for i in range(channels)]
+
+		#Parameters of the last Lorentzian fits (see "fit_peaks"), used as starting points for the next ones
+		self.fit_params=[np.zeros((0,4)) for i in range(channels)]
+
+
+	"""
+	Loads new data (channels x samples), subtracting the mean of every channel, and clears the peaks. "discard" is the
+	part of the data at the beginning of the scan that is ignored when looking for peaks (the mean is taken from
+	4/5 of it on, as in Signal).
+	"""
+	def load(self,datax,datay,discard=0.25):
+
+		datay=np.asarray(datay,dtype=float)
+		n=datay.shape[1]
+
+		if datay.shape!=self.data_y.shape:
+			self.resize(*datay.shape)
+
+		self.data_x=np.asarray(datax)
+		self.dx=self.data_x[1]-self.data_x[0]
+		self.discard=discard
+
+		np.mean(datay[:,int(0.8*discard*n):],axis=1,keepdims=True,out=self._mean)
+		np.subtract(datay,self._mean,out=self.data_y)
+		np.max(self.data_y[:,int(discard*n):],axis=1,out=self.mx)
+
+		for i in range(len(self.peaks_x)):
+			self.peaks_x[i]=np.array([])
+			self.peaks_width[i]=np.array([])
+			self.peaks_amp[i]=np.array([])
+
+
+	def __len__(self):
+		return self.data_y.shape[0]
+
+
+	#Signal object of a single channel. It shares the data with this object (so it changes when new data is loaded).
+	def __getitem__(self,ind):
+
+		sig=Signal.__new__(Signal)
+		sig.data_x=self.data_x
+		sig.discard=self.discard
+		sig.data_y=self.data_y[ind]
+		sig.dx=self.dx
+		sig.mx=self.mx[ind]
+		sig.smooth_y=self.smooth_y[ind]
+		sig.fltr=self.fltr
+		sig.der_y=self.der_y[ind]
+		sig.smooth_der=self.smooth_der[ind]
+		sig.peaks_x=self.peaks_x[ind]
+		sig.peaks_y=[]
+		sig.peaks_width=self.peaks_width[ind]
+		sig.peaks_amp=self.peaks_amp[ind]
+
+		return sig
+
+
+	"""
+	The same procedure as in Signal.find_peaks, but "criteria" is a list with a criterion for every channel. The search
+	can be limited to some of the channels (list of their indices); by default all of them are searched. When all
+	channels are searched, the filtered signals are written directly to the arrays of this object.
+	"""
+	def find_peaks(self,criteria,win_size=5,channels=None):
+
+		if channels is None:
+			channels=list(range(len(self)))
+
+		if len(channels)==0:
+			return
+
+		if len(channels)==len(self):
+			Y=self.data_y
+			S=self.fltr.peak_filter(Y,out=self.smooth_y)
+			D=self.fltr.smooth_derivative(S,1,self.dx,half_size=2,out=self.smooth_der)
+			R=self.fltr.apply(Y,1,self.dx,out=self.der_y)
+		else:
+			Y=self.data_y[channels]
+			S=self.fltr.peak_filter(Y)
+			D=self.fltr.smooth_derivative(S,1,self.dx,half_size=2)
+			R=self.fltr.apply(Y,1,self.dx)
+			self.smooth_y[channels]=S
+			self.smooth_der[channels]=D
+			self.der_y[channels]=R
+
+		thresholds=np.asarray(criteria,dtype=float)[channels]*self.mx[channels]
+		found=_crossings(D,Y,thresholds,win_size,self.discard)
+
+		#Channels where the smoothed derivative gives nothing are searched again using the raw one.
+		lost=[i for i in range(len(found)) if len(found[i])==0]
+		if len(lost)>0:
+			raw=_crossings(R[lost],Y[lost],thresholds[lost],win_size,self.discard)
+
+		for i in range(len(channels)):
+			if i in lost:
+				self.peaks_x[channels[i]]=self.fltr.linear_roots(self.data_x,R[i],raw[lost.index(i)],win_size,self.dx)
+			else:
+				self.peaks_x[channels[i]]=self.fltr.linear_roots(self.data_x,D[i],found[i],win_size,self.dx)
+
+
+	"""
+	Alternative method of finding peaks, used for channels where the line shape is known well. The data is
+	cross-correlated with a Lorentzian template of given half width (one width per channel, in the units of data_x),
+	which is done with FFT, so it costs the same every scan no matter how many peaks there are. Correlation (a matched
+	filter) averages the noise over the whole line, so it is much less sensitive to noise than the derivative, and
+	the criterion can be set lower without finding false peaks.
+
+	Peaks are the local maxima of the correlation that are higher than criterion*(maximum of the correlation). As in
+	"find_peaks", the first 25% of the scan (or "discard") is ignored and 20*win_size points after a peak are skipped. The position
+	is refined by fitting a parabola to the maximum and its two neighbours. The correlation is saved as the smoothed
+	signal of the channel.
+	"""
+	def find_template_peaks(self,criteria,widths,win_size=5,channels=None):
+
+		if channels is None:
+			channels=list(range(len(self)))
+
+		if len(channels)==0:
+			return
+
+		C=self.fltr.correlate(self.data_y[channels],np.asarray(widths,dtype=float)[channels],self.dx)
+		self.smooth_y[channels]=C
+		self.der_y[channels]=np.nan
+		self.smooth_der[channels]=np.nan
+
+		peaks=_maxima(C,np.asarray(criteria,dtype=float)[channels],win_size,self.dx,self.discard)
+		for i in range(len(channels)):
+			self.peaks_x[channels[i]]=self.data_x[0]+peaks[i]
+
+
+	"""
+	High precision mode: a Lorentzian (with a constant offset) is fitted to the data around every found peak of all
+	channels, in a window of +/- half_width points. All the windows are fitted together (see "_fit_lorentzians").
+	The fits start from the peak positions that were just found (or from the maximum of the data in the window, if
+	the found peak is more than a width away from it), while the widths, amplitudes and offsets are taken
+	from the previous fits of the same channel (if it had the same number of peaks), so usually a few iterations are
+	enough. Otherwise they are estimated from the data in the window.
+
+	Peak positions are replaced by the fitted ones, and the widths (HWHM, in the units of data_x) and amplitudes are
+	saved in "peaks_width" and "peaks_amp". If a fit fails (the peak is outside of its window, or the width or the
+	amplitude is not positive) the peak stays where it was found and its width and amplitude are NaN.
+	"""
+	def fit_peaks(self,half_width,channels=None,iterations=5):
+
+		if channels is None:
+			channels=list(range(len(self)))
+
+		n=self.data_y.shape[1]
+		L=2*half_width+1
+
+		rows=[]
+		centers=[]
+		for i in channels:
+			for p in self.peaks_x[i]:
+				rows.append(i)
+				centers.append(p)
+
+		if len(rows)==0 or L>n or half_width<2:
+			return
+
+		rows=np.array(rows)
+		centers=np.array(centers)
+		offsets=np.clip(np.round((centers-self.data_x[0])/self.dx).astype(int)-half_width,0,n-L)
+
+		#X values are measured from the middle of the window.
+		mid=self.data_x[offsets+half_width]
+		u=np.arange(-half_width,half_width+1)*self.dx
+		u=np.broadcast_to(u,(len(rows),L))
+		Y=self.data_y[rows[:,None],offsets[:,None]+np.arange(L)]
+
+		p=np.empty((len(rows),4))
+		p[:,0]=centers-mid
+
+		warm=np.zeros(len(rows),dtype=bool)
+		for i in channels:
+			sel=rows==i
+			if len(self.fit_params[i])==np.count_nonzero(sel):
+				p[sel,1:]=self.fit_params[i][:,1:]
+				warm[sel]=True
+
+		if not np.all(warm):
+			c=np.min(Y[~warm],axis=1)
+			A=np.max(Y[~warm],axis=1)-c
+			g=np.count_nonzero(Y[~warm]-c[:,None]>A[:,None]/2,axis=1)*self.dx/2
+			p[~warm,1:]=np.column_stack((np.maximum(g,self.dx),A,c))
+
+		#If the found peak is more than a width away from the maximum of the data, the fit starts from the maximum.
+		top=u[0,np.argmax(Y,axis=1)]
+		far=np.abs(top-p[:,0])>p[:,1]
+		p[far,0]=top[far]
+
+		p,cost=_fit_lorentzians(u,Y,p,iterations)
+
+		good=np.all(np.isfinite(p),axis=1)&(np.abs(p[:,0])<=half_width*self.dx)&(p[:,1]>0)&(p[:,2]>0)
+
+		for i in channels:
+
+			sel=rows==i
+			if not np.any(sel):
+				self.fit_params[i]=np.zeros((0,4))
+				continue
+
+			ok=good[sel]
+			self.peaks_x[i]=np.where(ok,mid[sel]+p[sel,0],centers[sel])
+			self.peaks_width[i]=np.where(ok,p[sel,1],np.nan)
+			self.peaks_amp[i]=np.where(ok,p[sel,2],np.nan)
+			self.fit_params[i]=p[sel] if np.all(ok) else np.zeros((0,4))
+
+
+	"""
+	Peak tracking. When the lock is engaged, peaks move only by a few samples from one scan to the next, so instead of
+	filtering and searching the whole scan, only short windows around peaks from the previous scan are used. "previous"
+	is a list with the previous peak positions (in the units of data_x) for every channel and "half_width" is the
+	number of samples on both sides of the old position that is searched.
+
+	Every window is cut out of the data with some margin, so that the filters give the same values inside the window
+	as they would for the full scan. All windows (of all channels) have the same length and are filtered together as
+	one batch. Then, the zero crossings are found as in "_crossings" (with the same height criterion, which uses the
+	maximum of the whole scan) and their positions are obtained the same way as in "find_peaks".
+
+	A channel is tracked successfully only if it had peaks in the previous scan and the same number of peaks is found
+	again. The method returns a list of channels for which tracking failed (they have to be searched with "find_peaks").
+	"""
+	def track_peaks(self,criteria,win_size,previous,half_width):
+
+		n=self.data_y.shape[1]
+		lost=[i for i in range(len(self)) if i>=len(previous) or len(previous[i])==0]
+
+		#Margin: peak filter (10 points), smoothed derivative window and the points used for the linear fit.
+		margin=10+len(self.fltr.kernel(1,self.dx,2))//2+win_size+1
+		L=2*(half_width+margin)
+
+		rows=[]
+		centers=[]
+		for i in range(len(self)):
+			if i not in lost:
+				for p in previous[i]:
+					rows.append(i)
+					centers.append(int(round((p-self.data_x[0])/self.dx)))
+
+		if len(rows)==0 or L>n:
+			return list(range(len(self)))
+
+		rows=np.array(rows)
+		centers=np.array(centers)
+		offsets=np.clip(centers-half_width-margin,0,n-L)
+
+		W=self.data_y[rows[:,None],offsets[:,None]+np.arange(L)]
+		D=self.fltr.smooth_derivative(self.fltr.peak_filter(W),1,self.dx,half_size=2)
+
+		#Rising zero crossings inside the windows (j is the index of the crossing within the window).
+		j=np.arange(1,L)
+		g=offsets[:,None]+j
+		mask=(D[:,:-1]<0)&(D[:,1:]>0)&(j>=margin)&(j<L-margin)&(g>=max(int(self.discard*n),1))&(g<n-win_size)&(np.abs(g-centers[:,None])<=half_width)
+
+		r,j=np.nonzero(mask)
+		j+=1
+		g=offsets[r]+j
+
+		thresholds=np.asarray(criteria,dtype=float)*self.mx
+		win=np.arange(-win_size,win_size)
+		high=np.amax(self.data_y[rows[r][:,None],g[:,None]+win],axis=1)>thresholds[rows[r]]
+		r,j,g=r[high],j[high],g[high]
+
+		for i in range(len(self)):
+
+			if i in lost:
+				continue
+
+			#Windows can overlap, so the same crossing can be found twice.
+			sel=np.flatnonzero(rows[r]==i)
+			g_ch,first=np.unique(g[sel],return_index=True)
+			sel=sel[first]
+
+			keep=np.searchsorted(g_ch,_suppress(g_ch,20*win_size))
+			sel=sel[keep]
+
+			if len(sel)!=len(previous[i]):
+				lost.append(i)
+				continue
+
+			Y=D[r[sel][:,None],j[sel][:,None]+win]
+			self.peaks_x[i]=self.fltr.window_roots(self.data_x[g[sel]-win_size],Y,win_size,self.dx)
+
+		#Only the windows of the tracked channels were filtered, so their filtered signals (from older scans) are cleared.
+		tracked=[i for i in range(len(self)) if i not in lost]
+		self.smooth_y[tracked]=np.nan
+		self.der_y[tracked]=np.nan
+		self.smooth_der[tracked]=np.nan
+
+		return sorted(lost)
+
+
+
+"""
+Helper function fitting Lorentzians y=A/(1+((x-x0)/g)**2)+c to many windows at once. "u" are the X values of the
+windows (windows x points), Y the data and p the starting parameters (windows x 4: x0, g, A, c). Every iteration is
+one Levenberg-Marquardt step, done for all windows together: the 4x4 normal equations of all windows are solved
+in one call, and each window keeps its own damping, which is lowered after a successful step and raised (with the
+step rejected) otherwise. Starting close to the solution, a few iterations are enough. Returns the fitted
+parameters and the sum of squared residuals for every window.
+"""
+def _fit_lorentzians(u,Y,p,iterations=5):
+
+	p=np.array(p,dtype=float)
+	lam=np.full(len(p),1e-3)
+	diag=np.arange(4)
+
+	def residuals(p):
+		return Y-p[:,2,None]/(1+((u-p[:,0,None])/p[:,1,None])**2)-p[:,3,None]
+
+	J=np.empty(u.shape+(4,))
+	J[...,3]=1
+
+	with np.errstate(all='ignore'):
+
+		r=residuals(p)
+		cost=np.sum(r**2,axis=1)
+
+		for i in range(iterations):
+
+			z=(u-p[:,0,None])/p[:,1,None]
+			d=1/(1+z**2)
+
+			J[...,0]=2*p[:,2,None]*z*d**2/p[:,1,None]
+			J[...,1]=J[...,0]*z
+			J[...,2]=d
+
+			JT=J.transpose(0,2,1)
+			A=np.matmul(JT,J)
+			A[:,diag,diag]*=1+lam[:,None]
+			A[:,diag,diag]+=1e-12
+
+			step=np.linalg.solve(A,np.matmul(JT,r[...,None]))[...,0]
+			new_p=p+step
+			new_r=residuals(new_p)
+			new_cost=np.sum(new_r**2,axis=1)
+
+			better=new_cost<cost
+			p[better]=new_p[better]
+			r[better]=new_r[better]
+			cost[better]=new_cost[better]
+			lam=np.where(better,lam/10,lam*10)
+
+	return p,cost
+
+
+"""
+Helper function returning indices of the accepted zero crossings of the derivatives D (channels x samples) for
+every channel. It is equivalent to going over D point by point: all rising zero crossings (D[i-1]<0 and D[i]>0)
+are found at once, the ones where the data (data_y) is not higher than the channel's threshold are dropped, and
+finally the crossings that would have been skipped after a previously accepted peak (20*win_size points) are
+removed. Only the last step has to jump from one accepted peak to the next, so its cost depends on the number
+of peaks, not on the number of samples.
+"""
+def _crossings(D,data_y,thresholds,win_size,discard=0.25):
+
+	n=D.shape[1]
+	found=[np.array([],dtype=int) for i in range(D.shape[0])]
+
+	#We discard/ignore first 25% of the data (by default). Real scan introduces terrible noise there.
+	start=max(int(discard*n),1)
+	stop=n-win_size
+
+	if stop<=start:
+		return found
+
+	ch,ind=np.nonzero((D[:,start-1:stop-1]<0)&(D[:,start:stop]>0))
+	ind+=start
+
+	if len(ind)==0:
+		return found
+
+	win=np.arange(-win_size,win_size)
+	high=np.amax(data_y[ch[:,None],ind[:,None]+win],axis=1)>thresholds[ch]
+	ch,ind=ch[high],ind[high]
+
+	for c in np.unique(ch):
+		found[c]=_suppress(ind[ch==c],20*win_size)
+
+	return found
+
+
+"""
+Finds the maxima of correlations C (channels x samples) for "find_template_peaks": local maxima after the first
+"discard" part of the scan that are higher than criterion*(maximum of the channel), with 20*win_size points skipped after a
+peak. Returns a list of peak positions (one array per channel), measured from the first sample, refined to a
+fraction of a sample by a parabola through the maximum and its two neighbours.
+
+The same part of the scan is searched as in "_crossings": there, the zero crossing of the derivative after a maximum
+at sample m is at m+1, so the maxima from one sample before the discarded part to win_size+1 samples before the end
+are used. A peak right at the edge of the discarded part is then found by both peak engines.
+"""
+def _maxima(C,criteria,win_size,dx,discard=0.25):
+
+	n=C.shape[1]
+	start=max(int(discard*n),2)-1
+	stop=n-win_size-1
+
+	if stop<=start:
+		return [np.array([]) for i in range(C.shape[0])]
+
+	mask=(C[:,start:stop]>C[:,start-1:stop-1])&(C[:,start:stop]>=C[:,start+1:stop+1])
+	thresholds=criteria*np.max(C[:,start:],axis=1)
+
+	r,ind=np.nonzero(mask)
+	ind+=start
+	high=C[r,ind]>thresholds[r]
+	r,ind=r[high],ind[high]
+
+	result=[]
+	for i in range(C.shape[0]):
+
+		peaks=_suppress(ind[r==i],20*win_size)
+
+		a,b,c=C[i,peaks-1],C[i,peaks],C[i,peaks+1]
+		den=a-2*b+c
+		shift=np.where(den!=0,0.5*(a-c)/np.where(den!=0,den,1),0)
+
+		result.append((peaks+shift)*dx)
+
+	return result
+
+
+#Helper function taking sorted candidate indices and removing the ones that are within "skip" points after an accepted one.
+def _suppress(cand,skip):
+
+	accepted=[]
+	pos=0
+	while pos<len(cand):
+		accepted.append(cand[pos])
+		pos=np.searchsorted(cand,cand[pos]+skip,side='right')
+
+	return np.array(accepted,dtype=int)
+
+
+
+
 #################################################################################################################
 
 
@@ -662,6 +1248,14 @@ A helper class that defines multiple SG filters and a moving average. In the coe
 a smoothing window, the second one is first derivative, the third one is second derivative, and the last element can
 be used to obtained thrid derivative of the signal. These windows are convolved with the signal to obtain desired
 result. Finally, moving average is defined, which is a convolution with a special [1,1,...,1]/n window.
+
+All methods work on single signals and on (channels x samples) arrays, in which case every row is filtered. They can
+write the result to a given array ("out"), so arrays used for every scan can be allocated only once.
+
+Convolution windows are prepared once and cached. A derivative window followed by a moving average is also cached
+as one combined window, so smoothing the derivative takes a single convolution instead of two. All cached windows
+depend on the sample spacing, so they are dropped as soon as a different spacing is used (i.e. when the scan time
+or number of samples changes).
 """
 class Filter:
 
@@ -669,18 +1263,193 @@ class Filter:
 
 		self.coeffs=[[-2/21,3/21,6/21,7/21,6/21,3/21,-2/21],[-3/10,-1/5,-1/10,0,1/10,1/5,3/10],[5/42,0,-3/42,-4/42,-3/42,0,5/42],[-1/6,1/6,1/6,0,-1/6,-1/6,1/6]]
 
-	def apply(self,signal,der,sp): #Make it more efficient with np.convolve!
+		#Scratch array used by the peak filter. It only grows, so it's allocated again only for larger data than ever before.
+		self._scratch=np.empty(0)
+
+		#Cached convolution windows, kept for every (der,sp,half_size), and spacing they were prepared for
+		self._kernels={}
+		self._sp=None
+
+		#Cached spectra of correlation templates, kept for every (nfft,width,sp)
+		self._templates={}
 
-		C=self.coeffs[der][:]
-		if der>1:
-			C=[c/sp**der for c in C]
+		#Least squares weights used to find zero crossings, kept for every (win_size,dx)
+		self._lsq_weights={}
 
-		return np.convolve(signal,C,"same")
+	def apply(self,signal,der,sp,out=None):
+
+		return self._convolve(signal,self.kernel(der,sp),out)
 
 	def moving_avg(self,data,half_size=3):
 
-		return np.divide(np.convolve(data,np.ones(2*half_size+1),"same"),2*half_size+1)
+		return np.divide(self._convolve(data,np.ones(2*half_size+1)),2*half_size+1)
+
+
+	"""
+	Derivative (or smoothing for der=0) followed by a moving average of a given half size, done as one convolution
+	with the combined window. It gives the same result as calling "apply" and then "moving_avg" (up to rounding).
+	Only the first and last "half_size" points would differ, because the derivative is not cut to zero outside
+	the data before averaging, so these few points are redone the old way on short pieces of the signal.
+	"""
+	def smooth_derivative(self,signal,der,sp,half_size=2,out=None):
+
+		signal=np.asarray(signal,dtype=float)
+		out=self._convolve(signal,self.kernel(der,sp,half_size),out)
+
+		m=2*half_size+len(self.coeffs[der])
+		if half_size>0 and signal.shape[-1]>m:
+			out[...,:half_size]=self.moving_avg(self.apply(signal[...,:m],der,sp),half_size)[...,:half_size]
+			out[...,-half_size:]=self.moving_avg(self.apply(signal[...,-m:],der,sp),half_size)[...,-half_size:]
+
+		return out
+
+
+	#Cached convolution window of given derivative order, combined with a moving average if half_size>0.
+	def kernel(self,der,sp,half_size=0):
+
+		self._use_spacing(sp)
+
+		if (der,sp,half_size) not in self._kernels:
+
+			C=np.array(self.coeffs[der])
+			if der>1:
+				C=C/sp**der
+
+			if half_size>0:
+				C=np.convolve(C,np.full(2*half_size+1,1/(2*half_size+1)))
+
+			self._kernels[(der,sp,half_size)]=C
+
+		return self._kernels[(der,sp,half_size)]
+
+
+	"""
+	Cross-correlation of the signal with a Lorentzian y=1/(1+(x/width)**2) (for (channels x samples) data, "width"
+	is a list with a width for every row). It is done with FFT, with the spectra of the templates cached for every
+	(FFT length, width, sp). The template is cut at +/-10 widths and its mean is subtracted, so a constant offset of
+	the signal doesn't change the result. The data is padded with zeros, so the correlation is not circular, and the
+	FFT is long enough for the whole template even if it's longer than the data.
+	"""
+	def correlate(self,data,width,sp):
+
+		data=np.asarray(data,dtype=float)
+		widths=np.broadcast_to(np.asarray(width,dtype=float),data.shape[:-1])
+
+		n=data.shape[-1]
+		J=int(np.ceil(10*np.max(widths)/sp))
+		nfft=fft.next_fast_len(max(n,J)+J+1,real=True)
+
+		T=np.empty(data.shape[:-1]+(nfft//2+1,),dtype=complex)
+		for ind in np.ndindex(widths.shape):
+			T[ind]=self.template_spectrum(nfft,float(widths[ind]),sp)
+
+		return fft.irfft(fft.rfft(data,nfft,axis=-1)*T,nfft,axis=-1)[...,:n]
+
+
+	#Cached (conjugated) spectrum of the Lorentzian template used by "correlate".
+	def template_spectrum(self,nfft,width,sp):
+
+		self._use_spacing(sp)
+
+		if (nfft,width,sp) not in self._templates:
+
+			t=np.fft.fftfreq(nfft,1/nfft)*sp
+			support=np.abs(t)<=10*width
+
+			template=np.zeros(nfft)
+			template[support]=1/(1+(t[support]/width)**2)
+			template[support]-=np.mean(template[support])
+
+			self._templates[(nfft,width,sp)]=np.conj(fft.rfft(template))
+
+		return self._templates[(nfft,width,sp)]
+
+
+	#Drops all cached windows, templates and least squares weights.
+	def clear_cache(self):
+		self._kernels={}
+		self._templates={}
+		self._lsq_weights={}
+		self._sp=None
+
+
+	#Everything cached is prepared for one sample spacing. If the spacing changes, the cache is cleared.
+	def _use_spacing(self,sp):
+		if sp!=self._sp:
+			self.clear_cache()
+			self._sp=sp
+
+
+	#Convolution in "same" mode (zeros outside the data) along the last axis. Result is written to "out" if given.
+	def _convolve(self,data,C,out=None):
+
+		if np.ndim(data)==1 and out is None:
+			return np.convolve(data,C,"same")
+
+		return ndimage.convolve1d(np.asarray(data,dtype=float),C,axis=-1,output=out,mode='constant')
+
+
+	"""
+	Nonlinear filter enhancing peaks: y[i]=x[i]**2-x[i-k]*x[i+k], with the first and last k points left untouched.
+	It is computed on array slices (along the last axis). The result is written to "out" if given (it has to have
+	the same shape as the data), otherwise a new array is created. The product of the shifted slices goes to
+	a scratch array that is kept between calls (and reused for data of any shape that fits), so with "out" given
+	nothing is allocated. The square is an exactly rounded x*x; the old per-point version used numpy's scalar x**2,
+	which goes through pow() and can be off by one in the last bit for about 0.1% of the points, so the two agree
+	to the last bit otherwise.
+	"""
+	def peak_filter(self,data,k=10,out=None):
+
+		data=np.asarray(data,dtype=float)
+		n=data.shape[-1]
+
+		if out is None:
+			out=np.empty(data.shape)
+
+		out[...,:k]=data[...,:k]
+		out[...,n-k:]=data[...,n-k:]
+
+		shape=data.shape[:-1]+(n-2*k,)
+		size=int(np.prod(shape))
+		if self._scratch.size<size:
+			self._scratch=np.empty(size)
+		scratch=self._scratch[:size].reshape(shape)
+
+		np.multiply(data[...,:n-2*k],data[...,2*k:],out=scratch)
+		np.square(data[...,k:n-k],out=out[...,k:n-k])
+		np.subtract(out[...,k:n-k],scratch,out=out[...,k:n-k])
+
+		return out
+
+
+	"""
+	Zero crossings of linear functions fitted to 2*win_size points of D around every index in "ind" (points from
+	i-win_size to i+win_size-1, as in Signal.find_peaks). For equally spaced x, the least squares slope and the
+	mean of D are just dot products of the window with fixed weights, so all the windows are stacked into one
+	array and solved with two matrix products. This gives the same result as calling np.polyfit for every
+	window (up to rounding), without building and solving the fit each time.
+	"""
+	def linear_roots(self,x,D,ind,win_size,dx):
+
+		ind=np.asarray(ind,dtype=int)
+		if len(ind)==0:
+			return np.array([])
+
+		return self.window_roots(np.asarray(x)[ind-win_size],np.asarray(D)[ind[:,None]+np.arange(-win_size,win_size)],win_size,dx)
+
+
+	#Zero crossings of lines fitted to rows of Y (2*win_size points each), where x0 are x values of first points of the rows.
+	def window_roots(self,x0,Y,win_size,dx):
+
+		if len(Y)==0:
+			return np.array([])
+
+		self._use_spacing(dx)
+
+		if (win_size,dx) not in self._lsq_weights:
+			u=np.arange(2*win_size)-(2*win_size-1)/2
+			self._lsq_weights[(win_size,dx)]=(u/(dx*np.sum(u**2)),np.full(2*win_size,1/(2*win_size)),dx*(2*win_size-1)/2)
 
+		w_slope,w_mean,x_mid=self._lsq_weights[(win_size,dx)]
 
-	def peak_filter(self,data,k=10):
-		return np.concatenate((np.concatenate((data[:k],[data[i]**2-data[i-k]*data[i+k] for i in range(k,len(data)-k)])),data[-k:]))
+		return x0+x_mid-np.dot(Y,w_mean)/np.dot(Y,w_slope)
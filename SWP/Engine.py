@@ -0,0 +1,266 @@
+import logging
+from threading import Thread, Condition, Event
+from collections import deque
+
+
+"""
+This file contains the lock engine, which runs the transfer lock (TransferLock, with its Lock and DAQ_tasks objects)
+without any GUI. The scan loop (acquisition, peak finding and feedback) runs in its own thread and, after every scan,
+publishes the state of the lock as a LockSnapshot. Subscribers (the GUI, the network interface, loggers...) get the
+snapshots from another thread (the dispatcher), so nothing they do, e.g. redrawing plots, delays the next feedback.
+
+Copying the acquired data and the error histories costs time proportional to their length, so it's done only for
+the snapshots that are needed for plotting: a snapshot is a "frame" (has them) only if one was asked for with
+"request_frame" since the last frame. The other snapshots have only the values of the last scan.
+
+There are two kinds of subscribers:
+	-	usual ones get only the newest snapshot: if they are slower than the scans, the snapshots they didn't get to
+		are skipped,
+	-	loggers ("every=True") get all the snapshots in order (up to 10000 can wait for them).
+
+The newest snapshot is also kept in "snapshot" and the newest frame in "frame", so they can be polled instead (the GUI
+polls frames from the Tk thread at a fixed frame rate and asks for the next one every time). Snapshots are never
+changed after they're published, so they can be read from any thread.
+"""
+
+
+#We might need to log some things directly.
+log=logging.getLogger(__name__)
+
+
+"""
+State of the lock after one scan. All the values are copies, so they don't change when the next scan is processed.
+It's filled in by TransferLock.snapshot. The acquired data and the histories of the errors are there only if the
+snapshot is a frame (see above), otherwise they're None.
+"""
+class LockSnapshot:
+
+	def __init__(self):
+
+		#Number of the scan since the scan was started, time when it was processed and average scanning frequency.
+		self.counter=0
+		self.timestamp=0.
+		self.scan_frequency=0.
+		self.frame=False
+
+		#Acquired data (channels x samples) with its X values and the scan settings.
+		self.time_samples=None
+		self.pd_data=None
+		self.scan_time=0.
+		self.scan_offset=0.
+		self.laser_voltages=[]
+
+		#Lockpoints as X positions in the plot of the data (master first).
+		self.lockpoints_x=[]
+
+		"""
+		Cavity lock. "two_peaks" tells if the master signal had exactly 2 peaks, "valid" if the lock was engaged and
+		had them (only then the error is updated). "err_mhz" is the last error added to the history, which is an array
+		(oldest first).
+		"""
+		self.master_lock_engaged=False
+		self.master_two_peaks=False
+		self.master_valid=False
+		self.master_locked=False
+		self.master_err=0.
+		self.master_err_rms=0.
+		self.master_err_mhz=0.
+		self.master_history=None
+		self.master_history_range=(0.,0.)
+
+		#Slave lasers, one value (or array) per laser. Frequencies are NaN if they weren't measured in this scan.
+		self.slave_locks_engaged=[]
+		self.slave_locked=[]
+		self.slave_errs=[]
+		self.slave_err_rms=[]
+		self.slave_histories=[]
+		self.slave_history_ranges=[]
+		self.slave_Rs=[]
+		self.slave_lockpoints=[]
+		self.slave_frequencies=[]
+		self.slave_abs_lockpoints=[]
+		self.slave_powers=[]
+
+
+
+"""
+The engine. It's created for a TransferLock object; "start" starts the scan loop in a new thread, "stop" stops it
+after the scan in progress (with "wait" it also waits until the tasks are stopped).
+"""
+class LockEngine:
+
+	def __init__(self,transfer_lock):
+
+		self.transfer_lock=transfer_lock
+		self.lock=transfer_lock.lock
+		self.daq_tasks=transfer_lock.daq_tasks
+
+		#Newest snapshot (also after it was dispatched) and newest frame (see request_frame).
+		self.snapshot=None
+		self.frame=None
+		self._frame_wanted=Event()
+
+		self._subscribers=[]
+		self._loggers=[]
+
+		#Snapshots waiting for the dispatcher: the newest one for usual subscribers and all of them for loggers.
+		self._new=Condition()
+		self._pending=None
+		self._pending_log=deque(maxlen=10000)
+
+		self._scan_thread=None
+		self._stopping=False
+		self._dispatcher=Thread(target=self._dispatch_loop,daemon=True)
+		self._dispatcher.start()
+
+
+	#Adds a subscriber: a function taking a LockSnapshot. With every=True it gets all the snapshots (see above).
+	def subscribe(self,callback,every=False):
+
+		with self._new:
+			if every:
+				self._loggers.append(callback)
+			else:
+				self._subscribers.append(callback)
+
+
+	def unsubscribe(self,callback):
+
+		with self._new:
+			if callback in self._subscribers:
+				self._subscribers.remove(callback)
+			if callback in self._loggers:
+				self._loggers.remove(callback)
+
+
+	@property
+	def running(self):
+		return self._scan_thread is not None and self._scan_thread.is_alive()
+
+
+	"""
+	Starts the scan loop (if it's not running already). If the loop was stopped, but it's still finishing its last
+	scan, it's waited for first, so that it doesn't end the new loop (or run along with it).
+	"""
+	def start(self):
+
+		if self.running:
+			if not self._stopping:
+				return
+			self._scan_thread.join()
+
+		self._stopping=False
+		self.transfer_lock.start_scan()
+		self._scan_thread=Thread(target=self.transfer_lock.scan,kwargs={"publish":self.publish,"frames":self._frame_requested},daemon=True)
+		self._scan_thread.start()
+
+
+	#Stops the scan loop after the scan in progress. With wait=True it returns once the loop has ended.
+	def stop(self,wait=False,timeout=None):
+
+		self._stopping=True
+		self.transfer_lock.stop_scan()
+
+		if wait and self.running:
+			self._scan_thread.join(timeout)
+
+
+	"""
+	Engaging and disengaging the locks (the same changes to the lock as done by the buttons of the GUI). A slave
+	laser's lock can be engaged only when the cavity lock is, and disengaging the cavity lock disengages them too.
+	"""
+	def engage_cavity_lock(self):
+		self.transfer_lock.master_lock_engaged=True
+
+
+	def disengage_cavity_lock(self):
+
+		for i in range(len(self.transfer_lock.slave_locks_engaged)):
+			self.disengage_laser_lock(i)
+
+		self.transfer_lock.master_lock_engaged=False
+		self.transfer_lock.master_locked_flag=False
+		self.transfer_lock.reset_master_error()
+		self.lock.master_err=0
+		self.lock.master_err_prev=0
+		self.lock.master_ctrl=0
+
+
+	def engage_laser_lock(self,ind):
+
+		if not self.transfer_lock.master_lock_engaged:
+			raise RuntimeError('The cavity lock has to be engaged first.')
+
+		self.lock.slave_sectors[ind]=0
+		self.transfer_lock.slave_locks_engaged[ind]=True
+
+
+	def disengage_laser_lock(self,ind):
+
+		self.transfer_lock.slave_locks_engaged[ind]=False
+		self.transfer_lock.slave_locked_flags[ind].clear()
+		self.transfer_lock.reset_slave_error(ind)
+		self.lock.slave_errs[ind]=0
+		self.lock.slave_errs_prev[ind]=0
+		self.lock.slave_ctrls[ind]=0
+
+
+	#Asks for the next snapshot to be a frame (with the acquired data and the error histories).
+	def request_frame(self):
+		self._frame_wanted.set()
+
+
+	#Called by the scan loop before every snapshot: tells if it should be a frame (and takes the request).
+	def _frame_requested(self):
+
+		if not self._frame_wanted.is_set():
+			return False
+
+		self._frame_wanted.clear()
+		return True
+
+
+	#Called by the scan loop after every scan. It only hands the snapshot over to the dispatcher.
+	def publish(self,snapshot):
+
+		with self._new:
+			self.snapshot=snapshot
+			if snapshot.frame:
+				self.frame=snapshot
+			self._pending=snapshot
+			if self._loggers:
+				self._pending_log.append(snapshot)
+			self._new.notify()
+
+
+	#Dispatcher thread: waits for new snapshots and passes them to the subscribers.
+	def _dispatch_loop(self):
+
+		while True:
+
+			with self._new:
+				while self._pending is None and not self._pending_log:
+					self._new.wait()
+
+				snapshot=self._pending
+				self._pending=None
+				logged=list(self._pending_log)
+				self._pending_log.clear()
+				subscribers=list(self._subscribers)
+				loggers=list(self._loggers)
+
+			for snap in logged:
+				for callback in loggers:
+					self._call(callback,snap)
+
+			if snapshot is not None:
+				for callback in subscribers:
+					self._call(callback,snapshot)
+
+
+	#Errors of subscribers are only logged, so that one subscriber can't stop the others (or the lock).
+	def _call(self,callback,snapshot):
+		try:
+			callback(snapshot)
+		except Exception as e:
+			log.warning(e)
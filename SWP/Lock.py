@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from collections import deque
 from scipy import interpolate
 from statistics import mean, stdev
@@ -73,6 +72,9 @@ class Lock:
 		if len(wvls)>1:
 			self.int_gain.append(float(cfg['LASER2']['IGain']))
 
+		#Factor multiplying all gains. It's lowered when the feedback is applied later (see TransferLock.scan).
+		self.gain_scale=1.
+
 		#Interval between master peaks (t2-t1)
 		self.interval=0 #ms
 
@@ -300,12 +302,13 @@ class Lock:
 		approximate the scan time with the distance between two peaks of the master signal, which should be at two ends of the scan.
 		This can, however, quite easily be changed if necessary.
 	The various numerical coeffiicients are there to make the feedback loop work correctly for gains of the order of 1 (so they basically
-	rescale the parameters). This can be changed, but once set, it should not be touched.
+	rescale the parameters). This can be changed, but once set, it should not be touched. Both gains are multiplied by "gain_scale",
+	which is 1 unless the feedback is delayed by an extra scan (pipelined and continuous acquisition modes).
 	"""
 	def refresh_master_control(self):
-		self.master_ctrl=(self.master_ctrl+0.05*self.prop_gain[0]*(self.master_err-self.master_err_prev)+self.int_gain[0]*self.master_err*self.interval/10000)
+		self.master_ctrl=(self.master_ctrl+self.gain_scale*(0.05*self.prop_gain[0]*(self.master_err-self.master_err_prev)+self.int_gain[0]*self.master_err*self.interval/10000))
 
 
 
 	def refresh_slave_control(self,i):
-		self.slave_ctrls[i]=self.slave_ctrls[i]+0.05*self.prop_gain[i+1]*(self.slave_errs[i]-self.slave_errs_prev[i])+self.int_gain[i+1]*self.slave_errs[i]*self.interval/10000
+		self.slave_ctrls[i]=self.slave_ctrls[i]+self.gain_scale*(0.05*self.prop_gain[i+1]*(self.slave_errs[i]-self.slave_errs_prev[i])+self.int_gain[i+1]*self.slave_errs[i]*self.interval/10000)
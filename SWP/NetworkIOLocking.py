@@ -379,6 +379,22 @@ class NetworkIOLocking:
         self.thread_influxdb.start()
         self.thread_influxdb.active.set()
 
+    def update_lock_state(self, snap):
+        """
+        Subscriber of the lock engine: copies the state of the locks from the
+        newest snapshot (see Engine.py). Errors and frequencies are NaN for
+        the locks that are not running.
+        """
+        self.master_locked_flag = snap.master_lock_engaged and snap.master_locked
+        self.master_err = snap.master_err_mhz if snap.master_valid else np.nan
+
+        for j in range(len(snap.slave_locks_engaged)):
+            running = snap.master_valid and snap.slave_locks_engaged[j]
+            self.slave_locked_flags[j] = running
+            self.slave_err[j] = snap.slave_errs[j] if running else np.nan
+            self.slave_frequency[j] = snap.slave_frequencies[j] if running else np.nan
+            self.slave_lockpoint[j] = snap.slave_abs_lockpoints[j]
+
     @property
     def data_server(self):
         return {
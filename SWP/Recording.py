@@ -0,0 +1,174 @@
+import numpy as np
+import h5py
+import os
+import queue
+from threading import Thread, Lock
+from time import time, strftime
+
+
+"""
+This file contains classes for recording raw scans (data from the photodetectors, as acquired by DAQ_tasks) into an
+HDF5 file and for reading them back (see ReplayBackend in Backends.py, which feeds recorded scans to the lock loop).
+
+The file contains datasets (one row per scan):
+	PD_data			-	(scans x channels x samples), float32
+	Time			-	time of acquisition (seconds since epoch)
+	ScanOffset		-	scan offset written for the scan
+	LaserVoltages	-	(scans x lasers) voltages applied to the slave lasers during the scan
+and attributes describing the scan (ScanTime, ScanSamples, Waveform, SettleSamples, AcquisitionMode, Channels).
+
+The datasets are chunked by "chunk" scans. Scans are collected in memory and every full chunk is written by a separate
+thread, so the lock loop doesn't wait for the disk. An existing file is never overwritten (FileExistsError is raised,
+see unused_filename). Scans are recorded by the scanning thread while the recording can be stopped from another one,
+so recording a scan and closing the file are done under a lock; scans recorded after the file is closed are ignored.
+"""
+class ScanRecorder:
+
+	def __init__(self,filename,channels,n_samples,n_lasers,attrs=None,chunk=64,compression=None):
+
+		self.filename=filename
+		self.chunk=chunk
+		self.n_scans=0
+		self._shape=(channels,n_samples)
+		self._n_lasers=n_lasers
+
+		self._file=h5py.File(filename,'x')
+		self._file.create_dataset('PD_data',shape=(0,channels,n_samples),maxshape=(None,channels,n_samples),chunks=(chunk,channels,n_samples),dtype='f4',compression=compression)
+		self._file.create_dataset('Time',shape=(0,),maxshape=(None,),chunks=(chunk,),dtype='f8')
+		self._file.create_dataset('ScanOffset',shape=(0,),maxshape=(None,),chunks=(chunk,),dtype='f8')
+		self._file.create_dataset('LaserVoltages',shape=(0,n_lasers),maxshape=(None,n_lasers),chunks=(chunk,n_lasers),dtype='f8')
+
+		if attrs is not None:
+			for key in attrs:
+				self._file.attrs[key]=attrs[key]
+
+		self._new_block()
+
+		#Full blocks waiting to be written (None stops the writing thread).
+		self._blocks=queue.Queue()
+		self._writer=Thread(target=self._write_loop,daemon=True)
+		self._writer.start()
+
+		self._lock=Lock()
+
+
+	#Adds a scan. Data is (channels x samples), voltages are the voltages applied to the lasers.
+	def record(self,data,offset,voltages,timestamp=None):
+
+		with self._lock:
+
+			if self._file is None:
+				return
+
+			i=self._filled
+			self._data[i]=data
+			self._time[i]=time() if timestamp is None else timestamp
+			self._offset[i]=offset
+			self._voltages[i]=voltages
+
+			self._filled+=1
+			self.n_scans+=1
+
+			if self._filled==self.chunk:
+				self._blocks.put((self._data,self._time,self._offset,self._voltages,self._filled))
+				self._new_block()
+
+
+	#Writes the remaining scans and closes the file.
+	def close(self):
+
+		with self._lock:
+
+			if self._file is None:
+				return
+
+			if self._filled>0:
+				self._blocks.put((self._data,self._time,self._offset,self._voltages,self._filled))
+
+			self._blocks.put(None)
+			self._writer.join()
+
+			self._file.close()
+			self._file=None
+
+
+	#New arrays for the next block (the full ones are owned by the writing thread until they're written).
+	def _new_block(self):
+
+		self._data=np.empty((self.chunk,)+self._shape,dtype=np.float32)
+		self._time=np.empty(self.chunk)
+		self._offset=np.empty(self.chunk)
+		self._voltages=np.empty((self.chunk,self._n_lasers))
+		self._filled=0
+
+
+	def _write_loop(self):
+
+		while True:
+			block=self._blocks.get()
+			if block is None:
+				break
+
+			*arrays,n=block
+			start=self._file['Time'].shape[0]
+
+			for name,values in zip(('PD_data','Time','ScanOffset','LaserVoltages'),arrays):
+				self._file[name].resize(start+n,axis=0)
+				self._file[name][start:]=values[:n]
+
+			self._file.flush()
+
+
+
+#The filename, or if such file exists, the filename with the current time added (e.g. scans_20240131-120000.hdf5).
+def unused_filename(filename):
+
+	if not os.path.exists(filename):
+		return filename
+
+	root,ext=os.path.splitext(filename)
+	return root+strftime('_%Y%m%d-%H%M%S')+ext
+
+
+
+"""
+Reader of the recorded scans. Scans are read from the file one chunk at a time, so reading them in order costs one
+read from the disk per chunk.
+"""
+class ScanReplay:
+
+	def __init__(self,filename):
+
+		self.filename=filename
+		self._file=h5py.File(filename,'r')
+
+		self.attrs=dict(self._file.attrs)
+		self.n_scans,self.channels,self.n_samples=self._file['PD_data'].shape
+		self.chunk=self._file['PD_data'].chunks[0] if self._file['PD_data'].chunks is not None else 64
+
+		self._block_start=-1
+		self._block=np.zeros((0,self.channels,self.n_samples))
+
+
+	def __len__(self):
+		return self.n_scans
+
+
+	#Data of the scan of given index (channels x samples).
+	def scan(self,ind):
+
+		start=ind-ind%self.chunk
+		if start!=self._block_start:
+			self._block=self._file['PD_data'][start:start+self.chunk].astype(float)
+			self._block_start=start
+
+		return self._block[ind-start]
+
+
+	#Time, scan offset and laser voltages recorded with the scan of given index.
+	def controls(self,ind):
+		return self._file['Time'][ind],self._file['ScanOffset'][ind],self._file['LaserVoltages'][ind]
+
+
+	def close(self):
+		self._file.close()
@@ -0,0 +1,172 @@
+import numpy as np
+
+
+"""
+This file contains the model of the cavity transmission that is used to simulate the data read from photodetectors
+(see DAQ_tasks.simulate_scan). All channels of one scan are computed at once, as (channels x samples) arrays: the
+transmission peaks are Lorentzians evaluated on the whole time axis by broadcasting, so the cost of a simulated scan
+is small compared to the processing of the scan, even for thousands of samples.
+
+On top of the peaks the model can add:
+	-	white noise and coloured (1/f^alpha) noise, separately for every channel,
+	-	drift of the cavity (moves all peaks) and of the lasers (moves the peaks of one slave laser), as random walks
+		with one step per scan,
+	-	nonlinearity of the piezo: the cavity length is not proportional to the scan voltage, so the peaks are not
+		moved uniformly when the scan offset changes,
+	-	hysteresis of the piezo: with the triangle scan, the peaks in the falling half are shifted compared to the
+		rising half.
+
+Settings are read from the [DAQ] section of the config file (keys starting with "Sim", see setup_model).
+"""
+class CavityModel:
+
+	"""
+	Amplitudes and widths (half widths in samples) are given for the master and slave lasers' peaks, noise levels for
+	every channel (master first, the last value is used for any further channels). Drifts are standard deviations of
+	the steps per scan in fractions of the scan, the nonlinearity is the relative deviation of the piezo from linear
+	in the middle of the scan and the hysteresis is the shift of the peaks in the falling half of the triangle scan
+	in fractions of the half of the scan.
+	"""
+	def __init__(self,amplitudes=(0.01,0.002),widths=(2,1),noise=(0.002,0.001,0.0015),colored_noise=0,noise_exponent=1,cavity_drift=0,laser_drift=0,nonlinearity=0,hysteresis=0,seed=None):
+
+		self.amplitudes=tuple(amplitudes)
+		self.widths=tuple(widths)
+		self.noise=tuple(noise)
+		self.colored_noise=colored_noise
+		self.noise_exponent=noise_exponent
+		self.cavity_drift=cavity_drift
+		self.laser_drift=laser_drift
+		self.nonlinearity=nonlinearity
+		self.hysteresis=hysteresis
+
+		self._rng=np.random.default_rng(seed)
+
+		#Current shifts (in fractions of the scan) caused by the drifts.
+		self.cavity_shift=0.
+		self.laser_shifts=np.zeros(0)
+
+		#Time axis (warped by the nonlinearity) and the noise filter, kept for the last number of samples and scan time.
+		self._axis_key=None
+		self._axis=np.zeros(0)
+		self._filter_key=None
+		self._filter=np.zeros(0)
+
+
+	"""
+	Simulates one scan of n_samples taking scan_time (ms). Master peaks are at given positions (ms), slave lasers
+	have their peak at given positions (ms) and two sidebands "sideband" (ms) away from it. Returns an array
+	(1+number of slave lasers, n_samples).
+
+	For the falling half of the triangle scan ("falling"), the peaks are shifted by the hysteresis and the drifts
+	don't move, as it's still the same scan. The data is returned in the order of the rising half.
+	"""
+	def scan(self,n_samples,scan_time,master_positions,slave_positions,sideband,falling=False):
+
+		n_slaves=len(slave_positions)
+		step=scan_time/n_samples
+
+		if not falling:
+			self._drift(n_slaves)
+
+		#Positions, amplitudes and widths of all peaks (channels x peaks), master has only two of the three peaks.
+		positions=np.empty((1+n_slaves,3))
+		positions[0,:2]=master_positions
+		positions[0,2]=0
+		positions[1:]=np.asarray(slave_positions,dtype=float)[:,None]+np.array([0,sideband,-sideband])
+		positions[1:]+=self.laser_shifts[:,None]*scan_time
+		positions+=self.cavity_shift*scan_time
+		if falling:
+			positions+=self.hysteresis*scan_time
+
+		amplitudes=np.full((1+n_slaves,3),self.amplitudes[1])
+		amplitudes[0]=(self.amplitudes[0],self.amplitudes[0],0)
+
+		widths=np.full((1+n_slaves,1),self.widths[1]*step)
+		widths[0]=self.widths[0]*step
+
+		diff=self._time_axis(n_samples,scan_time)-positions[:,:,None]
+		np.multiply(diff,diff,out=diff)
+		diff+=(widths*widths)[:,:,None]
+
+		data=np.einsum('cp,cpn->cn',amplitudes,np.reciprocal(diff,out=diff))
+		data+=self._noise(data.shape)
+
+		return data
+
+
+	#Moves the drifting peaks by one step of the random walks.
+	def _drift(self,n_slaves):
+
+		if len(self.laser_shifts)!=n_slaves:
+			self.laser_shifts=np.zeros(n_slaves)
+
+		if self.cavity_drift>0:
+			self.cavity_shift+=self.cavity_drift*self._rng.standard_normal()
+		if self.laser_drift>0:
+			self.laser_shifts+=self.laser_drift*self._rng.standard_normal(n_slaves)
+
+
+	"""
+	Times (ms) of the samples as seen by the cavity. With the nonlinearity k, the time t is mapped to t+k*4*t*(t-T)/T,
+	which keeps the beginning and the end of the scan in place and moves its middle by k*T.
+	"""
+	def _time_axis(self,n_samples,scan_time):
+
+		if self._axis_key!=(n_samples,scan_time,self.nonlinearity):
+			self._axis_key=(n_samples,scan_time,self.nonlinearity)
+			t=np.linspace(0,scan_time,num=n_samples)
+			self._axis=t+self.nonlinearity*4*t*(t-scan_time)/scan_time
+
+		return self._axis
+
+
+	#White noise plus coloured noise (white noise shaped by 1/f^(alpha/2) in amplitude) for every channel.
+	def _noise(self,shape):
+
+		channels,n_samples=shape
+		levels=np.array([self.noise[min(i,len(self.noise)-1)] for i in range(channels)])
+
+		noise=self._rng.standard_normal(shape)*levels[:,None]
+
+		if self.colored_noise>0:
+			spectrum=np.fft.rfft(self._rng.standard_normal(shape),axis=1)
+			spectrum*=self._noise_filter(n_samples)
+			noise+=self.colored_noise*np.fft.irfft(spectrum,n=n_samples,axis=1)
+
+		return noise
+
+
+	#Filter shaping the spectrum of the coloured noise, normalised so that the noise has standard deviation 1.
+	def _noise_filter(self,n_samples):
+
+		if self._filter_key!=(n_samples,self.noise_exponent):
+			self._filter_key=(n_samples,self.noise_exponent)
+			f=np.fft.rfftfreq(n_samples)
+			fltr=np.zeros(len(f))
+			fltr[1:]=f[1:]**(-self.noise_exponent/2)
+
+			#Power of all frequencies (the ones between 0 and Nyquist frequency appear twice in the full spectrum).
+			power=2*np.sum(fltr**2)-fltr[0]**2-(fltr[-1]**2 if n_samples%2==0 else 0)
+			self._filter=fltr/np.sqrt(power/n_samples)
+
+		return self._filter
+
+
+	#Settings of the model as the config file keys (see setup_model).
+	def settings(self):
+
+		return {"SimAmplitudes":",".join(str(a) for a in self.amplitudes),"SimWidths":",".join(str(w) for w in self.widths),"SimNoise":",".join(str(s) for s in self.noise),"SimColoredNoise":self.colored_noise,"SimNoiseExponent":self.noise_exponent,"SimCavityDrift":self.cavity_drift,"SimLaserDrift":self.laser_drift,"SimPiezoNonlinearity":self.nonlinearity,"SimPiezoHysteresis":self.hysteresis}
+
+
+
+#Creates the model using the [DAQ] section of the config file. Missing keys have the default values.
+def setup_model(cfg):
+
+	sec=cfg['DAQ']
+
+	return CavityModel(amplitudes=_floats(sec.get('SimAmplitudes','0.01,0.002')),widths=_floats(sec.get('SimWidths','2,1')),noise=_floats(sec.get('SimNoise','0.002,0.001,0.0015')),colored_noise=float(sec.get('SimColoredNoise','0')),noise_exponent=float(sec.get('SimNoiseExponent','1')),cavity_drift=float(sec.get('SimCavityDrift','0')),laser_drift=float(sec.get('SimLaserDrift','0')),nonlinearity=float(sec.get('SimPiezoNonlinearity','0')),hysteresis=float(sec.get('SimPiezoHysteresis','0')))
+
+
+#Helper function reading comma-separated numbers.
+def _floats(text):
+	return tuple(float(x) for x in text.split(","))
@@ -4,6 +4,7 @@ from tkinter import ttk
 import matplotlib
 import matplotlib.animation as animation
 matplotlib.use("TkAgg")
+import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.gridspec import GridSpec
 import threading
@@ -15,6 +16,8 @@ import os
 from .Config import *
 from .Devices import *
 from .Data_acq import *
+from .Engine import LockEngine
+from .Themes import Colors
 from .WavemeterFiberSwitch.WavemeterFiberswitchSocketClient import WavemeterFiberswitchSocketClient
 
 from .NetworkIOLocking import *
@@ -112,6 +115,11 @@ class GUI:
 		except:
 			pass
 
+		try:
+			self.ld.TC.transfer_lock.daq_tasks.stop_recording()
+		except:
+			pass
+
 		try:
 			del self.ld.TC.transfer_lock.daq_tasks
 		except:
@@ -718,6 +726,20 @@ class TransferCavity:
 
 		self.transfer_lock=TransferLock(self.lock,setup_tasks(config,len(self.lasers),simulate),config)
 
+		"""
+		Lock engine. It runs the scan loop of the transfer lock in its own thread and publishes the state of the lock
+		after every scan. The network interface and the error logging are its subscribers, so updating them doesn't
+		delay the feedback. This window instead shows the newest snapshot at a fixed frame rate ("RefreshRate" in
+		the [CAVITY] section, in fps; see "refresh"), so the cost of the GUI doesn't grow with the scanning frequency.
+		"""
+		self.engine=LockEngine(self.transfer_lock)
+		self.engine.subscribe(self.networkio.update_lock_state)
+		self.engine.subscribe(self.log_snapshot,every=True)
+
+		self.refresh_rate=float(config['CAVITY'].get('RefreshRate','20'))
+		self._shown_snapshot=None
+		self.parent.after(100,self.refresh)
+
 		"""
 		Sweep thread.
 		This part of the GUI operates mostly in its own thread. The exception is, however, the frequency sweeps,
@@ -1469,17 +1491,24 @@ class TransferCavity:
 		if flname=="":
 			return
 
-		daq_d={"DeviceName":self.transfer_lock.daq_tasks.device.name}
+		daq_d={"DeviceName":self.transfer_lock.daq_tasks.device.name,"Backend":self.transfer_lock.daq_tasks.backend.name,"AcquisitionMode":self.transfer_lock.daq_tasks.acquisition_mode,"CombinedOutput":str(int(self.transfer_lock.daq_tasks.combined_output)),"DelayedGainScale":self.transfer_lock.delayed_gain_scale}
+
+		#Settings of the simulated cavity are saved only if it's used.
+		if self.transfer_lock.daq_tasks.simulation:
+			daq_d.update(self.transfer_lock.daq_tasks.sim_model.settings())
+
+		if self.transfer_lock.daq_tasks.backend.name=="replay":
+			daq_d["ReplayFile"]=self.transfer_lock.daq_tasks.backend.replay.filename
 
 		wvm_d={"IP":self.host_ip,"Port":self.wvm_port,"Laser1":self.wvm_L1,"Laser2":self.wvm_L2}
 
-		cav_d={"RMS":self.transfer_lock.rms_points,"LockThreshold":self.transfer_lock.master_rms_crit,"PeakCriterion":self.transfer_lock.master_peak_crit,"ScanTime":self.transfer_lock.daq_tasks.ao_scan.scan_time,"ScanSamples":self.transfer_lock.daq_tasks.ao_scan.n_samples,"ScanOffset":self.transfer_lock.daq_tasks.ao_scan.offset,"ScanAmplitude":self.transfer_lock.daq_tasks.ao_scan.amplitude,"PGain":self.lock.prop_gain[0],"IGain":self.lock.int_gain[0],"FSR":self.lock._FSR,"Wavelength":self.lock.get_master_wavelength(),"Lockpoint":self.lock.master_lockpoint,"MinVoltage":self.transfer_lock.daq_tasks.ao_scan.mn_voltage,"MaxVoltage":self.transfer_lock.daq_tasks.ao_scan.mx_voltage,"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_scan_ai_channel()),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_scan_ao_channel())}
+		cav_d={"RMS":self.transfer_lock.rms_points,"ErrorHistory":self.transfer_lock._err_data_length,"LockThreshold":self.transfer_lock.master_rms_crit,"PeakCriterion":self.transfer_lock.master_peak_crit,"TrackPeaks":int(self.transfer_lock.track_peaks),"TrackWindow":self.transfer_lock.track_window,"FitPeaks":int(self.transfer_lock.fit_peaks),"FitWindow":self.transfer_lock.fit_window,"PeakEngine":self.transfer_lock.peak_engines[0],"TemplateWidth":self.transfer_lock.template_widths[0],"ScanTime":self.transfer_lock.daq_tasks.ao_scan.scan_time,"ScanSamples":self.transfer_lock.daq_tasks.ao_scan.n_samples,"ScanOffset":self.transfer_lock.daq_tasks.ao_scan.offset,"ScanAmplitude":self.transfer_lock.daq_tasks.ao_scan.amplitude,"ScanWaveform":self.transfer_lock.daq_tasks.ao_scan.waveform,"SettleFraction":self.transfer_lock.daq_tasks.settle_fraction,"HysteresisAlpha":self.transfer_lock.hysteresis_alpha,"RefreshRate":self.refresh_rate,"PGain":self.lock.prop_gain[0],"IGain":self.lock.int_gain[0],"FSR":self.lock._FSR,"Wavelength":self.lock.get_master_wavelength(),"Lockpoint":self.lock.master_lockpoint,"MinVoltage":self.transfer_lock.daq_tasks.ao_scan.mn_voltage,"MaxVoltage":self.transfer_lock.daq_tasks.ao_scan.mx_voltage,"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_scan_ai_channel()),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_scan_ao_channel())}
 
-		laser1_d={"Name":self.lasers[0].get_name(),"LockpointR":self.lock.slave_lockpoints[0],"LockpointMHz":self.lock.get_laser_lockpoint(0),"Wavelength":self.lasers[0].get_set_wavelength(),"PeakCriterion":self.transfer_lock.slave_peak_crits[0],"LockThreshold":self.transfer_lock.slave_rms_crits[0],"PGain":self.lock.prop_gain[1],"IGain":self.lock.int_gain[1],"MinVoltage":self.transfer_lock.daq_tasks.ao_laser.mn_voltages[0],"MaxVoltage":self.transfer_lock.daq_tasks.ao_laser.mx_voltages[0],"SetVoltage":self.transfer_lock.daq_tasks.ao_laser.voltages[0],"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ai_channel(0)),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ao_channel(0)),"PowerChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_power_channel(0))}
+		laser1_d={"Name":self.lasers[0].get_name(),"LockpointR":self.lock.slave_lockpoints[0],"LockpointMHz":self.lock.get_laser_lockpoint(0),"Wavelength":self.lasers[0].get_set_wavelength(),"PeakCriterion":self.transfer_lock.slave_peak_crits[0],"PeakEngine":self.transfer_lock.peak_engines[1],"TemplateWidth":self.transfer_lock.template_widths[1],"LockThreshold":self.transfer_lock.slave_rms_crits[0],"PGain":self.lock.prop_gain[1],"IGain":self.lock.int_gain[1],"MinVoltage":self.transfer_lock.daq_tasks.ao_laser.mn_voltages[0],"MaxVoltage":self.transfer_lock.daq_tasks.ao_laser.mx_voltages[0],"SetVoltage":self.transfer_lock.daq_tasks.ao_laser.voltages[0],"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ai_channel(0)),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ao_channel(0)),"PowerChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_power_channel(0))}
 
 		if len(self.lasers)>1:
 
-			laser2_d={"Name":self.lasers[1].get_name(),"LockpointR":self.lock.slave_lockpoints[1],"LockpointMHz":self.lock.get_laser_lockpoint(1),"Wavelength":self.lasers[1].get_set_wavelength(),"PeakCriterion":self.transfer_lock.slave_peak_crits[1],"LockThreshold":self.transfer_lock.slave_rms_crits[1],"PGain":self.lock.prop_gain[2],"IGain":self.lock.int_gain[2],"MinVoltage":self.transfer_lock.daq_tasks.ao_laser.mn_voltages[1],"MaxVoltage":self.transfer_lock.daq_tasks.ao_laser.mx_voltages[1],"SetVoltage":self.transfer_lock.daq_tasks.ao_laser.voltages[1],"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ai_channel(1)),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ao_channel(1)),"PowerChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_power_channel(1))}
+			laser2_d={"Name":self.lasers[1].get_name(),"LockpointR":self.lock.slave_lockpoints[1],"LockpointMHz":self.lock.get_laser_lockpoint(1),"Wavelength":self.lasers[1].get_set_wavelength(),"PeakCriterion":self.transfer_lock.slave_peak_crits[1],"PeakEngine":self.transfer_lock.peak_engines[2],"TemplateWidth":self.transfer_lock.template_widths[2],"LockThreshold":self.transfer_lock.slave_rms_crits[1],"PGain":self.lock.prop_gain[2],"IGain":self.lock.int_gain[2],"MinVoltage":self.transfer_lock.daq_tasks.ao_laser.mn_voltages[1],"MaxVoltage":self.transfer_lock.daq_tasks.ao_laser.mx_voltages[1],"SetVoltage":self.transfer_lock.daq_tasks.ao_laser.voltages[1],"InputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ai_channel(1)),"OutputChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_ao_channel(1)),"PowerChannel":channel_number(self.transfer_lock.daq_tasks.get_laser_power_channel(1))}
 
 			save_conf(flname,daq_d,wvm_d,cav_d,laser1_d,laser2_d)
 
@@ -2407,9 +2436,7 @@ class TransferCavity:
 
 
 		#Some parameters are reset
-		self.transfer_lock.master_err_history=deque(maxlen=self.transfer_lock._err_data_length)
-		self.transfer_lock.master_err_history.append(0)
-		self.transfer_lock.master_err_rms=0
+		self.transfer_lock.reset_master_error()
 		self.lock.master_err=0
 		self.lock.master_err_prev=0
 		self.lock.master_ctrl=0
@@ -2466,9 +2493,7 @@ class TransferCavity:
 
 		self.laser_lock_status_cv[ind].itemconfig(self.laser_lock_status[ind],fill=off_color)
 
-		self.transfer_lock.slave_err_history[ind]=deque(maxlen=self.transfer_lock._err_data_length)
-		self.transfer_lock.slave_err_history[ind].append(0)
-		self.transfer_lock.slave_err_rms[ind]=0
+		self.transfer_lock.reset_slave_error(ind)
 		self.lock.slave_errs[ind]=0
 		self.lock.slave_errs_prev[ind]=0
 		self.lock.slave_ctrls[ind]=0
@@ -3129,30 +3154,17 @@ class TransferCavity:
 		self.change_channels.config(state="disabled")
 		self.save_configuration.config(state="disabled")
 
-		#Changing flags
-		self.transfer_lock.start_scan()
 		self.run_scan.configure(text="Stop Scanning",command=self.stop_scanning,fg=off_color)
 		self.running=True
 
-
-		"""
-		Creating threads. The function responsible for scanning and acquiring data obtains this whole class (or rather
-		its object) as one of its arguments to actively perform changes to GUI and plot.
-		"""
-		try:
-			if self.transfer_lock._scan_thread is None:
-				self.transfer_lock._scan_thread=threading.Thread(target=self.transfer_lock.scan,kwargs={"GUI_object":self})
-			self.transfer_lock._scan_thread.start()
-
-		except RuntimeError:
-			self.transfer_lock._scan_thread=threading.Thread(target=self.transfer_lock.scan,kwargs={"GUI_object":self})
-			self.transfer_lock._scan_thread.start()
+		#The scan loop runs in the engine's thread, the GUI is updated from the published snapshots (see below).
+		self.engine.start()
 
 
 	#Method called when the scan is paused/stopped. It also disengages all the locks.
 	def stop_scanning(self):
 
-		self.transfer_lock.stop_scan()
+		self.engine.stop()
 		self.running=False
 
 		self.update_scan.config(state="normal")
@@ -3170,6 +3182,103 @@ class TransferCavity:
 			self.disengage_cavity_lock()
 
 
+	"""
+	Polls the newest frame of the lock engine from the Tk thread, "refresh_rate" times per second, and asks for the
+	next one. A frame is shown only once and only while scanning, so the scans done between two refreshes are skipped
+	(and their data isn't even copied) and the GUI costs the same at any scanning frequency.
+	"""
+	def refresh(self):
+
+		try:
+			snap=self.engine.frame
+			if self.running and snap is not None and snap is not self._shown_snapshot:
+				self._shown_snapshot=snap
+				self.show_snapshot(snap)
+		finally:
+			self.engine.request_frame()
+			self.parent.after(max(int(1000/self.refresh_rate),1),self.refresh)
+
+
+	#Shows the state of the lock after a scan: readouts, status lights of the locks, the acquired data and the errors.
+	def show_snapshot(self,snap):
+
+		plot_win=self.plot_win
+
+		self.real_scfr.config(text='{:.1f}'.format(snap.scan_frequency))
+
+		for i in range(len(snap.pd_data)):
+			plot_win.all_lines[i].set_data(snap.time_samples,snap.pd_data[i])
+			plot_win.all_lines[i+3].set_data([snap.lockpoints_x[i]]*2,[-10,10])
+		limits=[(plot_win.ax,(snap.scan_time*0.2,snap.scan_time*1.01),(np.amin(snap.pd_data)-0.05,np.amax(snap.pd_data)+0.2))]
+
+		if snap.master_lock_engaged:
+
+			if snap.master_two_peaks:
+				self.twopeak_status_cv.itemconfig(self.twopeak_status,fill=Colors['on_color'])
+				self.rms_cav.config(text="{:.3f}".format(snap.master_err_rms))
+				self.real_scoff.config(text='{:.2f}'.format(snap.scan_offset))
+			else:
+				self.twopeak_status_cv.itemconfig(self.twopeak_status,fill=Colors['off_color'])
+
+			if snap.master_locked:
+				self.cav_lock_status_cv.itemconfig(self.cav_lock_status,fill=Colors['on_color'])
+
+				for i in range(len(snap.slave_locks_engaged)):
+					if snap.slave_locks_engaged[i]:
+						self.rms_laser[i].config(text="{:.2f}".format(snap.slave_err_rms[i]))
+						self.app_volt[i].config(text='{:.3f}'.format(snap.laser_voltages[i]))
+						self.laser_r[i].config(text='{:.3f}'.format(snap.slave_Rs[i]))
+
+						if snap.slave_locked[i]:
+							self.laser_lock_status_cv[i].itemconfig(self.laser_lock_status[i],fill=Colors['on_color'])
+						else:
+							self.laser_lock_status_cv[i].itemconfig(self.laser_lock_status[i],fill=Colors['off_color'])
+			else:
+				self.cav_lock_status_cv.itemconfig(self.cav_lock_status,fill=Colors['off_color'])
+
+		if snap.master_valid:
+
+			history=snap.master_history
+			plot_win.mline.set_data(np.arange(len(history)),history)
+			limits.append((plot_win.ax_err,(0,self.transfer_lock.master_err_history.capacity-1),(snap.master_history_range[0]-self.transfer_lock.master_rms_crit/3,self.transfer_lock.master_rms_crit/3+snap.master_history_range[1])))
+
+			for j in range(len(snap.slave_locks_engaged)):
+				if snap.slave_locks_engaged[j]:
+					history=snap.slave_histories[j]
+					plot_win.slines[j].set_data(np.arange(len(history)),history)
+					limits.append((plot_win.ax_err_L[j],(0,self.transfer_lock.slave_err_history[j].capacity-1),(snap.slave_history_ranges[j][0]-self.transfer_lock.slave_rms_crits[j]/3,self.transfer_lock.slave_rms_crits[j]/3+snap.slave_history_ranges[j][1])))
+
+		plot_win.redraw(limits)
+
+
+	#Subscriber of the lock engine that gets every snapshot: errors are added to the logs (if logging is on).
+	def log_snapshot(self,snap):
+
+		if not snap.master_valid:
+			return
+
+		if self.master_logging_set:
+
+			self.master_time_temp.put(snap.timestamp-self.mt_start)
+			self.master_error_temp.put(snap.master_err)
+
+			self.transfer_lock._master_counter+=1
+
+		for j in range(len(snap.slave_locks_engaged)):
+			if snap.slave_locks_engaged[j] and self.laser_logging_set[j]:
+
+				self.slave_time_temp[j].put(snap.timestamp-self.lt_start[j])
+				self.slave_err_temp[j].put(snap.slave_errs[j])
+				self.slave_rfreq_temp[j].put(snap.slave_frequencies[j])
+				self.slave_lfreq_temp[j].put(snap.slave_abs_lockpoints[j])
+				self.slave_rr_temp[j].put(snap.slave_Rs[j])
+				self.slave_lr_temp[j].put(snap.slave_lockpoints[j])
+				self.slave_pow_temp[j].put(snap.slave_powers[j])
+				self.slave_wvmfreq_temp[j].put(self.real_frequency[j][0])
+
+				self.transfer_lock._slave_counters[j]+=1
+
+
 
 
 #################################################################################################################
@@ -3178,7 +3287,13 @@ class TransferCavity:
 The class below takse care of the plotting window. It is divided into 4 plots: the first one plots data acquired from
 the photodetectors and shows the current signals with peaks, the three other plots show real-time error signal of the
 master laser lock and both slave laser locks. The length of the data used for error signal is set to 100 points. For
-all the plots the scales are automatically adjusted. This class contains no methods.
+all the plots the scales are automatically adjusted.
+
+The plots are updated by blitting: the lines are animated artists, the rest of the figure (axes, ticks, labels) is
+drawn only when the figure is redrawn in full and its background is kept. An update then only restores the background
+of each axes and draws its lines on top of it. The figure is redrawn in full only when the limits of a plot change,
+and the Y limits change only when the data leaves the current view or takes up much less of it than it could
+(the view has a margin of "hysteresis" times the span of the data on both sides).
 """
 class PlotWindow:
 	def __init__(self,parent):
@@ -3268,6 +3383,68 @@ class PlotWindow:
 			self.slines[i],=self.ax_err_L[i].plot([],[],'w-',lw=1)
 
 
+		#Lines of every plot. They are drawn only by blitting (see "redraw"), not when the figure is drawn in full.
+		self.axes=[self.ax,self.ax_err]+self.ax_err_L
+		self._lines={self.ax:self.all_lines,self.ax_err:[self.mline],self.ax_err_L[0]:[self.slines[0]],self.ax_err_L[1]:[self.slines[1]]}
+		for ax in self.axes:
+			for line in self._lines[ax]:
+				line.set_animated(True)
+
+		self.hysteresis=0.1
+
+		#Backgrounds of the plots, saved after every full redraw of the figure (None until it's redrawn).
+		self._backgrounds=None
+		self.canvas.mpl_connect('draw_event',self._on_draw)
+
+
+	"""
+	Shows the new data of the lines. "limits" is a list of (axes, X limits, Y limits) wanted for the data of the
+	plots. X limits are set as they are (they should change only with the scan settings, e.g. the error plots span
+	the whole capacity of the histories, also while they're filling), Y limits with the margin (see above). If any limits change, the figure is
+	redrawn in full (when Tk is idle), otherwise only the lines are blitted.
+	"""
+	def redraw(self,limits=()):
+
+		rescaled=False
+		for ax,xlim,ylim in limits:
+			rescaled|=self._rescale(ax.get_xlim,ax.set_xlim,xlim,0)
+			rescaled|=self._rescale(ax.get_ylim,ax.set_ylim,ylim,self.hysteresis)
+
+		if rescaled or self._backgrounds is None:
+			self._backgrounds=None
+			self.canvas.draw_idle()
+			return
+
+		for ax,background in zip(self.axes,self._backgrounds):
+			self.canvas.restore_region(background)
+			for line in self._lines[ax]:
+				ax.draw_artist(line)
+			self.canvas.blit(ax.bbox)
+
+
+	#Sets new limits if the wanted ones don't fit in the current ones or these are too wide. Returns True if it did.
+	def _rescale(self,get_lim,set_lim,wanted,hysteresis):
+
+		lo,hi=wanted
+		cur_lo,cur_hi=get_lim()
+		margin=hysteresis*(hi-lo)
+
+		if lo>=cur_lo and hi<=cur_hi and cur_hi-cur_lo<=hi-lo+4*margin:
+			return False
+
+		set_lim(lo-margin,hi+margin)
+		return True
+
+
+	#Called after every full redraw of the figure: keeps the backgrounds of the plots and draws the lines on them.
+	def _on_draw(self,event):
+
+		self._backgrounds=[self.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+		for ax in self.axes:
+			for line in self._lines[ax]:
+				ax.draw_artist(line)
+
+
 
 #################################################################################################################
 """
@@ -1,9 +1,10 @@
 """
-The file that's initializing the application. It sets up the logger and creates a GUI object.
+The file that's initializing the application. It sets up the logger and creates a GUI object. The GUI object ("app")
+is created only when it's first used, so the program can also run without a display (see Daemon.py) and then Tk and
+matplotlib are never loaded.
 """
 
 
-from .Sweep_GUI import GUI
 import logging
 
 
@@ -20,5 +21,18 @@ fh.setFormatter(formatter)
 logger.addHandler(fh)
 
 
-app=GUI()
+#Creates the GUI object (and imports the GUI) when "app" or "GUI" is first imported from this package.
+def __getattr__(name):
+
+	global app, GUI
+
+	if name=="GUI":
+		from .Sweep_GUI import GUI
+		return GUI
+	elif name=="app":
+		from .Sweep_GUI import GUI
+		app=GUI()
+		return app
+
+	raise AttributeError("module {!r} has no attribute {!r}".format(__name__,name))
 
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from SWP.Buffers import RollingStats, RingBuffer, _Extrema
+
+
+"""
+Tests of the histories in Buffers.py: the running values are compared with the same statistics computed by NumPy
+over the last values.
+"""
+
+
+@pytest.mark.parametrize("window",[1,7,50])
+def test_rolling_stats(window):
+
+	rng=np.random.default_rng(1)
+	values=rng.normal(3,2,400)
+	stats=RollingStats(window)
+
+	for i in range(len(values)):
+		stats.append(values[i])
+		last=values[max(i+1-window,0):i+1]
+
+		assert len(stats)==len(last)
+		assert stats.mean==pytest.approx(np.mean(last))
+		assert stats.rms==pytest.approx(np.sqrt(np.mean(last**2)))
+		assert stats.ptp==pytest.approx(np.ptp(last))
+
+
+def test_rolling_stats_window_change():
+
+	stats=RollingStats(10)
+	for value in range(20):
+		stats.append(value)
+
+	stats.window=4
+	assert len(stats)==4
+	assert stats.mean==pytest.approx(17.5)
+	assert stats.ptp==pytest.approx(3)
+
+	stats.window=8
+	stats.append(20)
+	assert len(stats)==5
+	assert stats.mean==pytest.approx(18)
+
+
+def test_rolling_stats_empty():
+
+	stats=RollingStats(5)
+	assert (stats.mean,stats.rms,stats.ptp)==(0.,0.,0.)
+
+	stats.append(1)
+	stats.reset()
+	assert len(stats)==0
+
+
+@pytest.mark.parametrize("capacity",[1,5,64])
+def test_ring_buffer(capacity):
+
+	rng=np.random.default_rng(2)
+	values=rng.normal(0,1,200)
+	buf=RingBuffer(capacity)
+
+	for i in range(len(values)):
+		buf.append(values[i])
+		last=values[max(i+1-capacity,0):i+1]
+
+		assert len(buf)==len(last)
+		np.testing.assert_array_equal(buf.values,last)
+		np.testing.assert_array_equal(buf.x,np.arange(len(last)))
+		assert buf.min==last.min()
+		assert buf.max==last.max()
+
+	assert buf[-1]==values[-1]
+	assert list(buf)==list(values[-capacity:])
+
+
+def test_ring_buffer_views_are_read_only():
+
+	buf=RingBuffer(3)
+	buf.append(1)
+
+	with pytest.raises(ValueError):
+		buf.values[0]=2
+	with pytest.raises(ValueError):
+		buf.x[0]=2
+
+
+def test_ring_buffer_clear():
+
+	buf=RingBuffer(3)
+	for value in (1,2,3,4):
+		buf.append(value)
+
+	buf.clear()
+	assert len(buf)==0
+	assert (buf.min,buf.max)==(0.,0.)
+
+	buf.append(5)
+	np.testing.assert_array_equal(buf.values,[5])
+
+
+#The number of values kept grows by one up to the window, as in RollingStats and RingBuffer.
+@pytest.mark.parametrize("window",[1,2,17])
+def test_extrema(window):
+
+	rng=np.random.default_rng(3)
+	values=rng.integers(0,10,300)
+	extrema=_Extrema()
+
+	for i in range(len(values)):
+		length=min(i+1,window)
+		extrema.append(values[i],length)
+		last=values[max(i+1-length,0):i+1]
+
+		assert extrema.min==last.min()
+		assert extrema.max==last.max()
@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+pytest.importorskip("influxdb")
+
+from SWP import Daemon
+
+
+"""
+Tests of the command line of the headless entry point (Daemon.py).
+"""
+
+
+def test_config_path():
+	assert Daemon.config_path("DEFAULT_Sim")==Daemon.config_path("DEFAULT_Sim.ini")
+	assert Daemon.config_path("DEFAULT_Sim").endswith("/configs/DEFAULT_Sim.ini")
+
+
+#The backend is taken from the command line, and the replay backend can't run without a file.
+def test_replay_needs_a_file(capsys):
+
+	with pytest.raises(SystemExit):
+		Daemon.main(["DEFAULT_Sim","--backend","replay"])
+
+	assert "--replay-file" in capsys.readouterr().err
+
+
+def test_unknown_backend():
+
+	with pytest.raises(SystemExit):
+		Daemon.main(["DEFAULT_Sim","--backend","other"])
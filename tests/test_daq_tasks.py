@@ -0,0 +1,176 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+
+from SWP import Config, DAQ_tasks
+from SWP.Data_acq import TransferLock
+from SWP.Lock import Lock
+
+
+"""
+Tests of the acquisition modes of DAQ_tasks with the simulated backend, and of locking on the triangle scan.
+"""
+
+
+CONFIG=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"SWP","configs","DEFAULT_Sim.ini")
+
+
+def simulated_config(mode,**daq):
+
+	cfg=Config.load_conf(CONFIG)
+	cfg['DAQ']['Backend']='simulated'
+	cfg['DAQ']['SimRealtime']='0'
+	cfg['DAQ']['AcquisitionMode']=mode
+	for key in daq:
+		cfg['DAQ'][key]=daq[key]
+
+	return cfg
+
+
+def simulated_tasks(mode,**daq):
+	return DAQ_tasks.setup_tasks(simulated_config(mode,**daq),2,False)
+
+
+#Continuous mode in which the scans are delivered by calling the callback from the test (the DAQ's thread is stopped).
+def stopped_continuous(tasks):
+
+	tasks.start_continuous()
+	tasks.ai_PDs.dq_task.stop()
+
+	while not tasks._scans.empty():
+		tasks._free.put(tasks._scans.get()[0])
+
+
+def deliver(tasks,n=1):
+	for i in range(n):
+		tasks._scan_acquired(None,None,tasks.ao_scan.n_samples,None)
+
+
+def torn_flags(tasks):
+
+	flags=[]
+	while not tasks._scans.empty():
+		data,applied,torn,direction=tasks._scans.get()
+		tasks._free.put(data)
+		flags.append(torn)
+
+	return flags
+
+
+#The scan during which the offset or the laser voltages are written is torn, the following ones are not.
+def test_writes_tear_the_running_scan():
+
+	tasks=simulated_tasks('continuous')
+	stopped_continuous(tasks)
+
+	deliver(tasks)
+	assert torn_flags(tasks)==[False]
+
+	tasks.ao_scan.move_offset(0.1)
+	tasks._write_continuous()
+	deliver(tasks,3)
+	assert torn_flags(tasks)==[True,False,False]
+
+	tasks.ao_laser.voltages[0]+=0.01
+	tasks._write_continuous()
+	deliver(tasks,2)
+	assert torn_flags(tasks)==[True,False]
+
+	#Nothing changed, so nothing is written.
+	tasks._write_continuous()
+	deliver(tasks,2)
+	assert torn_flags(tasks)==[False,False]
+
+	tasks.torn_scans=2
+	tasks.ao_scan.move_offset(0.1)
+	tasks._write_continuous()
+	deliver(tasks,3)
+	assert torn_flags(tasks)==[True,True,False]
+
+	tasks.stop_continuous()
+
+
+#A torn scan is never processed: the acquisition waits for the next one.
+def test_torn_scans_are_dropped():
+
+	tasks=simulated_tasks('continuous')
+	stopped_continuous(tasks)
+	tasks._continuous=True
+
+	deliver(tasks)
+	tasks.ao_scan.move_offset(0.1)
+	tasks._write_continuous()
+	deliver(tasks)
+	torn=tasks._scans.queue[-1][0]
+
+	timer=threading.Timer(0.2,deliver,(tasks,))
+	timer.start()
+	tasks.continuous_acquire(threading.Event())
+	timer.join()
+
+	assert tasks._scans.empty()
+	assert tasks.PD_data is not torn
+	assert tasks._scan_applied[0]==tasks.ao_scan.offset
+
+	tasks.stop_continuous()
+
+
+#In the triangle mode every scan is one half of the period: the halves are written and acquired in turn.
+@pytest.mark.parametrize("mode",["sequential","pipelined"])
+def test_triangle_halves(mode):
+
+	tasks=simulated_tasks(mode)
+	tasks.ao_scan.set_waveform("triangle")
+	tasks.set_input_timing()
+	h=tasks.ao_scan.n_samples//2
+
+	directions=[]
+	for i in range(4):
+		tasks.acquire(threading.Event())
+		directions.append(tasks.scan_direction)
+		assert tasks.PD_data.shape==(3,h)
+
+	tasks.stop_acquisition()
+
+	assert directions==[1,-1,1,-1]
+	assert len(tasks.time_samples)==h
+	assert tasks.ao_scan.dq_task.timing.samp_quant_samp_per_chan==h
+
+
+"""
+With hysteresis of the piezo, the peaks of the falling half are shifted (by 0.02 of the half, so 0.2 ms). The master
+lock is updated after each half, so the offset changes between the halves of every period, and once the shift is
+estimated, both halves have to be locked to the lockpoint.
+"""
+def test_triangle_halves_lock_to_the_same_point():
+
+	cfg=simulated_config('sequential',SimPiezoHysteresis='0.02')
+	cfg['CAVITY']['ScanWaveform']='triangle'
+	cfg['CAVITY']['ScanOffset']='-2.5'
+	cfg['CAVITY']['Lockpoint']='3'
+
+	lock=Lock([1086,1087],cfg)
+	transfer_lock=TransferLock(lock,DAQ_tasks.setup_tasks(cfg,2,True),cfg)
+
+	offsets=[]
+	peaks={1:[],-1:[]}
+	for i in range(80):
+		transfer_lock.daq_tasks.acquire(threading.Event())
+		for datax,datay,direction in transfer_lock.scan_segments():
+			transfer_lock.obtain_signals(datax,datay,direction)
+		assert len(transfer_lock.master_signal.peaks_x)==2
+		transfer_lock.lock_master()
+
+		offsets.append(transfer_lock.daq_tasks.applied_offset())
+		peaks[direction].append(transfer_lock.master_signal.peaks_x[0])
+
+	assert np.all(np.diff(offsets[:10])!=0)
+	assert transfer_lock.hysteresis==pytest.approx(0.2,abs=0.01)
+	for direction in peaks:
+		assert np.mean(peaks[direction][-10:])==pytest.approx(3,abs=0.03)
+	assert np.mean(peaks[1][-10:])==pytest.approx(np.mean(peaks[-1][-10:]),abs=0.01)
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+
+from SWP import Config, DAQ_tasks
+from SWP.Data_acq import TransferLock
+from SWP.Engine import LockEngine
+from SWP.Lock import Lock
+
+
+"""
+Tests of the lock engine (Engine.py) running the transfer lock with the simulated backend: snapshots have to reach
+the subscribers, frames have to be made only when asked for and the scan loop has to survive stopping and starting.
+"""
+
+
+CONFIG=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"SWP","configs","DEFAULT_Sim.ini")
+
+
+@pytest.fixture
+def engine():
+
+	cfg=Config.load_conf(CONFIG)
+	cfg['DAQ']['Backend']='simulated'
+	cfg['DAQ']['SimRealtime']='0'
+	cfg['CAVITY']['ScanOffset']='-2.5'
+
+	lock=Lock([1086,1087],cfg)
+	engine=LockEngine(TransferLock(lock,DAQ_tasks.setup_tasks(cfg,2,True),cfg))
+	engine.engage_cavity_lock()
+
+	yield engine
+
+	engine.stop(wait=True,timeout=5)
+
+
+def wait_for(condition,timeout=5):
+
+	end=time.time()+timeout
+	while not condition():
+		assert time.time()<end
+		time.sleep(0.01)
+
+
+def run(engine,duration=0.3):
+
+	engine.start()
+	time.sleep(duration)
+	engine.stop(wait=True,timeout=5)
+	assert not engine.running
+
+
+#Loggers get all the snapshots in order, usual subscribers (here slower than the scans) only the newest ones.
+def test_subscribers(engine):
+
+	logged=[]
+	newest=[]
+
+	def slow(snapshot):
+		newest.append(snapshot.counter)
+		time.sleep(0.02)
+
+	engine.subscribe(logged.append,every=True)
+	engine.subscribe(slow)
+	run(engine)
+
+	last=engine.snapshot.counter
+	wait_for(lambda: logged and logged[-1].counter==last and newest[-1]==last)
+
+	counters=[s.counter for s in logged]
+	assert counters==list(range(counters[0],last+1))
+	assert len(newest)<len(counters)
+	assert newest==sorted(set(newest))
+
+	engine.unsubscribe(slow)
+	engine.unsubscribe(logged.append)
+	assert engine._subscribers==[] and engine._loggers==[]
+
+
+#A subscriber that fails doesn't stop the others.
+def test_failing_subscriber(engine):
+
+	def fail(snapshot):
+		raise RuntimeError('subscriber failed')
+
+	logged=[]
+	engine.subscribe(fail,every=True)
+	engine.subscribe(logged.append,every=True)
+	run(engine,0.1)
+
+	wait_for(lambda: logged and logged[-1].counter==engine.snapshot.counter)
+
+
+#Only the snapshot after a request is a frame, and it has the data and the histories.
+def test_frames(engine):
+
+	logged=[]
+	engine.subscribe(logged.append,every=True)
+
+	engine.start()
+	wait_for(lambda: engine.snapshot is not None and engine.snapshot.counter>5)
+	assert engine.frame is None
+	assert engine.snapshot.pd_data is None
+
+	engine.request_frame()
+	wait_for(lambda: engine.frame is not None)
+	frame=engine.frame
+	wait_for(lambda: engine.snapshot.counter>frame.counter+5)
+	engine.stop(wait=True,timeout=5)
+
+	wait_for(lambda: logged[-1].counter==engine.snapshot.counter)
+	assert [s.counter for s in logged if s.frame]==[frame.counter]
+	assert frame.pd_data.shape==(3,len(frame.time_samples))
+	assert frame.master_history is not None
+	assert engine.frame is frame
+
+
+#Starting right after stopping (while the last scan is still in progress) leaves one scan loop running.
+def test_restart(engine):
+
+	for i in range(5):
+		engine.start()
+		time.sleep(0.05)
+		engine.stop()
+		engine.start()
+		time.sleep(0.05)
+
+		counter=engine.snapshot.counter
+		wait_for(lambda: engine.snapshot.counter>counter)
+		assert engine.running
+
+	engine.stop(wait=True,timeout=5)
+	assert not engine.running
+
+	counter=engine.snapshot.counter
+	time.sleep(0.1)
+	assert engine.snapshot.counter==counter
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+
+from SWP.Data_acq import Filter
+
+
+"""
+Tests of the Filter methods of Data_acq.py against the per-point and single-signal versions they replaced.
+"""
+
+
+#The peak filter as it was computed point by point.
+def loop_peak_filter(data,k=10):
+	return np.concatenate((np.concatenate((data[:k],[data[i]**2-data[i-k]*data[i+k] for i in range(k,len(data)-k)])),data[-k:]))
+
+
+@pytest.mark.parametrize("k",[1,3,10])
+def test_peak_filter_matches_the_loop(k):
+
+	rng=np.random.default_rng(k)
+	data=rng.normal(0,1,(3,500))
+	fltr=Filter()
+
+	out=np.empty(data.shape)
+	result=fltr.peak_filter(data,k,out=out)
+	assert result is out
+
+	for c in range(3):
+		np.testing.assert_allclose(fltr.peak_filter(data[c],k),loop_peak_filter(data[c],k),rtol=1e-15,atol=1e-15)
+		np.testing.assert_allclose(out[c],loop_peak_filter(data[c],k),rtol=1e-15,atol=1e-15)
+
+
+#The scratch array is kept for data of any shape that fits, so a smaller scan after a larger one must not see old values.
+def test_peak_filter_reuses_the_scratch():
+
+	rng=np.random.default_rng(0)
+	fltr=Filter()
+
+	fltr.peak_filter(rng.normal(0,1,(3,800)))
+	size=fltr._scratch.size
+
+	small=rng.normal(0,1,(2,300))
+	result=fltr.peak_filter(small)
+
+	assert fltr._scratch.size==size
+	for c in range(2):
+		np.testing.assert_allclose(result[c],loop_peak_filter(small[c]),rtol=1e-15,atol=1e-15)
+
+
+@pytest.mark.parametrize("win_size",[1,3,5])
+def test_linear_roots_match_polyfit(win_size):
+
+	rng=np.random.default_rng(win_size)
+	dx=0.01
+	x=2+dx*np.arange(400)
+	D=np.cumsum(rng.normal(0,1,400))
+	ind=np.arange(win_size,400-win_size,7)
+
+	expected=[]
+	for i in ind:
+		a,b=np.polyfit(x[i-win_size:i+win_size],D[i-win_size:i+win_size],1)
+		expected.append(-b/a)
+
+	fltr=Filter()
+	np.testing.assert_allclose(fltr.linear_roots(x,D,ind,win_size,dx),expected,rtol=1e-9)
+	assert len(fltr.linear_roots(x,D,[],win_size,dx))==0
+
+
+def test_window_roots_of_lines():
+
+	dx=0.5
+	x0=np.array([1.,3.])
+	slopes=np.array([2.,-0.5])
+	roots=np.array([2.2,4.1])
+
+	#Rows are exact lines, so their zero crossings are found exactly.
+	Y=slopes[:,None]*(x0[:,None]+dx*np.arange(6)-roots[:,None])
+	np.testing.assert_allclose(Filter().window_roots(x0,Y,3,dx),roots)
+
+
+#The derivative followed by the moving average, as single-signal convolutions without cached windows.
+def old_smooth_derivative(signal,der,sp,half_size):
+
+	C=Filter().coeffs[der][:]
+	if der>1:
+		C=[c/sp**der for c in C]
+
+	D=np.convolve(signal,C,"same")
+	return np.divide(np.convolve(D,np.ones(2*half_size+1),"same"),2*half_size+1)
+
+
+@pytest.mark.parametrize("der",[0,1,2])
+@pytest.mark.parametrize("half_size",[0,2,3])
+def test_smooth_derivative_matches_two_convolutions(der,half_size):
+
+	rng=np.random.default_rng(10*der+half_size)
+	sp=0.02
+	data=rng.normal(0,1,(3,300))
+	fltr=Filter()
+
+	result=fltr.smooth_derivative(data,der,sp,half_size)
+	for c in range(3):
+		expected=old_smooth_derivative(data[c],der,sp,half_size)
+		np.testing.assert_allclose(result[c],expected,rtol=1e-10,atol=1e-12)
+		np.testing.assert_allclose(fltr.smooth_derivative(data[c],der,sp,half_size),expected,rtol=1e-10,atol=1e-12)
+
+
+def test_kernels_are_dropped_for_a_new_spacing():
+
+	fltr=Filter()
+	fltr.smooth_derivative(np.ones(50),1,0.1)
+	fltr.smooth_derivative(np.ones(50),2,0.2)
+
+	assert all(key[1]==0.2 for key in fltr._kernels)
+
+
+#Correlation with the Lorentzian template computed directly, one shift of the template at a time.
+def direct_correlation(data,width,sp):
+
+	J=int(np.floor(10*width/sp+1e-9))
+	j=np.arange(-J,J+1)
+	template=1/(1+(j*sp/width)**2)
+	template-=np.mean(template)
+
+	padded=np.concatenate((np.zeros(J),data,np.zeros(J)))
+	n=len(data)
+
+	return sum(template[k]*padded[k:k+n] for k in range(len(j)))
+
+
+@pytest.mark.parametrize("width",[0.05,0.1,0.37])
+def test_correlate_matches_the_direct_sum(width):
+
+	rng=np.random.default_rng(int(100*width))
+	sp=0.01
+	data=rng.normal(0,1,(2,700))
+	fltr=Filter()
+
+	result=fltr.correlate(data,[width,2*width],sp)
+	np.testing.assert_allclose(result[0],direct_correlation(data[0],width,sp),atol=1e-9)
+	np.testing.assert_allclose(result[1],direct_correlation(data[1],2*width,sp),atol=1e-9)
+	np.testing.assert_allclose(fltr.correlate(data[0],width,sp),result[0],atol=1e-12)
+
+
+#A constant offset of the data changes nothing, as the template has zero mean.
+def test_correlate_ignores_offset():
+
+	rng=np.random.default_rng(1)
+	data=rng.normal(0,1,500)
+	fltr=Filter()
+
+	np.testing.assert_allclose(fltr.correlate(data+3,0.1,0.01)[200:300],fltr.correlate(data,0.1,0.01)[200:300],atol=1e-9)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+
+from SWP.Data_acq import _crossings, _suppress
+
+
+"""
+Tests of the vectorised peak search helpers of Data_acq.py against the loop going over the derivative point by point,
+as find_peaks did it before.
+"""
+
+
+def loop_crossings(D,data_y,thresholds,win_size,discard=0.25):
+
+	found=[]
+	for c in range(D.shape[0]):
+
+		points=[]
+		skip=0
+		for i in range(max(int(discard*D.shape[1]),1),D.shape[1]-win_size):
+
+			if skip>0:
+				skip-=1
+				continue
+
+			if D[c,i-1]<0 and D[c,i]>0:
+				if np.amax(data_y[c,i-win_size:i+win_size])>thresholds[c]:
+					points.append(i)
+					skip=20*win_size
+
+		found.append(points)
+
+	return found
+
+
+#Noisy scans with a few peaks of random heights (channels x samples) and their derivatives.
+def noisy_scans(rng,channels,n):
+
+	t=np.arange(n)
+	data=rng.normal(0,0.02,(channels,n))
+	for c in range(channels):
+		for pos in rng.uniform(0,n,rng.integers(0,6)):
+			data[c]+=rng.uniform(0.1,1)/(1+((t-pos)/rng.uniform(2,20))**2)
+
+	return data,np.gradient(data,axis=1)
+
+
+@pytest.mark.parametrize("seed",range(20))
+@pytest.mark.parametrize("win_size",[1,3,5])
+def test_crossings_match_the_loop(seed,win_size):
+
+	rng=np.random.default_rng(seed)
+	data,D=noisy_scans(rng,3,1500)
+	thresholds=rng.uniform(0,0.5,3)
+
+	found=_crossings(D,data,thresholds,win_size)
+	expected=loop_crossings(D,data,thresholds,win_size)
+
+	for c in range(3):
+		assert list(found[c])==expected[c]
+
+
+def test_crossings_short_scan():
+
+	D=np.ones((2,8))
+	found=_crossings(D,D,np.zeros(2),5)
+	assert [len(f) for f in found]==[0,0]
+
+
+@pytest.mark.parametrize("skip",[0,1,7,50])
+def test_suppress_matches_the_loop(skip):
+
+	rng=np.random.default_rng(skip)
+	cand=np.unique(rng.integers(0,1000,200))
+
+	expected=[]
+	for c in cand:
+		if not expected or c>expected[-1]+skip:
+			expected.append(c)
+
+	assert list(_suppress(cand,skip))==expected
+	assert len(_suppress(np.array([],dtype=int),skip))==0
@@ -0,0 +1,177 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+h5py=pytest.importorskip("h5py")
+
+from SWP.Recording import ScanRecorder, ScanReplay, unused_filename
+
+
+"""
+Tests of recording raw scans (Recording.py): scans written by ScanRecorder have to be read back by ScanReplay with
+the scan offset and laser voltages that were written for them, also when they're recorded by DAQ_tasks.
+"""
+
+
+CONFIG=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"SWP","configs","DEFAULT_Sim.ini")
+
+
+@pytest.mark.parametrize("n_scans",[0,3,8,21])
+def test_round_trip(tmp_path,n_scans):
+
+	filename=str(tmp_path/"scans.hdf5")
+	rng=np.random.default_rng(n_scans)
+	data=rng.normal(0,1,(n_scans,3,100)).astype(np.float32)
+	offsets=rng.normal(0,1,n_scans)
+	voltages=rng.normal(0,1,(n_scans,2))
+
+	recorder=ScanRecorder(filename,3,100,2,attrs={"ScanTime":20.},chunk=4)
+	for i in range(n_scans):
+		recorder.record(data[i],offsets[i],voltages[i],timestamp=float(i))
+	recorder.close()
+	recorder.close()
+
+	replay=ScanReplay(filename)
+	assert len(replay)==n_scans
+	assert (replay.channels,replay.n_samples,replay.chunk)==(3,100,4)
+	assert replay.attrs["ScanTime"]==20.
+
+	#Read out of order, so that the chunks are read again.
+	for i in list(range(n_scans))+list(range(n_scans))[::-3]:
+		np.testing.assert_array_equal(replay.scan(i),data[i])
+		timestamp,offset,volts=replay.controls(i)
+		assert (timestamp,offset)==(float(i),offsets[i])
+		np.testing.assert_array_equal(volts,voltages[i])
+
+	replay.close()
+
+
+def test_existing_file_is_not_overwritten(tmp_path):
+
+	filename=str(tmp_path/"scans.hdf5")
+	recorder=ScanRecorder(filename,1,10,1)
+	recorder.record(np.ones((1,10)),0.,[0.])
+	recorder.close()
+
+	with pytest.raises(FileExistsError):
+		ScanRecorder(filename,1,10,1)
+
+	replay=ScanReplay(filename)
+	assert len(replay)==1
+	replay.close()
+
+	other=unused_filename(filename)
+	assert other!=filename and other.endswith(".hdf5")
+	assert unused_filename(str(tmp_path/"other.hdf5"))==str(tmp_path/"other.hdf5")
+
+
+#The recording is closed while another thread is recording scans: every scan recorded before is in the file.
+def test_close_while_recording(tmp_path):
+
+	filename=str(tmp_path/"scans.hdf5")
+	recorder=ScanRecorder(filename,2,50,1,chunk=4)
+	started=threading.Event()
+	errors=[]
+
+	def record():
+		try:
+			while recorder._file is not None:
+				recorder.record(np.ones((2,50)),0.,[0.])
+				started.set()
+		except Exception as e:
+			errors.append(e)
+
+	thread=threading.Thread(target=record)
+	thread.start()
+	started.wait()
+	recorder.close()
+	thread.join()
+
+	assert errors==[]
+	replay=ScanReplay(filename)
+	assert len(replay)==recorder.n_scans
+	replay.close()
+
+
+def simulated_config(**daq):
+
+	from SWP import Config
+
+	cfg=Config.load_conf(CONFIG)
+	cfg['DAQ']['Backend']='simulated'
+	cfg['DAQ']['SimRealtime']='0'
+	for key in daq:
+		cfg['DAQ'][key]=daq[key]
+
+	return cfg
+
+
+"""
+The scan offset is stamped into the first sample of every simulated scan, so the offset recorded with a scan has to
+be the same as its first sample in every acquisition mode (in the pipelined and continuous modes, the offset is moved
+while the next scan is already being acquired).
+"""
+@pytest.mark.parametrize("mode",["sequential","pipelined","continuous"])
+def test_recorded_offsets(tmp_path,mode):
+
+	pytest.importorskip("scipy")
+	from SWP import DAQ_tasks
+
+	filename=str(tmp_path/"scans.hdf5")
+	tasks=DAQ_tasks.setup_tasks(simulated_config(AcquisitionMode=mode,RecordFile=filename),2,False)
+
+	simulate_scan=tasks.simulate_scan
+	def stamped_scan(direction=1):
+		data=simulate_scan(direction)
+		data[0,0]=tasks.ao_scan.offset
+		return data
+	tasks.simulate_scan=stamped_scan
+
+	finished=threading.Event()
+	acquired=[]
+	for i in range(30):
+		tasks.acquire(finished)
+		acquired.append(tasks.PD_data[0,0])
+		tasks.ao_scan.move_offset(0.01)
+
+	tasks.stop_acquisition()
+	tasks.stop_recording()
+
+	with h5py.File(filename,'r') as f:
+		offsets=f['ScanOffset'][:]
+		stamps=f['PD_data'][:,0,0]
+
+	assert len(offsets)==30
+	np.testing.assert_allclose(offsets,stamps,atol=1e-6)
+	np.testing.assert_allclose(stamps,np.array(acquired,dtype=np.float32))
+
+
+#Recording into an existing file starts a new one, and scans with other settings than the recorded ones are not replayed.
+def test_replay(tmp_path):
+
+	pytest.importorskip("scipy")
+	from SWP import DAQ_tasks
+
+	filename=str(tmp_path/"scans.hdf5")
+	tasks=DAQ_tasks.setup_tasks(simulated_config(RecordFile=filename),2,False)
+	tasks.start_recording(filename)
+	recorded=tasks.recorder.filename
+	assert recorded!=filename
+
+	finished=threading.Event()
+	for i in range(3):
+		tasks.acquire(finished)
+	tasks.stop_recording()
+
+	replayed=DAQ_tasks.setup_tasks(simulated_config(Backend='replay',ReplayFile=recorded),2,False)
+	replayed.acquire(finished)
+	replay=ScanReplay(recorded)
+	np.testing.assert_array_equal(replayed.PD_data,replay.scan(0))
+	replay.close()
+
+	replayed.ao_scan.set_waveform("triangle")
+	replayed.set_input_timing()
+	with pytest.raises(ValueError):
+		replayed.acquire(finished)
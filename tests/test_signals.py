@@ -0,0 +1,186 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("scipy")
+
+from SWP.Data_acq import Filter, SignalBatch, _fit_lorentzians
+from SWP.Simulation import CavityModel
+
+
+"""
+Tests of the peak search of SignalBatch (Data_acq.py) on simulated scans (master laser and two slave lasers).
+"""
+
+
+N_SAMPLES=2000
+SCAN_TIME=20.
+WIN_SIZE=N_SAMPLES//400
+CRITERIA=[0.3,0.3,0.3]
+
+
+#Simulated scans, with the peaks moved by "shift" (ms) between scans.
+def scans(shifts,seed=0,noise=(0.002,0.001,0.0015)):
+
+	model=CavityModel(noise=noise,seed=seed)
+	x=np.linspace(0,SCAN_TIME,num=N_SAMPLES)
+
+	for shift in shifts:
+		yield x,model.scan(N_SAMPLES,SCAN_TIME,(8+shift,15+shift),(10+shift,17-shift),1.5)
+
+
+def full_search(x,data):
+
+	batch=SignalBatch(Filter())
+	batch.load(x,data)
+	batch.find_peaks(CRITERIA,WIN_SIZE)
+
+	return batch
+
+
+def test_tracked_peaks_match_the_full_search():
+
+	batch=SignalBatch(Filter())
+
+	for k,(x,data) in enumerate(scans([0,0.01,-0.02,0.03,0.03])):
+
+		previous=[np.copy(p) for p in batch.peaks_x]
+		batch.load(x,data)
+
+		if k==0:
+			batch.find_peaks(CRITERIA,WIN_SIZE)
+			continue
+
+		lost=batch.track_peaks(CRITERIA,WIN_SIZE,previous,40)
+		assert lost==[]
+
+		expected=full_search(x,data)
+		for i in range(3):
+			assert len(batch.peaks_x[i])==len(expected.peaks_x[i])>0
+			np.testing.assert_allclose(batch.peaks_x[i],expected.peaks_x[i],rtol=0,atol=1e-9)
+
+		#Only windows were filtered, so nothing of the tracked channels' filtered signals is left from older scans.
+		assert np.all(np.isnan(batch.smooth_der))
+
+
+def test_tracking_fails_when_peaks_move_too_far():
+
+	x,data=next(scans([0]))
+	batch=full_search(x,data)
+	previous=[p+1 for p in batch.peaks_x]
+
+	batch.load(x,data)
+	assert batch.track_peaks(CRITERIA,WIN_SIZE,previous,40)==[0,1,2]
+
+
+def test_channels_without_previous_peaks_are_lost():
+
+	x,data=next(scans([0]))
+	batch=full_search(x,data)
+	previous=[batch.peaks_x[0],np.array([]),batch.peaks_x[2]]
+
+	batch.load(x,data)
+	assert batch.track_peaks(CRITERIA,WIN_SIZE,previous,40)==[1]
+
+
+def template_search(x,data,widths=(0.02,0.01,0.01)):
+
+	batch=SignalBatch(Filter())
+	batch.load(x,data)
+	batch.find_template_peaks(CRITERIA,widths,WIN_SIZE)
+
+	return batch
+
+
+#Both engines find the same peaks, the template one at the simulated positions.
+@pytest.mark.parametrize("seed",range(5))
+def test_template_peaks(seed):
+
+	shift=0.1*seed
+	x,data=next(scans([shift],seed=seed))
+	derivative=full_search(x,data)
+	template=template_search(x,data)
+
+	positions=[[8+shift,15+shift],[8.5+shift,10+shift,11.5+shift],[15.5-shift,17-shift,18.5-shift]]
+
+	dx=x[1]-x[0]
+	for i in range(3):
+		assert len(template.peaks_x[i])==len(derivative.peaks_x[i])
+		np.testing.assert_allclose(template.peaks_x[i],positions[i],atol=0.25*dx)
+
+	#The correlation is kept as the smoothed signal, the derivatives aren't computed.
+	assert np.all(np.isnan(template.smooth_der))
+
+
+#The highest sample of the first master peak is the last discarded one, which both engines have to accept.
+def test_peak_at_the_discard_edge():
+
+	x=np.linspace(0,SCAN_TIME,num=N_SAMPLES)
+	edge=x[int(0.25*N_SAMPLES)-1]
+	model=CavityModel(noise=(0,),seed=0)
+	data=model.scan(N_SAMPLES,SCAN_TIME,(edge,edge+10),(12,),1.5)
+
+	for batch in (full_search(x,data),template_search(x,data[:2],(0.02,0.01))):
+		assert len(batch.peaks_x[0])==2
+		assert batch.peaks_x[0][0]==pytest.approx(edge,abs=0.5*(x[1]-x[0]))
+
+
+def lorentzian(u,x0,g,A,c):
+	return A/(1+((u-x0)/g)**2)+c
+
+
+#Noisy windows are fitted as curve_fit fits them one by one.
+def test_fit_lorentzians_matches_curve_fit():
+
+	from scipy.optimize import curve_fit
+
+	rng=np.random.default_rng(0)
+	u=np.broadcast_to(np.linspace(-1,1,41),(6,41))
+	truth=np.column_stack((rng.uniform(-0.2,0.2,6),rng.uniform(0.1,0.3,6),rng.uniform(0.5,2,6),rng.uniform(-0.1,0.1,6)))
+	Y=lorentzian(u,*truth.T[:,:,None])+rng.normal(0,0.01,u.shape)
+
+	start=truth*rng.uniform(0.8,1.2,truth.shape)
+	p,cost=_fit_lorentzians(u,Y,start,iterations=20)
+
+	for i in range(6):
+		expected=curve_fit(lorentzian,u[i],Y[i],p0=start[i])[0]
+		np.testing.assert_allclose(p[i],expected,rtol=1e-5,atol=1e-7)
+		assert cost[i]==pytest.approx(np.sum((Y[i]-lorentzian(u[i],*expected))**2),rel=1e-6)
+
+
+def test_fit_peaks_finds_the_simulated_lines():
+
+	batch=SignalBatch(Filter())
+	step=SCAN_TIME/N_SAMPLES
+
+	for k,(x,data) in enumerate(scans([0,0.01,0.02],noise=(0.0002,))):
+
+		batch.load(x,data)
+		batch.find_peaks(CRITERIA,WIN_SIZE)
+		batch.fit_peaks(40)
+
+		#The model's Lorentzians have half widths of 2 (master) and 1 (slaves) samples of its own time step.
+		np.testing.assert_allclose(batch.peaks_x[0],[8+0.01*k,15+0.01*k],atol=0.02*step)
+		np.testing.assert_allclose(batch.peaks_width[0],2*step,rtol=0.02)
+		np.testing.assert_allclose(batch.peaks_width[1],step,rtol=0.02)
+		np.testing.assert_allclose(batch.peaks_amp[0],0.01/(2*step)**2,rtol=0.02)
+
+	#The next fits start from the last ones.
+	assert [len(p) for p in batch.fit_params]==[2,3,3]
+
+
+#A peak that can't be fitted keeps the position from the search, without a width and an amplitude.
+def test_failed_fit_keeps_the_found_peak():
+
+	x,data=next(scans([0]))
+	batch=SignalBatch(Filter())
+	batch.load(x,data)
+	batch.find_peaks(CRITERIA,WIN_SIZE)
+	found=np.copy(batch.peaks_x[0])
+
+	batch.data_y[0]=0
+	batch.fit_peaks(40,channels=[0])
+
+	np.testing.assert_array_equal(batch.peaks_x[0],found)
+	assert np.all(np.isnan(batch.peaks_width[0]))
+	assert len(batch.fit_params[0])==0
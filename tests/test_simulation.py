@@ -0,0 +1,103 @@
+import configparser
+
+import numpy as np
+import pytest
+
+from SWP.Simulation import CavityModel, setup_model
+
+
+"""
+Tests of the simulated cavity transmission (Simulation.py). Without noise, the highest points of the channels have to
+be at the positions of the peaks.
+"""
+
+
+def quiet_model(**kwargs):
+	return CavityModel(noise=(0,),**kwargs)
+
+
+def test_scan_shape():
+
+	data=CavityModel(seed=0).scan(1000,20,(5,15),(8,12),1)
+	assert data.shape==(3,1000)
+
+
+#The sum of Lorentzians the simulated data used to be computed with, point by point.
+def lor(x,amplitudes,positions,widths):
+	return sum(a/(g**2+(x-b)**2) for a,b,g in zip(amplitudes,positions,widths))
+
+
+def test_matches_point_by_point_model():
+
+	n,scan_time,sideband=1000,20,1.2
+	x=np.linspace(0,scan_time,num=n)
+	data=quiet_model().scan(n,scan_time,(5,15),(8,12),sideband)
+
+	master=[lor(t,[0.01]*2,[5,15],[2*scan_time/n]*2) for t in x]
+	slaves=[[lor(t,[0.002]*3,[p,p+sideband,p-sideband],[scan_time/n]*3) for t in x] for p in (8,12)]
+
+	np.testing.assert_allclose(data,[master]+slaves,rtol=1e-12)
+
+
+def test_peak_positions():
+
+	n,scan_time=2000,20
+	t=np.linspace(0,scan_time,num=n)
+	data=quiet_model().scan(n,scan_time,(5,15),(8,),2)
+
+	#Master peaks and the slave laser's peak with its sidebands (all peaks of a channel are equally high).
+	for row,positions in ((data[0],[5,15]),(data[1],[6,8,10])):
+		maxima=np.nonzero((row[1:-1]>row[:-2])&(row[1:-1]>row[2:]))[0]+1
+		assert t[maxima]==pytest.approx(positions,abs=scan_time/n)
+
+
+def test_seeded_models_are_equal():
+
+	settings=dict(colored_noise=0.001,cavity_drift=0.01,laser_drift=0.01,seed=5)
+	a,b=CavityModel(**settings),CavityModel(**settings)
+
+	for i in range(3):
+		np.testing.assert_array_equal(a.scan(500,20,(5,15),(8,12),1),b.scan(500,20,(5,15),(8,12),1))
+
+
+def test_colored_noise_level():
+
+	model=CavityModel(amplitudes=(0,0),noise=(0,),colored_noise=1,noise_exponent=1,seed=1)
+	data=model.scan(4096,20,(5,15),(),1)
+
+	assert np.std(data)==pytest.approx(1,rel=0.2)
+
+
+def test_nonlinearity_moves_the_middle():
+
+	n,scan_time=2001,20
+	t=np.linspace(0,scan_time,num=n)
+	data=quiet_model(nonlinearity=0.05).scan(n,scan_time,(10,30),(),1)
+
+	#The cavity sees the middle of the scan (10 ms) at 10-0.05*20 ms, so the peak at 10 ms appears 1 ms later.
+	assert t[np.argmax(data[0])]==pytest.approx(11,abs=0.02)
+
+
+def test_hysteresis_shifts_the_falling_half():
+
+	n,scan_time=2000,10
+	t=np.linspace(0,scan_time,num=n)
+	model=quiet_model(hysteresis=0.02,cavity_drift=0.01,seed=2)
+
+	rising=model.scan(n,scan_time,(2.5,7.5),(5,),1)
+	falling=model.scan(n,scan_time,(2.5,7.5),(5,),1,falling=True)
+
+	#The falling half is still the same scan, so only the hysteresis (0.02 of the half) moves the peaks.
+	shift=t[np.argmax(falling[1])]-t[np.argmax(rising[1])]
+	assert shift==pytest.approx(0.2,abs=scan_time/n)
+
+
+def test_settings_round_trip():
+
+	model=CavityModel(amplitudes=(0.02,0.003),widths=(3.,2.),noise=(0.001,0.002),colored_noise=0.5,noise_exponent=2,cavity_drift=0.01,laser_drift=0.02,nonlinearity=0.03,hysteresis=0.04)
+
+	cfg=configparser.ConfigParser()
+	cfg.optionxform=str
+	cfg['DAQ']={key:str(value) for key,value in model.settings().items()}
+
+	assert setup_model(cfg).settings()==model.settings()